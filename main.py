@@ -4,9 +4,10 @@ main.py
 A script for running the ray tracer.
 """
 
+import asyncio
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Literal
+from typing import Literal, Optional, Tuple
 
 from jaxtyping import Shaped, jaxtyped
 from typeguard import typechecked
@@ -30,11 +31,63 @@ class Args:
         "scene4",
         "cornell_box",
     ] = "cornell_box"
-    """The type of scene to render."""
+    """The type of scene to render (a scene file of the scenes directory)."""
+    scene_file: Optional[str] = None
+    """Render this scene file (.json, .toml or a compiled .npz) instead of scene_type."""
+    compile_scene: Optional[str] = None
+    """Compile the scene file to this .npz file of packed arrays, instead of rendering."""
     spp: int = 25
     """The number of samples per pixel."""
     show_pbar: bool = True
     """A flag for showing progress bar."""
+    engine: Literal["recursive", "wavefront"] = "recursive"
+    """The ray tracing engine: recursive, or iterative with one generation of rays per bounce."""
+    tile_size: Optional[int] = None
+    """Render the image in square tiles of this size (in pixels)."""
+    memory_budget: Optional[float] = None
+    """Approximate peak memory of a tile in megabytes, used to choose the tile size."""
+    workers: Optional[int] = None
+    """Render the tiles with this number of processes."""
+    threads: Optional[int] = None
+    """Render the tiles with this number of threads sharing the scene."""
+    seed: Optional[int] = None
+    """Seed of the random numbers, for reproducible renders."""
+    checkpoint: Optional[str] = None
+    """Path (without extension) where the linear framebuffer is periodically saved."""
+    checkpoint_interval: float = 600.0
+    """Seconds between two checkpoints."""
+    resume: bool = False
+    """Continue from the checkpoint, rendering only the missing samples per pixel."""
+    adaptive: bool = False
+    """Spend the samples on the pixels that haven't converged (spp is then the average)."""
+    noise_threshold: float = 0.01
+    """Relative error under which a pixel has converged in adaptive mode."""
+    sampler: Literal["random", "stratified", "halton", "sobol", "blue_noise"] = "random"
+    """The sampler of the camera rays and of the rays scattered by diffuse surfaces."""
+    denoise: bool = False
+    """Denoise the image with the albedo, normal and depth of the first hits."""
+    aovs: Tuple[
+        Literal["albedo", "normal", "depth", "primitive_id", "collider_id", "material_id", "hit_count"], ...
+    ] = ()
+    """AOVs of the first hits saved next to the image, as {name}_{aov}.png (name: the scene file or scene_type)."""
+    hdr_output: Optional[str] = None
+    """Save the linear color and sample counts as float32 to this .npy or .pfm file."""
+    tonemap: Literal["clip", "reinhard", "aces"] = "clip"
+    """Tone mapping of the 8-bit image."""
+    exposure: float = 0.0
+    """Exposure of the 8-bit image, in stops."""
+    texture_lod: bool = False
+    """Filter the textures with mip levels picked from ray cones, instead of aliasing."""
+    merge: Tuple[str, ...] = ()
+    """Merge these partial renders of the scene (HDR outputs or checkpoints) instead of rendering."""
+    farm_workers: int = 0
+    """Render with a render farm coordinator and this number of local worker processes."""
+    farm_address: Optional[str] = None
+    """Address ('host:port' or a Unix socket path) of the render farm coordinator."""
+    farm_worker: bool = False
+    """Run as a render farm worker connecting to farm_address, instead of rendering."""
+    serve: Optional[str] = None
+    """Run a render service listening on this address ('host:port' or a Unix socket path), instead of rendering."""
 
 
 @jaxtyped(typechecker=typechecked)
@@ -44,6 +97,48 @@ def main(args: Args) -> None:
     out_dir.mkdir(exist_ok=True)
     print(f"Results will be stored under {str(out_dir)}")
 
+    if args.compile_scene is not None:
+        compile_scene(args.scene_file or str(Path("scenes") / f"{args.scene_type}.json"), args.compile_scene)
+        return
+
+    if args.merge:
+        # partial renders of the same image, e.g. rendered on several machines with different seeds
+        framebuffer = merge_renders(args.merge)
+        print("Merged", len(args.merge), "renders,", framebuffer.samples.mean(), "samples per pixel")
+        if args.hdr_output is not None:
+            save_hdr(args.hdr_output, framebuffer)
+        framebuffer.to_image(tonemap=args.tonemap, exposure=args.exposure).save(out_dir / f"{output_name(args)}.png")
+        return
+
+    if args.serve is not None:
+        # render service: the jobs describe their scene with a spec, like the render farm jobs
+        # ({"scene_type": ...} or {"scene_file": ...}, see scene_spec)
+        service = RenderService(build_scene_from_spec, workers=args.workers or 1)
+        asyncio.run(service.serve(args.serve))
+        return
+
+    if args.farm_worker:
+        run_worker(args.farm_address, build_scene_from_spec)
+        return
+
+    if args.farm_workers > 0 or args.farm_address is not None:
+        # render farm: the workers build the scene themselves from its spec
+        (framebuffer,) = render_farm(
+            build_scene_from_spec,
+            [scene_spec(args)],
+            args.spp,
+            workers=args.farm_workers,
+            address=args.farm_address,
+            tile_size=args.tile_size or 64,
+            seed=args.seed,
+            engine=args.engine,
+            sampler=args.sampler,
+        )
+        if args.hdr_output is not None:
+            save_hdr(args.hdr_output, framebuffer)
+        framebuffer.to_image(tonemap=args.tonemap, exposure=args.exposure).save(out_dir / f"{output_name(args)}.png")
+        return
+
     # setup scene
     scene = build_scene(args)
 
@@ -51,651 +146,60 @@ def main(args: Args) -> None:
     img = scene.render(
         samples_per_pixel=args.spp,
         progress_bar=args.show_pbar,
+        engine=args.engine,
+        tile_size=args.tile_size,
+        memory_budget=args.memory_budget,
+        workers=args.workers,
+        threads=args.threads,
+        seed=args.seed,
+        checkpoint=args.checkpoint,
+        checkpoint_interval=args.checkpoint_interval,
+        resume=args.resume,
+        adaptive=args.adaptive,
+        noise_threshold=args.noise_threshold,
+        sampler=args.sampler,
+        denoise=args.denoise,
+        aovs=args.aovs,
+        hdr_output=args.hdr_output,
+        tonemap=args.tonemap,
+        exposure=args.exposure,
+        texture_lod=args.texture_lod,
     )
+    if args.aovs:
+        img, aovs = img
+        for name, data in aovs.items():
+            aov_image(name, data).save(out_dir / f"{output_name(args)}_{name}.png")
 
     # show and save
-    img.save(out_dir / f"{args.scene_type}.png")
-
-
-@jaxtyped(typechecker=typechecked)
-def build_scene(args: Args) -> Scene:
-
-    if args.scene_type == "cornell_box":
-        scene = Scene(ambient_color=rgb(0.00, 0.00, 0.00))
-
-        scene.add_Camera(
-            screen_width=600,
-            screen_height=600,
-            look_from=vec3(278, 278, 800),
-            look_at=vec3(278, 278, 0),
-            focal_distance=1.0,
-            field_of_view=40,
-        )
-
-        # materials
-        green_diffuse = Diffuse(diff_color=rgb(0.12, 0.45, 0.15))
-        red_diffuse = Diffuse(diff_color=rgb(0.65, 0.05, 0.05))
-        white_diffuse = Diffuse(diff_color=rgb(0.73, 0.73, 0.73))
-        emissive_white = Emissive(color=rgb(15.0, 15.0, 15.0))
-        blue_glass = Refractive(n=vec3(1.5 + 0.05e-8j, 1.5 + 0.02e-8j, 1.5 + 0.0j))
-
-        scene.add(
-            Plane(
-                material=emissive_white,
-                center=vec3(213 + 130 / 2, 554, -227.0 - 105 / 2),
-                width=130.0,
-                height=105.0,
-                u_axis=vec3(1.0, 0.0, 0),
-                v_axis=vec3(0.0, 0, 1.0),
-            ),
-            importance_sampled=False,
-            # importance_sampled=False,
-        )
-
-        scene.add(
-            Plane(
-                material=white_diffuse,
-                center=vec3(555 / 2, 555 / 2, -555.0),
-                width=555.0,
-                height=555.0,
-                u_axis=vec3(0.0, 1.0, 0),
-                v_axis=vec3(1.0, 0, 0.0),
-            )
-        )
-
-        scene.add(
-            Plane(
-                material=green_diffuse,
-                center=vec3(-0.0, 555 / 2, -555 / 2),
-                width=555.0,
-                height=555.0,
-                u_axis=vec3(0.0, 1.0, 0),
-                v_axis=vec3(0.0, 0, -1.0),
-            )
-        )
-
-        scene.add(
-            Plane(
-                material=red_diffuse,
-                center=vec3(555.0, 555 / 2, -555 / 2),
-                width=555.0,
-                height=555.0,
-                u_axis=vec3(0.0, 1.0, 0),
-                v_axis=vec3(0.0, 0, -1.0),
-            )
-        )
-
-        scene.add(
-            Plane(
-                material=white_diffuse,
-                center=vec3(555 / 2, 555, -555 / 2),
-                width=555.0,
-                height=555.0,
-                u_axis=vec3(1.0, 0.0, 0),
-                v_axis=vec3(0.0, 0, -1.0),
-            )
-        )
-
-        scene.add(
-            Plane(
-                material=white_diffuse,
-                center=vec3(555 / 2, 0.0, -555 / 2),
-                width=555.0,
-                height=555.0,
-                u_axis=vec3(1.0, 0.0, 0),
-                v_axis=vec3(0.0, 0, -1.0),
-            )
-        )
-
-        cb = Cuboid(
-            material=white_diffuse,
-            center=vec3(182.5, 165, -285 - 160 / 2),
-            width=165,
-            height=165 * 2,
-            length=165,
-            shadow=False,
-        )
-        cb.rotate(θ=15, u=vec3(0, 1, 0))
-        scene.add(cb)
-
-        scene.add(
-            Sphere(
-                material=blue_glass,
-                center=vec3(370.5, 165 / 2, -65 - 185 / 2),
-                radius=165 / 2,
-                shadow=False,
-                max_ray_depth=3,
-            ),
-            # importance_sampled=True,
-            importance_sampled=False,
-        )
-
-        return scene
-    elif args.scene_type == "scene0":
-        # define materials to use
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=2.0),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.7,
-            n=vec3(2.2, 2.2, 2.2),
-        )  # n = index of refraction
-
-        # Set Scene
-        scene = Scene()
-        scene.add_Camera(
-            look_from=vec3(0.0, 0.25, 1.0),
-            look_at=vec3(0.0, 0.25, -3.0),
-            screen_width=400,
-            screen_height=300,
-        )
-
-        scene.add_DirectionalLight(Ldir=vec3(0.0, 0.5, 0.5), color=rgb(0.5, 0.5, 0.5))
-
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=6.0,
-                height=6.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=5,
-            )
-        )
-
-        # see src/backgrounds
-        return scene
-    elif args.scene_type == "scene0-skybox":
-        # define materials to use
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=2.0),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.7,
-            n=vec3(2.2, 2.2, 2.2),
-        )  # n = index of refraction
-
-        # Set Scene
-        scene = Scene()
-        scene.add_Camera(
-            look_from=vec3(0.0, 0.25, 1.0),
-            look_at=vec3(0.0, 0.25, -3.0),
-            screen_width=400,
-            screen_height=300,
-        )
-
-        scene.add_DirectionalLight(Ldir=vec3(0.0, 0.5, 0.5), color=rgb(0.5, 0.5, 0.5))
-
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=6.0,
-                height=6.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=5,
-            )
-        )
-
-        # see src/backgrounds
-        scene.add_Background("stormydays.png")
-        return scene
-    elif args.scene_type == "scene1-diffuse":
-        # define materials to use
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=2.0),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.7,
-            n=vec3(2.2, 2.2, 2.2),
-        )  # n = index of refraction
-        green_diffuse = Diffuse(diff_color=rgb(0.0, 0.1, 0.0))
-
-        # Set Scene
-        scene = Scene()
-        scene.add_Camera(
-            look_from=vec3(0.0, 0.25, 1.0),
-            look_at=vec3(0.0, 0.25, -3.0),
-            screen_width=400,
-            screen_height=300,
-        )
-
-        scene.add_DirectionalLight(Ldir=vec3(0.0, 0.5, 0.5), color=rgb(0.5, 0.5, 0.5))
-
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=6.0,
-                height=6.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=5,
-            )
-        )
-
-        cb = Cuboid(
-            material=green_diffuse,
-            center=vec3(0.00, 0.0001, -0.8),
-            width=0.9,
-            height=1.0,
-            length=0.4,
-            shadow=False,
-            max_ray_depth=5,
-        )
-        cb.rotate(θ=30, u=vec3(0, 1, 0))
-        scene.add(cb)
-
-        # see src/backgrounds
-        scene.add_Background("stormydays.png")
-        return scene
-    elif args.scene_type == "scene1-glossy":
-        # define materials to use
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=2.0),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.7,
-            n=vec3(2.2, 2.2, 2.2),
-        )  # n = index of refraction
-        green_glossy = Glossy(
-            diff_color=rgb(0.0, 0.5, 0.0),
-            n=vec3(1.3 + 1.91j, 1.3 + 1.91j, 1.4 + 2.91j),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.8,
-        )
-
-        # Set Scene
-        scene = Scene()
-        scene.add_Camera(
-            look_from=vec3(0.0, 0.25, 1.0),
-            look_at=vec3(0.0, 0.25, -3.0),
-            screen_width=400,
-            screen_height=300,
-        )
-
-        scene.add_DirectionalLight(Ldir=vec3(0.0, 0.5, 0.5), color=rgb(0.5, 0.5, 0.5))
-
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=6.0,
-                height=6.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=5,
-            )
-        )
-
-        cb = Cuboid(
-            material=green_glossy,
-            center=vec3(0.00, 0.0001, -0.8),
-            width=0.9,
-            height=1.0,
-            length=0.4,
-            shadow=False,
-            max_ray_depth=5,
-        )
-        cb.rotate(θ=30, u=vec3(0, 1, 0))
-        scene.add(cb)
-
-        # see src/backgrounds
-        scene.add_Background("stormydays.png")
-        return scene
-    elif args.scene_type == "scene1-refractive":
-        # define materials to use
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=2.0),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.7,
-            n=vec3(2.2, 2.2, 2.2),
-        )  # n = index of refraction
-        green_glass = Refractive(n=vec3(1.5 + 4e-8j, 1.5 + 0.0j, 1.5 + 4e-8j))
-
-        # Set Scene
-        scene = Scene()
-        scene.add_Camera(
-            look_from=vec3(0.0, 0.25, 1.0),
-            look_at=vec3(0.0, 0.25, -3.0),
-            screen_width=400,
-            screen_height=300,
-        )
-
-        scene.add_DirectionalLight(Ldir=vec3(0.0, 0.5, 0.5), color=rgb(0.5, 0.5, 0.5))
-
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=6.0,
-                height=6.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=5,
-            )
-        )
-
-        cb = Cuboid(
-            material=green_glass,
-            center=vec3(0.00, 0.0001, -0.8),
-            width=0.9,
-            height=1.0,
-            length=0.4,
-            shadow=False,
-            max_ray_depth=5,
-        )
-        cb.rotate(θ=30, u=vec3(0, 1, 0))
-        scene.add(cb)
-
-        # see src/backgrounds
-        scene.add_Background("stormydays.png")
-        return scene
-    elif args.scene_type == "scene2-diffuse":
-        green_diffuse = Diffuse(diff_color=rgb(0.0, 0.1, 0.0))
-
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=80.0),
-            n=vec3(1.2 + 0.3j, 1.2 + 0.3j, 1.1 + 0.3j),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.9,
-        )
-
-        # Set Scene
-        scene = Scene(ambient_color=rgb(0.05, 0.05, 0.05))
-
-        angle = -np.pi / 2 * 0.3
-        scene.add_Camera(
-            look_from=vec3(2.5 * np.sin(angle), 0.25, 2.5 * np.cos(angle) - 1.5),
-            look_at=vec3(0.0, 0.25, -3.0),
-            screen_width=400,
-            screen_height=300,
-        )
-
-        scene.add_DirectionalLight(
-            Ldir=vec3(0.52, 0.45, -0.5), color=rgb(0.15, 0.15, 0.15)
-        )
-
-        scene.add(
-            Sphere(
-                material=green_diffuse,
-                center=vec3(-0.75, 0.1, -2.0),
-                radius=0.6,
-                max_ray_depth=3,
-            )
-        )
+    img.save(out_dir / f"{output_name(args)}.png")
 
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=120.0,
-                height=120.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=3,
-            )
-        )
 
-        # see src/backgrounds
-        scene.add_Background("stormydays.png")
-        return scene
-    elif args.scene_type == "scene2-glossy":
-        green_glossy = Glossy(
-            diff_color=rgb(0.0, 0.5, 0.0),
-            n=vec3(1.3 + 1.91j, 1.3 + 1.91j, 1.4 + 2.91j),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.8,
-        )
+def scene_spec(args: Args) -> dict:
+    # scene spec of the render farm jobs and the render service: the Args fields that describe the scene
+    spec = {"scene_type": args.scene_type}
+    if args.scene_file is not None:
+        spec["scene_file"] = args.scene_file
+    return spec
 
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=80.0),
-            n=vec3(1.2 + 0.3j, 1.2 + 0.3j, 1.1 + 0.3j),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.9,
-        )
 
-        # Set Scene
-        scene = Scene(ambient_color=rgb(0.05, 0.05, 0.05))
+def build_scene_from_spec(spec: dict) -> Scene:
+    return build_scene(Args(**spec))
 
-        angle = -np.pi / 2 * 0.3
-        scene.add_Camera(
-            look_from=vec3(2.5 * np.sin(angle), 0.25, 2.5 * np.cos(angle) - 1.5),
-            look_at=vec3(0.0, 0.25, -3.0),
-            screen_width=400,
-            screen_height=300,
-        )
 
-        scene.add_DirectionalLight(
-            Ldir=vec3(0.52, 0.45, -0.5), color=rgb(0.15, 0.15, 0.15)
-        )
+def output_name(args: Args) -> str:
+    # the images are named after the scene file, or the scene type
+    if args.scene_file is not None:
+        return Path(args.scene_file).stem
+    return args.scene_type
 
-        scene.add(
-            Sphere(
-                material=green_glossy,
-                center=vec3(-0.75, 0.1, -2.0),
-                radius=0.6,
-                max_ray_depth=3,
-            )
-        )
-
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=120.0,
-                height=120.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=3,
-            )
-        )
-
-        # see src/backgrounds
-        scene.add_Background("stormydays.png")
-        return scene
-    elif args.scene_type == "scene2-refractive":
-        green_glass = Refractive(n=vec3(1.5 + 4e-8j, 1.5 + 0.0j, 1.5 + 4e-8j))
-
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=80.0),
-            n=vec3(1.2 + 0.3j, 1.2 + 0.3j, 1.1 + 0.3j),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.9,
-        )
-
-        # Set Scene
-        scene = Scene(ambient_color=rgb(0.05, 0.05, 0.05))
-
-        angle = -np.pi / 2 * 0.3
-        scene.add_Camera(
-            look_from=vec3(2.5 * np.sin(angle), 0.25, 2.5 * np.cos(angle) - 1.5),
-            look_at=vec3(0.0, 0.25, -3.0),
-            screen_width=400,
-            screen_height=300,
-        )
-
-        scene.add_DirectionalLight(
-            Ldir=vec3(0.52, 0.45, -0.5), color=rgb(0.15, 0.15, 0.15)
-        )
-
-        scene.add(
-            Sphere(
-                material=green_glass,
-                center=vec3(-0.75, 0.1, -2.0),
-                radius=0.6,
-                max_ray_depth=3,
-            )
-        )
-
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=120.0,
-                height=120.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=3,
-            )
-        )
 
-        # see src/backgrounds
-        scene.add_Background("stormydays.png")
-        return scene
-    elif args.scene_type == "scene3":
-        gold_metal = Glossy(
-            diff_color=rgb(1.0, 0.572, 0.184),
-            n=vec3(0.15 + 3.58j, 0.4 + 2.37j, 1.54 + 1.91j),
-            roughness=0.0,
-            spec_coeff=0.2,
-            diff_coeff=0.8,
-        )
-        bluish_metal = Glossy(
-            diff_color=rgb(0.0, 0, 0.1),
-            n=vec3(1.3 + 1.91j, 1.3 + 1.91j, 1.4 + 2.91j),
-            roughness=0.2,
-            spec_coeff=0.5,
-            diff_coeff=0.3,
-        )
-
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=80.0),
-            n=vec3(1.2 + 0.3j, 1.2 + 0.3j, 1.1 + 0.3j),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.9,
-        )
-
-        # Set Scene
-        scene = Scene(ambient_color=rgb(0.05, 0.05, 0.05))
-
-        angle = -np.pi / 2 * 0.3
-        scene.add_Camera(
-            look_from=vec3(2.5 * np.sin(angle), 0.25, 2.5 * np.cos(angle) - 1.5),
-            look_at=vec3(0.0, 0.25, -3.0),
-            screen_width=400,
-            screen_height=300,
-        )
-
-        scene.add_DirectionalLight(
-            Ldir=vec3(0.52, 0.45, -0.5), color=rgb(0.15, 0.15, 0.15)
-        )
-
-        scene.add(
-            Sphere(
-                material=gold_metal,
-                center=vec3(-0.75, 0.1, -3.0),
-                radius=0.6,
-                max_ray_depth=3,
-            )
-        )
-        scene.add(
-            Sphere(
-                material=bluish_metal,
-                center=vec3(1.25, 0.1, -3.0),
-                radius=0.6,
-                max_ray_depth=3,
-            )
-        )
-
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=120.0,
-                height=120.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=3,
-            )
-        )
-
-        # see src/backgrounds
-        scene.add_Background("stormydays.png")
-        return scene
-    elif args.scene_type == "scene4":
-        # materials
-        blue_glass = Refractive(
-            n=vec3(1.5 + 4e-8j, 1.5 + 4e-8j, 1.5 + 0.0j)
-        )  # n = index of refraction
-        green_glass = Refractive(n=vec3(1.5 + 4e-8j, 1.5 + 0.0j, 1.5 + 4e-8j))
-        red_glass = Refractive(n=vec3(1.5 + 0.0j, 1.5 + 5e-8j, 1.5 + 5e-8j))
-
-        floor = Glossy(
-            diff_color=image("checkered_floor.png", repeat=80.0),
-            n=vec3(1.2 + 0.3j, 1.2 + 0.3j, 1.1 + 0.3j),
-            roughness=0.2,
-            spec_coeff=0.3,
-            diff_coeff=0.9,
-        )
-
-        # Set Scene
-        scene = Scene(ambient_color=rgb(0.05, 0.05, 0.05))
-
-        angle = np.pi / 2 * 0.3
-        scene.add_Camera(
-            look_from=vec3(2.5 * np.sin(angle), 0.25, 2.5 * np.cos(angle) - 1.5),
-            look_at=vec3(0.0, 0.25, -1.5),
-            screen_width=400,
-            screen_height=300,
-        )
-
-        scene.add_DirectionalLight(
-            Ldir=vec3(0.52, 0.45, -0.5), color=rgb(0.15, 0.15, 0.15)
-        )
-
-        scene.add(
-            Sphere(
-                material=blue_glass,
-                center=vec3(-1.2, 0.0, -1.5),
-                radius=0.5,
-                shadow=False,
-                max_ray_depth=3,
-            )
-        )
-        scene.add(
-            Sphere(
-                material=green_glass,
-                center=vec3(0.0, 0.0, -1.5),
-                radius=0.5,
-                shadow=False,
-                max_ray_depth=3,
-            )
-        )
-        scene.add(
-            Sphere(
-                material=red_glass,
-                center=vec3(1.2, 0.0, -1.5),
-                radius=0.5,
-                shadow=False,
-                max_ray_depth=3,
-            )
-        )
-
-        scene.add(
-            Plane(
-                material=floor,
-                center=vec3(0, -0.5, -3.0),
-                width=120.0,
-                height=120.0,
-                u_axis=vec3(1.0, 0, 0),
-                v_axis=vec3(0, 0, -1.0),
-                max_ray_depth=3,
-            )
-        )
+@jaxtyped(typechecker=typechecked)
+def build_scene(args: Args) -> Scene:
+    # the scenes are described by scene files, see src/scene_file.py
+    if args.scene_file is not None:
+        return load_scene(args.scene_file)
+    return load_scene(str(Path("scenes") / f"{args.scene_type}.json"))
 
-        # see src/backgrounds
-        scene.add_Background("miramar.jpeg")
-        return scene
 
 if __name__ == "__main__":
     main(tyro.cli(Args))
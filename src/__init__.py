@@ -4,7 +4,16 @@ from .utils.colour_functions import *
 from .utils.image_functions import *
 
 from .ray import *
+from .wavefront import *
+from .aov import *
+from .framebuffer import *
+from .denoise import *
+from .checkpoint import *
+from .hdr import *
 from .scene import *
+from .scene_file import *
+from .farm import *
+from .service import *
 from .geometry import *
 from .lights import *
 from .materials import *
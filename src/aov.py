@@ -0,0 +1,130 @@
+from PIL import Image
+import numpy as np
+from .utils.vector3 import vec3
+
+
+# Arbitrary output variables (AOVs): features of the first surface hit by the camera rays,
+# recorded by the engines while they trace the camera rays (no extra intersection pass).
+# Every AOV is summed over the samples of a pixel in the framebuffer, and resolved by its kind:
+# - "mean": the average over the samples, antialiased like the color (albedo, normal, depth),
+# - "sum": the sum over the samples (hit_count: the number of camera rays that hit a surface),
+# - "first": the value of the first sample of the pixel, for the ids, which can't be averaged.
+#   It's stored plus one, so pixels whose first sample hit nothing get -1.
+# The ids index the lists of the scene built by Scene.finalize: scene_primitives (primitive_id),
+# collider_list (collider_id) and material_list (material_id).
+
+
+def get_albedo(scene, ray, hit):
+    return hit.material.get_albedo(hit)
+
+
+def get_normal(scene, ray, hit):
+    return hit.material.get_Normal(hit)
+
+
+def get_depth(scene, ray, hit):
+    return hit.distance
+
+
+def get_collider_id(scene, ray, hit):
+    ids = np.array([scene.collider_id[id(c)] for c in hit.colliders])
+    if hit.collider_index is None:
+        return np.full(hit.distance.shape[0], ids[0])
+    return ids[hit.collider_index]
+
+
+def get_primitive_id(scene, ray, hit):
+    return scene.collider_primitive[get_collider_id(scene, ray, hit)]
+
+
+def get_material_id(scene, ray, hit):
+    return scene.collider_material[get_collider_id(scene, ray, hit)]
+
+
+def get_hit_count(scene, ray, hit):
+    return np.ones(hit.distance.shape[0])
+
+
+# AOV name: (number of channels, function of the scene, the camera rays and their first hit, kind)
+AOVS = {
+    "albedo": (3, get_albedo, "mean"),
+    "normal": (3, get_normal, "mean"),
+    "depth": (1, get_depth, "mean"),
+    "primitive_id": (1, get_primitive_id, "first"),
+    "collider_id": (1, get_collider_id, "first"),
+    "material_id": (1, get_material_id, "first"),
+    "hit_count": (1, get_hit_count, "sum"),
+}
+
+
+def aov_channels(names):
+    """Returns the total number of channels of the given AOVs."""
+    return sum(AOVS[name][0] for name in names)
+
+
+def resolve_aov(name, data, samples):
+    """Returns the value of an AOV from its sum over the given numbers of samples (see the kinds of AOVS)."""
+    kind = AOVS[name][2]
+    if kind == "mean":
+        return data / np.maximum(samples, 1)
+    if kind == "first":
+        return data - 1.0
+    return data
+
+
+def aov_image(name, data, max_depth=10.0):
+    """
+    Returns a PIL RGB image showing the resolved values of an AOV, an array of shape (height, width, channels).
+    Normals are mapped from [-1, 1] to [0, 1], depths are a grey map clamped at max_depth,
+    ids get a random color each (black where nothing was hit) and hit counts are scaled by their maximum.
+    """
+    kind = AOVS[name][2]
+    if name == "normal":
+        color = data * 0.5 + 0.5
+    elif name == "depth":
+        color = np.repeat(np.minimum(data, max_depth) / max_depth, 3, axis=2)
+    elif kind == "first":
+        ids = data[..., 0].astype(np.int64)
+        palette = np.random.RandomState(0).rand(max(int(ids.max()) + 1, 1), 3)
+        color = np.where(ids[..., None] >= 0, palette[ids], 0.0)
+    elif kind == "sum":
+        color = np.repeat(data / max(data.max(), 1.0), 3, axis=2)
+    else:
+        color = data
+    return Image.fromarray((255 * np.clip(color, 0, 1)).astype(np.uint8), "RGB")
+
+
+class AOVSamples:
+    """
+    The AOVs of one sample of a batch of camera rays, filled by the engine.
+    Rays that hit nothing keep zeros.
+
+    Args:
+    - names: The names of the recorded AOVs (keys of AOVS).
+    - n: The number of camera rays.
+    - first: An optional boolean array of shape (n,) telling which camera rays are the first sample of their pixel.
+      The "first" AOVs are only recorded for them (by default for every ray).
+    """
+
+    def __init__(self, names, n, first=None):
+        for name in names:
+            if name not in AOVS:
+                raise ValueError("unknown AOV " + name)
+        self.data = {name: np.zeros((AOVS[name][0], n)) for name in names}
+        self.first = first
+
+    def record(self, index, scene, ray, hit):
+        """Records the AOVs of the camera rays of the given indices, whose first hit is hit."""
+        if hit.point is None:
+            hit.point = ray.origin + ray.dir * hit.distance
+        for name, data in self.data.items():
+            channels, f, kind = AOVS[name]
+            value = f(scene, ray, hit)
+            if isinstance(value, vec3):
+                value = value.to_array()
+            value = np.reshape(value, (channels, -1))
+            if kind == "first":
+                value = value + 1.0
+                if self.first is not None:
+                    value = np.where(self.first[index], value, 0.0)
+            data[:, index] = value
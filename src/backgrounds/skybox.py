@@ -1,8 +1,9 @@
+import numpy as np
 from ..geometry import Cuboid_Collider, Primitive
 from ..materials import Material
 from ..utils.vector3 import vec3
 from ..utils.constants import SKYBOX_DISTANCE
-from ..utils.image_functions import load_image, load_image_as_linear_sRGB
+from ..utils.image_functions import get_texels, cached_texels, texture_key, Texels
 from .util.blur_background import blur_skybox
 
 
@@ -11,7 +12,9 @@ class SkyBox(Primitive):
         self, cubemap, center=vec3(0.0, 0.0, 0.0), light_intensity=0.0, blur=0.0
     ):
         super().__init__(
-            center, SkyBox_Material(cubemap, light_intensity, blur), shadow=False
+            center,
+            SkyBox_Material(cubemap, light_intensity, blur, layout="cross"),
+            shadow=False,
         )
         l = SKYBOX_DISTANCE
         self.light_intensity = light_intensity
@@ -33,15 +36,32 @@ class SkyBox(Primitive):
 
 
 class SkyBox_Material(Material):
-    def __init__(self, cubemap, light_intensity, blur):
-        self.texture = load_image_as_linear_sRGB("src/backgrounds/" + cubemap)
+    """
+    Args:
+    - layout: The layout of the images for their mip levels, "cross" for cube maps (see Texels).
+    """
+
+    def __init__(self, cubemap, light_intensity, blur, layout=None):
+        super().__init__()
+        self.texture = get_texels(
+            "src/backgrounds/" + cubemap, linear=True, layout=layout
+        )
 
         if light_intensity != 0.0:
-            self.lightmap = load_image("src/backgrounds/lightmaps/" + cubemap)
+            self.lightmap = get_texels(
+                "src/backgrounds/lightmaps/" + cubemap, layout=layout
+            )
 
         if blur != 0.0:
-            self.blur_image = blur_skybox(
-                load_image("src/backgrounds/" + cubemap), blur, cubemap
+            path = "src/backgrounds/" + cubemap
+            self.blur_image = cached_texels(
+                ("blur_skybox", texture_key(path), blur, layout),
+                lambda: Texels(
+                    blur_skybox(get_texels(path)[...], blur, cubemap).astype(
+                        np.float16
+                    ),
+                    layout=layout,
+                ),
             )
 
         self.blur = blur
@@ -50,35 +70,13 @@ class SkyBox_Material(Material):
 
     def get_texture_color(self, hit, ray):
         u, v = hit.get_uv()
-
-        if self.blur != 0.0:
-            im = self.blur_image[
-                -(
-                    (v * self.blur_image.shape[0] * self.repeat).astype(int)
-                    % self.blur_image.shape[0]
-                ),
-                (u * self.blur_image.shape[1] * self.repeat).astype(int)
-                % self.blur_image.shape[1],
-            ].T
-        else:
-            im = self.texture[
-                -(
-                    (v * self.texture.shape[0] * self.repeat).astype(int)
-                    % self.texture.shape[0]
-                ),
-                (u * self.texture.shape[1] * self.repeat).astype(int)
-                % self.texture.shape[1],
-            ].T
+        image = self.blur_image if self.blur != 0.0 else self.texture
+        im = image.sample(u, v, self.repeat, hit.get_lod(image.shape, self.repeat))
 
         if (ray.depth != 0) and (self.light_intensity != 0.0):
-            ls = self.lightmap[
-                -(
-                    (v * self.texture.shape[0] * self.repeat).astype(int)
-                    % self.texture.shape[0]
-                ),
-                (u * self.texture.shape[1] * self.repeat).astype(int)
-                % self.texture.shape[1],
-            ].T
+            ls = self.lightmap.sample(
+                u, v, self.repeat, hit.get_lod(self.lightmap.shape, self.repeat)
+            )
             color = vec3(
                 im[0] + self.light_intensity * ls[0],
                 im[1] + self.light_intensity * ls[1],
@@ -89,6 +87,13 @@ class SkyBox_Material(Material):
             color = vec3(im[0], im[1], im[2])
         return color
 
-    def get_color(self, scene, ray, hit):
+    def get_albedo(self, hit):
+        # the background seen from the camera, so the denoiser leaves it as it is
+        u, v = hit.get_uv()
+        image = self.blur_image if self.blur != 0.0 else self.texture
+        im = image.sample(u, v, self.repeat, hit.get_lod(image.shape, self.repeat))
+        return vec3(im[0], im[1], im[2])
+
+    def scatter(self, scene, ray, hit):
         hit.point = ray.origin + ray.dir * hit.distance
-        return hit.material.get_texture_color(hit, ray)
+        return hit.material.get_texture_color(hit, ray), []
@@ -1,132 +1,136 @@
-from PIL import Image, ImageFilter
+import os
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from ...utils.colour_functions import sRGB_to_sRGB_linear
 
 
-def to_image(arr):
-    img = [
-        Image.fromarray((255 * arr[:, :, i]).astype(np.uint8), "L") for i in range(0, 3)
-    ]
-    return Image.merge("RGB", img)
-
-
-def to_array(img):
-    return np.asarray(img) / 256.0
-
-
-def blur_skybox(img_array, blur, cubemap):
-
+# Gaussian blur of a cube map laid out as a horizontal cross (4x3 faces of N x N texels):
+#
+#          top
+#   left  front  right  back
+#         bottom
+#
+# Every face is padded with strips of its four neighbours, rotated so they continue the face across
+# the seams, and blurred in float with a separable Gaussian (two 1D convolutions, with FFTs for wide blurs).
+# The corners of the padding are outside of the cube, so they're left out with a normalized
+# convolution (the blur of the texels divided by the blur of a mask of the valid texels).
+
+# face: its position in the cross (row, column) and its (left, right, top, bottom) neighbours,
+# as (face, number of 90 degree counterclockwise rotations of np.rot90)
+FACES = {
+    "left": ((1, 0), (("back", 0), ("front", 0), ("top", 1), ("bottom", -1))),
+    "front": ((1, 1), (("left", 0), ("right", 0), ("top", 0), ("bottom", 0))),
+    "right": ((1, 2), (("front", 0), ("back", 0), ("top", -1), ("bottom", 1))),
+    "back": ((1, 3), (("right", 0), ("left", 0), ("top", 2), ("bottom", 2))),
+    "top": ((0, 1), (("left", -1), ("right", 1), ("back", 2), ("front", 0))),
+    "bottom": ((2, 1), (("left", 1), ("right", -1), ("front", 0), ("back", 2))),
+}
+
+
+def gaussian_kernel(sigma):
+    radius = max(int(np.ceil(3.0 * sigma)), 1)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-(x**2) / (2.0 * sigma**2))
+    return kernel / kernel.sum()
+
+
+def convolve_axis(x, kernel, axis):
+    """Convolves x with a 1D kernel of odd length along an axis (zeros outside x)."""
+    length = x.shape[axis]
+    radius = kernel.shape[0] // 2
+    if kernel.shape[0] <= 16:
+        # short kernels: sum of the shifted copies of x
+        pad = [(0, 0)] * x.ndim
+        pad[axis] = (radius, radius)
+        x = np.moveaxis(np.pad(x, pad), axis, 0)
+        out = np.zeros((length,) + x.shape[1:], x.dtype)
+        term = np.empty_like(out)
+        for i, weight in enumerate(kernel.astype(x.dtype)):
+            out += np.multiply(x[i : i + length], weight, out=term)
+        return np.moveaxis(out, 0, axis)
+
+    # long kernels: product of the FFTs, zero padded to a fast size
+    size = fft_size(length + kernel.shape[0] - 1)
+    shape = [1] * x.ndim
+    shape[axis] = -1
+    kernel_f = np.fft.rfft(kernel, size).reshape(shape)
+    out = np.fft.irfft(np.fft.rfft(x, size, axis=axis) * kernel_f, size, axis=axis)
+    return np.take(out, np.arange(radius, radius + length), axis=axis)
+
+
+def fft_size(n):
+    """Returns the smallest integer >= n whose only prime factors are 2, 3 and 5."""
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def padded_face(faces, name, border):
+    """Returns the face (with its mask channel) surrounded by a border of its neighbours.
+    The corners of the border are zeros, out of the mask."""
+    face = faces[name]
+    N = face.shape[0]
+    out = np.zeros((N + 2 * border, N + 2 * border, face.shape[2]), face.dtype)
+    inside = slice(border, border + N)
+    out[inside, inside] = face
+
+    (left, k_left), (right, k_right), (top, k_top), (bottom, k_bottom) = FACES[name][1]
+    out[inside, :border] = np.rot90(faces[left], k_left)[:, N - border :]
+    out[inside, border + N :] = np.rot90(faces[right], k_right)[:, :border]
+    out[:border, inside] = np.rot90(faces[top], k_top)[N - border :, :]
+    out[border + N :, inside] = np.rot90(faces[bottom], k_bottom)[:border, :]
+    return out
+
+
+def blur_skybox(img_array, blur, cubemap, threads=None):
+    """
+    Blurs a cube map laid out as a horizontal cross across the seams of its faces.
+
+    Args:
+    - img_array: A NumPy array of shape (3N, 4N, channels) with the sRGB values of the cube map.
+    - blur: The standard deviation of the Gaussian, in texels.
+    - cubemap: The name of the cube map (for the progress message).
+    - threads: The number of faces blurred at the same time (by default one per CPU, up to 6).
+
+    Returns:
+    - A float32 NumPy array of the same shape with the linear sRGB values of the blurred cube map.
+      The texels out of the faces are black.
+    """
     print("blurring " + cubemap)
 
-    N = int(img_array.shape[0] / 3)
-
-    left = img_array[1 * N : 2 * N, 0 * N : 1 * N]
-    front = img_array[N : 2 * N, N : 2 * N]
-    right = img_array[N : 2 * N, 2 * N : 3 * N]
-    back = img_array[N : 2 * N, 3 * N : 4 * N]
-    top = img_array[0 : 1 * N, 1 * N : 2 * N]
-    bottom = img_array[2 * N : 3 * N, 1 * N : 2 * N]
-
-    cubelist = [
-        [None, top, None, None],
-        [left, front, right, back],
-        [None, bottom, None, None],
-    ]
-
-    back_blur = np.zeros((N * 3, N * 3, 3))
-
-    back_blur[1 * N : 2 * N, 0 * N : 1 * N] = cubelist[1][0 - 2]  # left
-    back_blur[N : 2 * N, N : 2 * N] = cubelist[1][1 - 2]  # front
-    back_blur[N : 2 * N, 2 * N : 3 * N] = cubelist[1][2 - 2]  # right
-    back_blur[2 * N : 3 * N, 1 * N : 2 * N] = np.rot90(cubelist[2][1], k=2)  # bottom
-    back_blur[0 : 1 * N, 1 * N : 2 * N] = np.rot90(cubelist[0][1], k=2)  # top
-
-    back_blur = to_image(back_blur)
-    back_blur = (back_blur).filter(ImageFilter.GaussianBlur(radius=blur))
-
-    back_blur = to_array(back_blur)
-
-    back_blur = back_blur[N : 2 * N, N : 2 * N]
-
-    top_blur = np.zeros((N * 3, N * 3, 3))
-    top_blur[1 * N : 2 * N, 0 * N : 1 * N] = np.rot90(cubelist[1][0], k=-1)  # left
-    top_blur[N : 2 * N, N : 2 * N] = cubelist[1 - 1][1]  # front
-    top_blur[N : 2 * N, 2 * N : 3 * N] = np.rot90(cubelist[1][2], k=1)  # right
-    top_blur[2 * N : 3 * N, 1 * N : 2 * N] = cubelist[1][1]  # bottom
-    top_blur[0 : 1 * N, 1 * N : 2 * N] = np.rot90(cubelist[1][3], k=2)  # top
-    top_blur = to_image(top_blur)
-    top_blur = (top_blur).filter(ImageFilter.GaussianBlur(radius=blur))
-
-    top_blur = to_array(top_blur)
-
-    top_blur = top_blur[N : 2 * N, N : 2 * N]
-
-    bottom_blur = np.zeros((N * 3, N * 3, 3))
-
-    bottom_blur[1 * N : 2 * N, 0 * N : 1 * N] = np.rot90(cubelist[1][0], k=1)  # left
-    bottom_blur[N : 2 * N, N : 2 * N] = cubelist[1 + 1][1]  # front
-    bottom_blur[N : 2 * N, 2 * N : 3 * N] = np.rot90(cubelist[1][2], k=-1)  # right
-    bottom_blur[2 * N : 3 * N, 1 * N : 2 * N] = np.rot90(cubelist[1][3], k=2)  # bottom
-    bottom_blur[0 : 1 * N, 1 * N : 2 * N] = cubelist[1][1]  # top
-
-    bottom_blur = to_image(bottom_blur)
-    bottom_blur = (bottom_blur).filter(ImageFilter.GaussianBlur(radius=blur))
-
-    bottom_blur = to_array(bottom_blur)
-
-    bottom_blur = bottom_blur[N : 2 * N, N : 2 * N]
-
-    right_blur = np.zeros((N * 3, N * 3, 3))
-
-    right_blur[1 * N : 2 * N, 0 * N : 1 * N] = cubelist[1][0 + 1]  # left
-    right_blur[N : 2 * N, N : 2 * N] = cubelist[1][1 + 1]  # front
-    right_blur[N : 2 * N, 2 * N : 3 * N] = cubelist[1][2 + 1]  # right
-    right_blur[2 * N : 3 * N, 1 * N : 2 * N] = np.rot90(cubelist[2][1])  # bottom
-    right_blur[0 : 1 * N, 1 * N : 2 * N] = np.rot90(cubelist[0][1], k=-1)  # top
-
-    right_blur = to_image(right_blur).filter(ImageFilter.GaussianBlur(radius=blur))
-
-    right_blur = to_array(right_blur)
-
-    right_blur = right_blur[N : 2 * N, N : 2 * N]
-
-    front_blur = np.zeros((N * 3, N * 3, 3))
-
-    front_blur[1 * N : 2 * N, 0 * N : 1 * N] = cubelist[1][0]  # left
-    front_blur[N : 2 * N, N : 2 * N] = cubelist[1][1]  # front
-    front_blur[N : 2 * N, 2 * N : 3 * N] = cubelist[1][2]  # right
-    front_blur[2 * N : 3 * N, 1 * N : 2 * N] = cubelist[2][1]  # bottom
-    front_blur[0 : 1 * N, 1 * N : 2 * N] = cubelist[0][1]  # top
-
-    front_blur = to_image(front_blur)
-
-    front_blur = (front_blur).filter(ImageFilter.GaussianBlur(radius=blur))
-
-    front_blur = to_array(front_blur)
-
-    front_blur = front_blur[N : 2 * N, N : 2 * N]
-
-    left_blur = np.zeros((N * 3, N * 3, 3))
-
-    left_blur[1 * N : 2 * N, 0 * N : 1 * N] = cubelist[1][0 - 1]  # left
-    left_blur[N : 2 * N, N : 2 * N] = cubelist[1][1 - 1]  # front
-    left_blur[N : 2 * N, 2 * N : 3 * N] = cubelist[1][2 - 1]
-    left_blur[2 * N : 3 * N, 1 * N : 2 * N] = np.rot90(cubelist[2][1], k=-1)  # bottom
-    left_blur[0 : 1 * N, 1 * N : 2 * N] = np.rot90(cubelist[0][1], k=1)  # top
-
-    left_blur = to_image(left_blur).filter(ImageFilter.GaussianBlur(radius=blur))
-
-    left_blur = to_array(left_blur)
-
-    left_blur = left_blur[N : 2 * N, N : 2 * N]
-
-    skybox_blurred = np.zeros((N * 3, N * 4, 3))
-
-    skybox_blurred[1 * N : 2 * N, 0 * N : 1 * N] = left_blur
-    skybox_blurred[N : 2 * N, N : 2 * N] = front_blur
-    skybox_blurred[N : 2 * N, 2 * N : 3 * N] = right_blur
-    skybox_blurred[N : 2 * N, 3 * N : 4 * N] = back_blur
-    skybox_blurred[0 : 1 * N, 1 * N : 2 * N] = top_blur
-    skybox_blurred[2 * N : 3 * N, 1 * N : 2 * N] = bottom_blur
+    N = img_array.shape[0] // 3
+    kernel = gaussian_kernel(blur)
+    border = min(kernel.shape[0] // 2, N)
+
+    faces = {}
+    for name, ((row, column), _) in FACES.items():
+        face = img_array[row * N : (row + 1) * N, column * N : (column + 1) * N]
+        # the mask of the valid texels is blurred along with the channels
+        faces[name] = np.concatenate(
+            [face, np.ones(face.shape[:2] + (1,))], axis=2, dtype=np.float32
+        )
+
+    def blur_face(name):
+        face = padded_face(faces, name, border)
+        face = convolve_axis(convolve_axis(face, kernel, 0), kernel, 1)
+        face = face[border : border + N, border : border + N]
+        return face[:, :, :-1] / np.maximum(face[:, :, -1:], 1e-12)
+
+    if threads is None:
+        threads = min(len(FACES), os.cpu_count() or 1)
+    if threads > 1:
+        with ThreadPool(threads) as pool:
+            blurred = pool.map(blur_face, FACES)
+    else:
+        blurred = [blur_face(name) for name in FACES]
+
+    skybox_blurred = np.zeros(img_array.shape, np.float32)
+    for ((row, column), _), face in zip(FACES.values(), blurred):
+        skybox_blurred[row * N : (row + 1) * N, column * N : (column + 1) * N] = face
 
     return sRGB_to_sRGB_linear(skybox_blurred)
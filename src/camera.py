@@ -1,5 +1,7 @@
 from .utils.vector3 import vec3, rgb
 from .utils.random import random_in_unit_disk
+from .utils.sampler import RandomSampler, PIXEL_DIMENSION, LENS_DIMENSION
+from .utils.buffer_pool import empty_vec3
 import numpy as np
 from .ray import Ray
 
@@ -48,31 +50,65 @@ class Camera:
         self.x = xx.flatten()
         self.y = yy.flatten()
 
-    def get_ray(self, n: vec3) -> Ray:
+    def get_ray(self, n: vec3, pool=None, pixel_index=None, sampler=None, sample_index=0, ray_cones=False) -> Ray:
         """
         Generates rays emitted from the camera position through each pixel on the image plane.
         Each ray casted through each pixel needs to be perturbed slightly to avoid aliasing.
 
         Args:
         - n: Index of refraction of the scene's participating medium (for air n = 1).
+        - pool: An optional BufferPool. The rays are then written in its buffers, which are
+          reused by the next call, instead of being allocated.
+        - pixel_index: The indices (row * screen_width + column) of the pixels to sample.
+          If None, one ray is generated for every pixel of the screen.
+        - sampler: The Sampler object positioning the rays in the pixels and on the lens (random if None).
+        - sample_index: The index of the sample of every pixel (an integer or an array), for the sampler.
+        - ray_cones: Whether the rays carry ray cones (see Ray), starting at the camera with the angle of a pixel.
 
         Returns:
         - A Ray object containing the origin, direction, and other information of the rays.
         """
         # raise NotImplementedError("TODO")
-        rx, ry = random_in_unit_disk(self.x.shape[0])
-        dx = self.cameraRight * rx * self.lens_radius
-        dy = self.cameraUp * ry * self.lens_radius
-        ray_origin = self.look_from + dx + dy
+        x, y = self.x, self.y
+        if pixel_index is not None:
+            x, y = x[pixel_index], y[pixel_index]
+
+        num_rays = x.shape[0]
+        if sampler is None:
+            sampler = RandomSampler()
+        pixel = np.arange(num_rays) if pixel_index is None else pixel_index
+        sample_index = np.broadcast_to(sample_index, (num_rays,))
+
+        rx, ry = random_in_unit_disk(
+            num_rays, sampler.get_pixel_2d(pixel, sample_index, LENS_DIMENSION, self.screen_width)
+        )
+        dx = self.cameraRight.mul(rx, out=empty_vec3(pool, "camera.dx", num_rays))
+        dx *= self.lens_radius
+        dy = self.cameraUp.mul(ry, out=empty_vec3(pool, "camera.dy", num_rays))
+        dy *= self.lens_radius
+        ray_origin = self.look_from.add(dx, out=empty_vec3(pool, "camera.origin", num_rays))
+        ray_origin += dy
         
-        x_perturb = self.x + (np.random.rand(self.x.shape[0]) - 0.5) * self.camera_width / self.screen_width
-        y_perturb = self.y + (np.random.rand(self.y.shape[0]) - 0.5) * self.camera_height / self.screen_height
+        jitter = sampler.get_pixel_2d(pixel, sample_index, PIXEL_DIMENSION, self.screen_width)
+        x_perturb = x + (jitter[0] - 0.5) * self.camera_width / self.screen_width
+        y_perturb = y + (jitter[1] - 0.5) * self.camera_height / self.screen_height
         
-        dx_pixel = self.cameraRight * x_perturb * self.focal_distance
-        dy_pixel = self.cameraUp * y_perturb * self.focal_distance
+        dx_pixel = self.cameraRight.mul(x_perturb, out=dx)
+        dx_pixel *= self.focal_distance
+        dy_pixel = self.cameraUp.mul(y_perturb, out=dy)
+        dy_pixel *= self.focal_distance
         dz_pixel = self.cameraFwd * self.focal_distance
         
-        ray_dir = (self.look_from + dx_pixel + dy_pixel + dz_pixel - ray_origin).normalize()
+        ray_dir = self.look_from.add(dx_pixel, out=empty_vec3(pool, "camera.dir", num_rays))
+        ray_dir += dy_pixel
+        ray_dir += dz_pixel
+        ray_dir -= ray_origin
+        ray_dir.normalize(out=ray_dir)
+
+        cone_width, cone_spread = None, None
+        if ray_cones:
+            cone_width = np.zeros(num_rays)
+            cone_spread = np.full(num_rays, self.camera_height / self.screen_height)
 
         return Ray(
             origin=ray_origin,
@@ -82,4 +118,6 @@ class Camera:
             reflections=0,
             transmissions=0,
             diffuse_reflections=0,
+            cone_width=cone_width,
+            cone_spread=cone_spread,
         )
@@ -0,0 +1,106 @@
+import json
+import os
+import time
+import numpy as np
+from .framebuffer import Framebuffer
+
+
+# A checkpoint of a render is a pair of files sharing the same path prefix:
+# {path}.npz with the linear color sums, square sums, sample counts and AOV sums of the framebuffer
+# and the metadata of the render, and {path}.json with a readable copy of the metadata.
+# Both are written to a temporary file and renamed, so a render killed while saving leaves the previous
+# checkpoint intact. The metadata loaded is the one of the .npz, so it always matches its pixels
+# (a render killed between the two renames leaves a stale .json, which is only informative).
+
+
+def save_checkpoint(path, framebuffer, metadata):
+    """
+    Writes the framebuffer and the metadata of a render to {path}.npz and {path}.json.
+
+    Args:
+    - path: The path of the checkpoint, without extension.
+    - framebuffer: A Framebuffer object.
+    - metadata: A JSON serializable dict describing the render.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    metadata = dict(
+        metadata,
+        width=framebuffer.width,
+        height=framebuffer.height,
+        samples_min=int(framebuffer.samples.min()),
+        samples_max=int(framebuffer.samples.max()),
+        time=time.time(),
+    )
+
+    with open(path + ".npz.tmp", "wb") as f:
+        np.savez(
+            f,
+            color=framebuffer.color,
+            square=framebuffer.square,
+            samples=framebuffer.samples,
+            metadata=np.array(json.dumps(metadata)),
+            **{"aov_" + name: data for name, data in framebuffer.aovs.items()},
+        )
+    os.replace(path + ".npz.tmp", path + ".npz")
+
+    with open(path + ".json.tmp", "w") as f:
+        json.dump(metadata, f, indent=4)
+    os.replace(path + ".json.tmp", path + ".json")
+
+
+def has_checkpoint(path):
+    return os.path.exists(path + ".npz")
+
+
+def load_checkpoint(path):
+    """
+    Reads a checkpoint written by save_checkpoint.
+
+    Returns:
+    - A Framebuffer object and the metadata dict of the render.
+    """
+    with np.load(path + ".npz") as data:
+        if "metadata" in data.files:
+            metadata = json.loads(str(data["metadata"]))
+        else:
+            # checkpoints written before the metadata was in the .npz
+            with open(path + ".json", "r") as f:
+                metadata = json.load(f)
+        aovs = [key[4:] for key in data.files if key.startswith("aov_")]
+        framebuffer = Framebuffer(metadata["width"], metadata["height"], aovs=aovs)
+        framebuffer.color[:] = data["color"]
+        framebuffer.square[:] = data["square"]
+        framebuffer.samples[:] = data["samples"]
+        for name in aovs:
+            framebuffer.aovs[name][:] = data["aov_" + name]
+    return framebuffer, metadata
+
+
+class Checkpointer:
+    """Saves the framebuffer of a progressive render at most once every interval seconds."""
+
+    def __init__(self, path, interval, metadata):
+        self.path = path
+        self.interval = interval
+        self.metadata = metadata
+        self.last_save = time.time()
+
+    def update(self, framebuffer, lock=None, force=False):
+        """
+        Saves a checkpoint if the interval has elapsed (or force is True).
+        lock, if given, is held while the framebuffer is copied, so tiles being rendered
+        by other threads or processes aren't saved half accumulated.
+        """
+        if self.path is None:
+            return
+        if not force and time.time() - self.last_save < self.interval:
+            return
+
+        if lock is not None:
+            with lock:
+                framebuffer = framebuffer.copy()
+        save_checkpoint(self.path, framebuffer, self.metadata)
+        self.last_save = time.time()
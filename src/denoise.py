@@ -0,0 +1,134 @@
+import numpy as np
+from .utils.vector3 import rgb
+
+
+# Denoising of a rendered framebuffer: an edge-avoiding a-trous wavelet filter (Dammertz et al. 2010)
+# guided by the feature buffers (AOVs, see aov.py) of the first hits: albedo, normal and depth.
+# The color is demodulated by the albedo first, so the filter only blurs the lighting and textures stay sharp.
+# Like SVGF (Schied et al. 2017), the luminance edge-stopping function is scaled by the standard deviation
+# of the estimate of each pixel, which is filtered along with the color: noisy pixels are smoothed more,
+# and the filter gets more selective as the noise goes down.
+
+FEATURES = ("albedo", "normal", "depth")
+
+# B3 spline, the 1D kernel of the a-trous filter
+KERNEL = (1.0 / 16.0, 1.0 / 4.0, 3.0 / 8.0, 1.0 / 4.0, 1.0 / 16.0)
+
+# Rec. 709 luminance of linear RGB
+LUMINANCE = np.array([0.2126, 0.7152, 0.0722])
+
+
+def shift(x, dy, dx, pad):
+    # x[..., y + dy, x + dx] for every pixel of x, padded with the edge pixels
+    # (pad is the padded copy of x with a border of pad pixels)
+    H, W = x.shape[-2:]
+    border = (pad.shape[-1] - W) // 2
+    return pad[..., border + dy : border + dy + H, border + dx : border + dx + W]
+
+
+def padded(x, border):
+    return np.pad(x, [(0, 0)] * (x.ndim - 2) + [(border, border)] * 2, mode="edge")
+
+
+def box_filter(x, radius):
+    """Mean of x over the (2 * radius + 1)^2 window of every pixel (edge pixels are repeated)."""
+    p = padded(x, radius)
+    out = np.zeros_like(x)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            out += shift(x, dy, dx, p)
+    return out / (2 * radius + 1) ** 2
+
+
+def denoise_framebuffer(
+    framebuffer, iterations=3, sigma_color=4.0, sigma_normal=128.0, sigma_depth=1.0
+):
+    """
+    Denoises the average color of a framebuffer rendered with the albedo, normal and depth AOVs.
+
+    Args:
+    - framebuffer: A Framebuffer object with the AOVs of FEATURES.
+    - iterations: The number of a-trous passes. Pass i filters with holes of 2^i pixels,
+      so the filter covers (4 * 2^iterations - 3)^2 pixels.
+    - sigma_color: The luminance difference, in standard deviations of the pixel estimate, that stops the filter.
+    - sigma_normal: The exponent of the cosine between the normals of two pixels.
+    - sigma_depth: The depth difference, relative to the depth gradient of the pixel, that stops the filter.
+
+    Returns:
+    - A vec3 object containing the denoised linear RGB color of every pixel.
+    """
+    missing = [name for name in FEATURES if name not in framebuffer.aovs]
+    if missing:
+        raise ValueError("denoising needs the AOVs " + ", ".join(missing))
+
+    H, W = framebuffer.height, framebuffer.width
+    n = np.maximum(framebuffer.samples, 1).reshape(H, W)
+    mean = framebuffer.color.reshape(3, H, W) / n
+
+    # demodulated color: the lighting reaching the surface
+    albedo = framebuffer.get_aov("albedo").reshape(3, H, W)
+    albedo = np.where(albedo > 0.01, albedo, 1.0)
+    color = mean / albedo
+
+    # variance of the estimate of the luminance of every pixel
+    variance = np.maximum(framebuffer.square.reshape(3, H, W) / n - mean**2, 0.0)
+    variance = variance * (n / np.maximum(n - 1, 1)) / n / albedo**2
+    # averaged over a 7x7 window: the variance of a few samples is as noisy as their mean
+    variance = box_filter(np.tensordot(LUMINANCE**2, variance, axes=1), 3)
+    # with fewer samples it isn't known at all: the spatial variance of the neighborhood is used instead
+    luminance = np.tensordot(LUMINANCE, color, axes=1)
+    spatial = np.maximum(
+        box_filter(luminance**2, 3) - box_filter(luminance, 3) ** 2, 0.0
+    )
+    variance = np.where(n < 4, spatial, variance)
+
+    normal = framebuffer.get_aov("normal").reshape(3, H, W)
+    length = np.sqrt(np.sum(normal**2, axis=0))
+    hit = length > 1e-6  # pixels whose rays hit nothing have no features
+    normal = normal / np.maximum(length, 1e-6)
+    depth = framebuffer.get_aov("depth")[0].reshape(H, W)
+    gradient_y, gradient_x = np.gradient(depth)
+    gradient = np.maximum(np.abs(gradient_x), np.abs(gradient_y))
+
+    for i in range(iterations):
+        step = 2**i
+        border = 2 * step
+        color_pad, variance_pad = padded(color, border), padded(variance, border)
+        normal_pad, depth_pad = padded(normal, border), padded(depth, border)
+        hit_pad = padded(hit, border)
+        luminance = np.tensordot(LUMINANCE, color, axes=1)
+        luminance_pad = padded(luminance, border)
+        sigma_luminance = sigma_color * np.sqrt(box_filter(variance, 1)) + 1e-10
+
+        weight_sum = np.zeros((H, W))
+        color_sum = np.zeros_like(color)
+        variance_sum = np.zeros((H, W))
+        for j, ky in enumerate(KERNEL):
+            for k, kx in enumerate(KERNEL):
+                dy, dx = (j - 2) * step, (k - 2) * step
+                q_hit = shift(hit, dy, dx, hit_pad)
+                cosine = np.maximum(
+                    np.sum(normal * shift(normal, dy, dx, normal_pad), axis=0), 0.0
+                )
+                w_normal = np.where(
+                    hit & q_hit, cosine**sigma_normal, (hit == q_hit).astype(float)
+                )
+                w_depth = np.exp(
+                    -np.abs(depth - shift(depth, dy, dx, depth_pad))
+                    / (sigma_depth * gradient * np.hypot(dx, dy) + 1e-10)
+                )
+                w_luminance = np.exp(
+                    -np.abs(luminance - shift(luminance, dy, dx, luminance_pad))
+                    / sigma_luminance
+                )
+                w = ky * kx * w_normal * w_depth * w_luminance
+
+                weight_sum += w
+                color_sum += w * shift(color, dy, dx, color_pad)
+                variance_sum += w**2 * shift(variance, dy, dx, variance_pad)
+
+        # the center pixel always has a positive weight
+        color = color_sum / weight_sum
+        variance = variance_sum / weight_sum**2
+
+    return rgb.from_array((color * albedo).reshape(3, H * W))
@@ -0,0 +1,346 @@
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import tempfile
+import threading
+import time
+import numpy as np
+from .framebuffer import Framebuffer
+from .utils.buffer_pool import BufferPool
+from .scene import engines
+from .utils.sampler import samplers
+
+
+# Render farm: a coordinator shards the frames of a render in jobs (a tile and a range of samples,
+# with a seed derived from both) and hands them out to workers connected over TCP or Unix sockets.
+# Workers build the scene from a JSON scene spec with their own build_scene function (once per frame),
+# render the job with Scene.render_tile and send back the linear partial accumulator of the tile.
+# The coordinator merges the partials in job order, so the result doesn't depend on the number
+# of workers or on the order they finish. A job of a worker that disconnects is handed out again.
+#
+# Messages are a JSON header followed by raw arrays (no pickle), so workers and coordinator
+# don't have to trust each other with code execution.
+
+
+ARRAY_DTYPES = ("<f8", "<i8")
+
+
+def parse_address(address):
+    """'host:port' is a TCP address, anything else the path of a Unix socket."""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def send_message(sock, header, arrays=()):
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays=[[a.dtype.str, list(a.shape)] for a in arrays])
+    data = json.dumps(header).encode()
+    sock.sendall(struct.pack("!Q", len(data)) + data)
+    for a in arrays:
+        sock.sendall(memoryview(a).cast("B"))
+
+
+def recv_exactly(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    while size:
+        n = sock.recv_into(view, size)
+        if n == 0:
+            raise ConnectionError("connection closed")
+        view = view[n:]
+        size -= n
+    return data
+
+
+def recv_message(sock):
+    """Returns the header and the arrays of a message sent by send_message."""
+    (size,) = struct.unpack("!Q", recv_exactly(sock, 8))
+    header = json.loads(recv_exactly(sock, size))
+    arrays = []
+    for dtype, shape in header.pop("arrays"):
+        if dtype not in ARRAY_DTYPES:
+            raise ValueError("unexpected array type " + dtype)
+        dtype = np.dtype(dtype)
+        data = recv_exactly(sock, dtype.itemsize * int(np.prod(shape)))
+        arrays.append(np.frombuffer(data, dtype=dtype).reshape(shape))
+    return header, arrays
+
+
+def tile_pixels(tile, width):
+    row0, row1, column0, column1 = tile
+    rows = np.arange(row0, row1)
+    return (rows[:, None] * width + np.arange(column0, column1)).ravel()
+
+
+def run_worker(address, build_scene, retry_time=10.0):
+    """
+    Connects to a coordinator and renders its jobs until it says stop.
+
+    Args:
+    - address: The address of the coordinator ('host:port' or the path of a Unix socket).
+    - build_scene: A function returning the Scene object described by a scene spec (a JSON dict).
+    - retry_time: How long to retry connecting while the coordinator isn't listening yet.
+    """
+    family, addr = parse_address(address)
+    deadline = time.time() + retry_time
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(addr)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            sock.close()
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+    scenes = {}  # frame: (scene, framebuffer), each frame is built once
+    with sock:
+        while True:
+            header, _ = recv_message(sock)
+            if header["type"] == "stop":
+                return
+
+            frame = header["frame"]
+            if frame not in scenes:
+                scenes.clear()
+                scene = build_scene(header["scene"])
+                scene.finalize()
+                scene.pool = BufferPool()
+                W, H = scene.camera.screen_width, scene.camera.screen_height
+                scenes[frame] = (scene, Framebuffer(W, H))
+            scene, framebuffer = scenes[frame]
+
+            get_color = engines[header["engine"]]
+            scene.sampler = samplers[header["sampler"]](
+                header["samples_per_pixel"], header["sampler_seed"]
+            )
+            pixel_index = tile_pixels(header["tile"], framebuffer.width)
+            framebuffer.color[:, pixel_index] = 0.0
+            framebuffer.square[:, pixel_index] = 0.0
+            # the first sample of the job, so the sampler continues the sequence of the pixels
+            framebuffer.samples[pixel_index] = header["start"]
+            scene.render_tile(
+                framebuffer,
+                pixel_index,
+                header["samples"],
+                get_color,
+                np.array(header["seed"], dtype=np.uint32),
+            )
+            send_message(
+                sock,
+                {"type": "result", "job": header["job"]},
+                [
+                    framebuffer.color[:, pixel_index],
+                    framebuffer.square[:, pixel_index],
+                    framebuffer.samples[pixel_index] - header["start"],
+                ],
+            )
+
+
+class Coordinator:
+    """
+    Shards the frames of a render in jobs and merges the partial accumulators sent by the workers.
+
+    Args:
+    - address: The address to listen on ('host:port' or the path of a Unix socket).
+    - scene_specs: One JSON scene spec per frame, passed to the build_scene function of the workers.
+    - width, height: The resolution of the frames.
+    - samples_per_pixel: The number of samples of every pixel.
+    - tile_size: The width and height of the tiles of a job, in pixels.
+    - samples_per_job: The number of samples of a job. By default a job has all the samples of its tile.
+    - seed: The seed of the render. Each job is seeded by (frame, tile, first sample).
+    - engine: "recursive" or "wavefront".
+    - sampler: The name of the sampler (see sampler.py).
+    """
+
+    def __init__(
+        self,
+        address,
+        scene_specs,
+        width,
+        height,
+        samples_per_pixel,
+        tile_size=64,
+        samples_per_job=None,
+        seed=None,
+        engine="recursive",
+        sampler="random",
+    ):
+        self.address = address
+        self.scene_specs = scene_specs
+        self.width, self.height = width, height
+        self.engine = engine
+        self.sampler = sampler
+        self.samples_per_pixel = samples_per_pixel
+        # the samplers are seeded like the ones of Scene.render
+        self.sampler_seed = seed if seed is not None else 0
+        self.entropy = np.random.SeedSequence(seed).entropy
+        samples_per_job = samples_per_job or samples_per_pixel
+
+        self.jobs = []
+        for frame in range(len(scene_specs)):
+            for row in range(0, height, tile_size):
+                for column in range(0, width, tile_size):
+                    tile = (
+                        row,
+                        min(row + tile_size, height),
+                        column,
+                        min(column + tile_size, width),
+                    )
+                    tile_id = row * width + column
+                    for start in range(0, samples_per_pixel, samples_per_job):
+                        samples = min(samples_per_job, samples_per_pixel - start)
+                        self.jobs.append((frame, tile, start, samples, tile_id))
+
+        self.pending = queue.Queue()
+        self.results = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(addr)
+        self.server.listen()
+
+    def job_message(self, job_id):
+        frame, tile, start, samples, tile_id = self.jobs[job_id]
+        seed = np.random.SeedSequence(self.entropy, spawn_key=(frame, tile_id, start))
+        return {
+            "type": "job",
+            "job": job_id,
+            "frame": frame,
+            "scene": self.scene_specs[frame],
+            "engine": self.engine,
+            "sampler": self.sampler,
+            "samples_per_pixel": self.samples_per_pixel,
+            "sampler_seed": self.sampler_seed,
+            "tile": tile,
+            "start": start,
+            "samples": samples,
+            "seed": seed.generate_state(4).tolist(),
+        }
+
+    def serve(self, sock):
+        # hands out jobs to one worker until there are none left
+        job_id = None
+        try:
+            with sock:
+                while not self.done.is_set():
+                    try:
+                        job_id = self.pending.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    send_message(sock, self.job_message(job_id))
+                    header, arrays = recv_message(sock)
+                    if header.get("type") != "result" or header.get("job") != job_id:
+                        raise ValueError("unexpected message from a worker")
+                    with self.lock:
+                        self.results[job_id] = arrays
+                        if len(self.results) == len(self.jobs):
+                            self.done.set()
+                    job_id = None
+                send_message(sock, {"type": "stop"})
+        except (ConnectionError, OSError, ValueError):
+            if job_id is not None:
+                self.pending.put(job_id)  # another worker renders it
+
+    def run(self, workers_alive=None):
+        """
+        Serves the jobs to the workers until they are all done.
+
+        Args:
+        - workers_alive: An optional function returning False when no worker is left to render the jobs.
+
+        Returns:
+        - A list with the merged Framebuffer object of each frame.
+        """
+        for job_id in range(len(self.jobs)):
+            self.pending.put(job_id)
+
+        threads = []
+        self.server.settimeout(0.1)
+        with self.server:
+            while not self.done.is_set():
+                try:
+                    sock, _ = self.server.accept()
+                except socket.timeout:
+                    # workers exit once they are told to stop: only an error while results are missing
+                    if self.done.is_set():
+                        break
+                    if workers_alive is not None and not workers_alive():
+                        raise RuntimeError(
+                            "the render farm workers exited before the render was done"
+                        )
+                    continue
+                sock.settimeout(None)
+                thread = threading.Thread(target=self.serve, args=(sock,), daemon=True)
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        framebuffers = [Framebuffer(self.width, self.height) for _ in self.scene_specs]
+        for job_id, (frame, tile, start, job_samples, tile_id) in enumerate(self.jobs):
+            color, square, samples = self.results[job_id]
+            framebuffer = framebuffers[frame]
+            pixel_index = tile_pixels(tile, self.width)
+            framebuffer.color[:, pixel_index] += color
+            framebuffer.square[:, pixel_index] += square
+            framebuffer.samples[pixel_index] += samples
+        return framebuffers
+
+
+def render_farm(
+    build_scene, scene_specs, samples_per_pixel, workers=2, address=None, **kwargs
+):
+    """
+    Renders frames with a coordinator in this process and local worker processes.
+
+    Args:
+    - build_scene: A function returning the Scene object described by a scene spec.
+      It must be picklable (a module level function), it's run by the workers.
+    - scene_specs: One JSON scene spec per frame.
+    - samples_per_pixel: The number of samples of every pixel.
+    - workers: The number of local worker processes. With 0, workers started
+      elsewhere (see run_worker) must connect to address.
+    - address: The address to listen on. By default, a Unix socket in a temporary directory.
+    - kwargs: Coordinator options (tile_size, samples_per_job, seed, engine, sampler).
+
+    Returns:
+    - A list with the Framebuffer object of each frame.
+    """
+    scene = build_scene(scene_specs[0])
+    W, H = scene.camera.screen_width, scene.camera.screen_height
+    del scene
+
+    with tempfile.TemporaryDirectory() as directory:
+        if address is None:
+            address = os.path.join(directory, "farm.sock")
+        coordinator = Coordinator(
+            address, scene_specs, W, H, samples_per_pixel, **kwargs
+        )
+
+        processes = [
+            multiprocessing.Process(target=run_worker, args=(address, build_scene))
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            framebuffers = coordinator.run(
+                (lambda: any(p.is_alive() for p in processes)) if workers else None
+            )
+        finally:
+            for process in processes:
+                process.join()
+    return framebuffers
@@ -0,0 +1,168 @@
+import numpy as np
+from .utils import colour_functions as cf
+from .utils.vector3 import vec3, rgb
+from .utils.image_functions import to_8bit_image
+from .aov import AOVS, aov_channels, resolve_aov
+
+
+class Framebuffer:
+    """
+    Float accumulation buffer of a render.
+
+    It keeps the sum of the linear RGB samples of every pixel, the sum of their squares
+    (for the variance of the estimate) and their number, so pixels (or tiles of pixels)
+    can be sampled independently and in any order.
+    Pixels are indexed in row-major order: index = row * width + column.
+
+    The arrays can be placed in an existing buffer (e.g. shared memory) of nbytes(width, height, aovs) bytes.
+
+    aovs: The names of the AOVs (see aov.py) summed with the color, in the dict self.aovs
+    of (channels, num_pixel) arrays. get_aov resolves them.
+    """
+
+    def __init__(self, width, height, buffer=None, aovs=()):
+        self.width = width
+        self.height = height
+        P = width * height
+        if buffer is None:
+            self.color = np.zeros((3, P))
+            self.square = np.zeros((3, P))
+            self.samples = np.zeros(P, dtype=np.int64)
+            self.aovs = {name: np.zeros((AOVS[name][0], P)) for name in aovs}
+        else:
+            self.color = np.ndarray((3, P), dtype=np.float64, buffer=buffer)
+            self.square = np.ndarray(
+                (3, P), dtype=np.float64, buffer=buffer, offset=self.color.nbytes
+            )
+            self.samples = np.ndarray(
+                P, dtype=np.int64, buffer=buffer, offset=2 * self.color.nbytes
+            )
+            self.aovs = {}
+            offset = 7 * 8 * P
+            for name in aovs:
+                self.aovs[name] = np.ndarray(
+                    (AOVS[name][0], P), dtype=np.float64, buffer=buffer, offset=offset
+                )
+                offset += self.aovs[name].nbytes
+
+    def nbytes(width, height, aovs=()):
+        # size of the buffer holding the color and square sums (2 * 3 float64), the sample counts (int64)
+        # and the AOV sums (float64)
+        return (7 + aov_channels(aovs)) * 8 * width * height
+
+    def copy(self):
+        framebuffer = Framebuffer(self.width, self.height, aovs=self.aovs)
+        framebuffer.color[:] = self.color
+        framebuffer.square[:] = self.square
+        framebuffer.samples[:] = self.samples
+        for name, data in self.aovs.items():
+            framebuffer.aovs[name][:] = data
+        return framebuffer
+
+    def merge(self, other):
+        """
+        Adds the samples of another framebuffer of the same size (e.g. a partial render of the same image
+        made by another run with another seed), so the result is the render with the samples of both.
+        Returns self.
+        """
+        if (other.width, other.height) != (self.width, self.height):
+            raise ValueError(
+                "can't merge a %dx%d render into a %dx%d render"
+                % (other.width, other.height, self.width, self.height)
+            )
+        for name in list(self.aovs):
+            if name not in other.aovs:
+                # the samples of other don't have it
+                del self.aovs[name]
+        for name, data in self.aovs.items():
+            if AOVS[name][2] == "first":
+                # the first sample of a pixel is the one of the framebuffer that has samples first
+                data[:] = np.where(self.samples > 0, data, other.aovs[name])
+            else:
+                data += other.aovs[name]
+        self.color += other.color
+        self.square += other.square
+        self.samples += other.samples
+        return self
+
+    def add(self, color, pixel_index=None, samples=1, square=None, aovs=None):
+        """
+        Accumulates samples for each of the given pixels.
+
+        Args:
+        - color: A vec3 object with one linear RGB color per pixel, the sum of its samples.
+        - pixel_index: The indices of the sampled pixels (each pixel at most once),
+          or None if the colors cover the whole image.
+        - samples: The number of samples summed in color.
+        - square: A NumPy array of shape (3, num_pixel) with the sum of the squared samples.
+          It can be omitted for a single sample.
+        - aovs: A dict with the sums of the samples of the AOVs of the framebuffer (arrays of shape (channels, num_pixel)).
+        """
+        if square is None:
+            square = color.to_array() ** 2
+
+        if pixel_index is None:
+            self.color += color.to_array()
+            self.square += square
+            self.samples += samples
+        else:
+            self.color[:, pixel_index] += color.to_array()
+            self.square[:, pixel_index] += square
+            self.samples[pixel_index] += samples
+
+        if aovs is not None:
+            for name, data in self.aovs.items():
+                if pixel_index is None:
+                    data += aovs[name]
+                else:
+                    data[:, pixel_index] += aovs[name]
+
+    def get_samples(self, pixel_index=None):
+        """Returns the number of samples that all the given pixels (or the whole image) have."""
+        if pixel_index is None:
+            return int(self.samples.min())
+        return int(self.samples[pixel_index].min())
+
+    def get_error(self, floor=0.01):
+        """
+        Returns the relative standard error of the color of every pixel:
+        the standard deviation of the mean over the mean (plus floor, so dark pixels
+        aren't held to a relative precision that can't be seen). It's inf for pixels with less than 2 samples.
+        The error of a pixel is the largest of its 3x3 neighborhood, because the variance estimated
+        from a few samples is often 0 where light is rarely found (e.g. all the samples missed it).
+        """
+        n = np.maximum(self.samples, 1)
+        mean = self.color / n
+        variance = np.maximum(self.square / n - mean**2, 0) * (n / np.maximum(n - 1, 1))
+        error = np.sqrt(variance.mean(axis=0) / n) / (mean.mean(axis=0) + floor)
+        error = np.where(self.samples < 2, np.inf, error)
+
+        padded = np.pad(error.reshape(self.height, self.width), 1, mode="edge")
+        neighborhood = error.reshape(self.height, self.width).copy()
+        for dy in range(3):
+            for dx in range(3):
+                np.maximum(
+                    neighborhood,
+                    padded[dy : dy + self.height, dx : dx + self.width],
+                    out=neighborhood,
+                )
+        return neighborhood.ravel()
+
+    def get_linear(self) -> vec3:
+        """Returns the average linear RGB color of every pixel (black for pixels without samples)."""
+        return rgb.from_array(self.color / np.maximum(self.samples, 1))
+
+    def get_aov(self, name):
+        """Returns the value of an AOV for every pixel (see the kinds of aov.AOVS), an array of shape (channels, num_pixel)."""
+        return resolve_aov(name, self.aovs[name], self.samples)
+
+    def to_image(self, linear=None, tonemap="clip", exposure=0.0):
+        """
+        Returns the tone mapped, gamma corrected image as a PIL RGB image.
+        linear: An optional vec3 object replacing the average linear color (e.g. the denoised color).
+        tonemap, exposure: The tone mapping of the linear color (see colour_functions.tonemap).
+        """
+        if linear is None:
+            linear = self.get_linear()
+        color = cf.tonemap(linear.to_array(), tonemap, exposure)
+        return to_8bit_image(color, self.width, self.height)
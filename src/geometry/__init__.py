@@ -5,3 +5,4 @@ from .plane import *
 from .triangle import *
 from .triangle_mesh import *
 from .cuboid import *
+from .bvh import *
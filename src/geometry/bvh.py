@@ -0,0 +1,219 @@
+import numpy as np
+from functools import partial
+from ..utils.constants import *
+from ..utils.vector3 import vec3
+from ..utils.buffer_pool import empty
+from .collider_group import pack_colliders, intersect_groups
+
+
+def to_columns(v, n):
+    """Broadcasts the data of a vec3 to a (3, n) float array (without copying it if possible)."""
+    return np.broadcast_to(np.real(v.data).reshape(3, -1), (3, n))
+
+
+def batch_size(*vs):
+    """Returns the number of rays described by a group of (possibly scalar) vec3."""
+    return max(v.data.size // 3 for v in vs)
+
+
+class BVH:
+    """
+    Bounding volume hierarchy over a set of axis aligned bounding boxes.
+
+    The tree is stored as flat arrays (one entry per node) and is traversed with
+    packets of rays: every node is tested against all the rays that reached it
+    with a single vectorized slab test, and only the rays that hit the node's box
+    are passed down to its children.
+    """
+
+    def __init__(self, lo, hi, leaf_size=4):
+        """
+        Args:
+        - lo: A NumPy array of shape (num_prim, 3) with the lower corners of the boxes.
+        - hi: A NumPy array of shape (num_prim, 3) with the upper corners of the boxes.
+        - leaf_size: The maximum number of primitives stored in a leaf.
+        """
+        lo = np.asarray(lo, dtype=np.float64).reshape(-1, 3)
+        hi = np.asarray(hi, dtype=np.float64).reshape(-1, 3)
+
+        # pad the boxes a bit, so flat primitives (planes, triangles) get a volume
+        pad = 1e-6 * (hi - lo).max(axis=1, keepdims=True) + 1e-9
+        lo = lo - pad
+        hi = hi + pad
+
+        self.leaf_size = leaf_size
+        self.size = lo.shape[0]
+        self.order = np.arange(self.size)
+
+        node_lo, node_hi, left, right, start, count = [], [], [], [], [], []
+        centroids = (lo + hi) / 2
+
+        # each entry: (node index, first primitive, number of primitives)
+        stack = []
+        if self.size > 0:
+            stack.append((0, 0, self.size))
+            node_lo.append(None), node_hi.append(None)
+            left.append(-1), right.append(-1), start.append(0), count.append(0)
+
+        while stack:
+            node, first, n = stack.pop()
+            prims = self.order[first : first + n]
+            node_lo[node] = lo[prims].min(axis=0)
+            node_hi[node] = hi[prims].max(axis=0)
+
+            if n <= leaf_size:
+                start[node], count[node] = first, n
+                continue
+
+            # split at the median centroid along the axis of largest centroid spread
+            c = centroids[prims]
+            axis = np.argmax(c.max(axis=0) - c.min(axis=0))
+            half = n // 2
+            part = np.argpartition(c[:, axis], half)
+            self.order[first : first + n] = prims[part]
+
+            for child_first, child_n in ((first, half), (first + half, n - half)):
+                child = len(node_lo)
+                node_lo.append(None), node_hi.append(None)
+                left.append(-1), right.append(-1), start.append(0), count.append(0)
+                stack.append((child, child_first, child_n))
+                if child_first == first:
+                    left[node] = child
+                else:
+                    right[node] = child
+
+        self.node_lo = np.array(node_lo).reshape(-1, 3)
+        self.node_hi = np.array(node_hi).reshape(-1, 3)
+        self.node_center = (self.node_lo + self.node_hi) / 2
+        self.left = np.array(left, dtype=np.int64)
+        self.right = np.array(right, dtype=np.int64)
+        self.start = np.array(start, dtype=np.int64)
+        self.count = np.array(count, dtype=np.int64)
+
+    def traverse(self, O, D, intersect_leaf, pool=None):
+        """
+        Finds the nearest intersection of every ray with the primitives of the tree.
+
+        Args:
+        - O: A NumPy array of shape (3, num_ray) with the ray origins.
+        - D: A NumPy array of shape (3, num_ray) with the ray directions.
+        - intersect_leaf: A function (node, prims, O, D) -> (distance, orientation, index, primitive_id)
+          returning the nearest intersection of the given rays with the primitives `prims`
+          of the leaf `node`, where `index` is the position of the nearest primitive in `prims`.
+        - pool: An optional BufferPool for the temporary arrays of the slab tests.
+
+        Returns:
+        - The distance, orientation, primitive index and sub-primitive id of the
+          nearest hit of each ray. Rays that hit nothing have distance FARAWAY and index -1.
+        """
+        n = O.shape[1]
+        distance = np.full(n, FARAWAY)
+        orientation = np.full(n, FARAWAY)
+        index = np.full(n, -1, dtype=np.int64)
+        primitive_id = np.zeros(n, dtype=np.int64)
+
+        if self.size == 0 or n == 0:
+            return distance, orientation, index, primitive_id
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inv_D = np.divide(1.0, D, out=empty(pool, "bvh.inv_D", (3, n)))
+
+        stack = [(0, np.arange(n))]
+        while stack:
+            node, rays = stack.pop()
+
+            # slab test against the node box
+            shape = (3, rays.size)
+            O_r = np.take(O, rays, axis=1, out=empty(pool, "bvh.O", shape))
+            inv_D_r = np.take(
+                inv_D, rays, axis=1, out=empty(pool, "bvh.inv_D_r", shape)
+            )
+            t0 = np.subtract(
+                self.node_lo[node][:, None], O_r, out=empty(pool, "bvh.t0", shape)
+            )
+            t1 = np.subtract(
+                self.node_hi[node][:, None], O_r, out=empty(pool, "bvh.t1", shape)
+            )
+            with np.errstate(invalid="ignore"):
+                t0 *= inv_D_r
+                t1 *= inv_D_r
+            t_near = np.fmin(t0, t1, out=O_r)
+            t_far = np.fmax(t0, t1, out=inv_D_r)
+            t_enter = np.fmax.reduce(t_near, axis=0)
+            t_exit = np.fmin.reduce(t_far, axis=0)
+
+            rays = rays[
+                (t_exit >= np.maximum(t_enter, 0.0)) & (t_enter < distance[rays])
+            ]
+            if rays.size == 0:
+                continue
+
+            if self.left[node] == -1:
+                prims = self.order[
+                    self.start[node] : self.start[node] + self.count[node]
+                ]
+                d, o, i, p = intersect_leaf(node, prims, O[:, rays], D[:, rays])
+                closer = d < distance[rays]
+                r = rays[closer]
+                distance[r] = d[closer]
+                orientation[r] = o[closer]
+                index[r] = prims[i[closer]]
+                primitive_id[r] = p[closer]
+            else:
+                # visit first the child that is closer along the mean ray direction,
+                # so the farther one can be culled with the updated distances.
+                l, r = self.left[node], self.right[node]
+                mean_D = D[:, rays].mean(axis=1)
+                if self.node_center[l].dot(mean_D) <= self.node_center[r].dot(mean_D):
+                    stack += [(r, rays), (l, rays)]
+                else:
+                    stack += [(l, rays), (r, rays)]
+
+        return distance, orientation, index, primitive_id
+
+
+class ColliderBVH(BVH):
+    """
+    Bounding volume hierarchy over a list of colliders.
+    The colliders of each leaf are packed by type (see collider_group.py),
+    so a leaf costs one broadcasted kernel per collider type.
+    """
+
+    def __init__(self, collider_list, leaf_size=8):
+        self.collider_list = list(collider_list)
+        bounds = [c.get_bounds() for c in self.collider_list]
+        lo = np.array([b[0] for b in bounds]).reshape(-1, 3)
+        hi = np.array([b[1] for b in bounds]).reshape(-1, 3)
+        super().__init__(lo, hi, leaf_size=leaf_size)
+
+        self.leaf_groups = {}
+        for node in np.nonzero(self.left == -1)[0]:
+            prims = self.order[self.start[node] : self.start[node] + self.count[node]]
+            self.leaf_groups[node] = pack_colliders(
+                [self.collider_list[c] for c in prims]
+            )
+
+    def intersect_leaf(self, node, prims, O, D, pool=None):
+        return intersect_groups(self.leaf_groups[node], O, D, pool)
+
+    def intersect(self, O, D, pool=None):
+        """
+        Computes the nearest intersection of the rays with the colliders.
+
+        Args:
+        - O: A vec3 object representing the origins of the rays.
+        - D: A vec3 object representing the directions of the rays.
+        - pool: An optional BufferPool for the temporary arrays of the intersection kernels.
+
+        Returns:
+        - The distance and orientation of the nearest hit, the index of the hit
+          collider in `collider_list` (-1 if nothing is hit) and the id of the hit
+          sub-primitive inside that collider (e.g. the triangle of a mesh).
+        """
+        n = batch_size(O, D)
+        return self.traverse(
+            to_columns(O, n),
+            to_columns(D, n),
+            partial(self.intersect_leaf, pool=pool),
+            pool,
+        )
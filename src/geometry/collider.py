@@ -16,3 +16,8 @@ class Collider:
     @abstractmethod
     def get_Normal(self, hit):
         pass
+
+    @abstractmethod
+    def get_bounds(self):
+        """Returns the lower and upper corners of the axis aligned bounding box."""
+        pass
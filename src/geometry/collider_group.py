@@ -0,0 +1,254 @@
+import numpy as np
+from ..utils.constants import *
+from ..utils.vector3 import vec3
+from ..utils.buffer_pool import empty
+from .sphere import Sphere_Collider
+from .plane import Plane_Collider
+from .cuboid import Cuboid_Collider
+
+
+# Colliders of the same type are packed in structure-of-arrays groups, so a ray batch
+# is intersected with all of them in one broadcasted kernel of shape (num_collider, num_ray).
+
+
+# The kernels share the names of their pooled temporaries ("collider.*"),
+# because they never run at the same time.
+
+
+def dot(a, b, out=None):
+    return np.einsum("i...,i...->...", a, b, out=out)
+
+
+def nearest(distance, orientation):
+    """Reduces (num_collider, num_ray) intersections to the nearest one of each ray."""
+    index = np.argmin(distance, axis=0)
+    rays = np.arange(distance.shape[1])
+    return distance[index, rays], orientation[index, rays], index
+
+
+class ColliderGroup:
+    """Fallback group that intersects its colliders one by one."""
+
+    def __init__(self, colliders, indices):
+        self.colliders = colliders
+        # positions of the colliders in the packed list
+        self.indices = np.asarray(indices)
+
+    def intersect(self, O, D, pool=None):
+        """
+        Computes the nearest intersection of the rays with the colliders of the group.
+
+        Args:
+        - O: A NumPy array of shape (3, num_ray) with the ray origins.
+        - D: A NumPy array of shape (3, num_ray) with the ray directions.
+        - pool: An optional BufferPool for the temporary arrays.
+
+        Returns:
+        - The distance and orientation of the nearest hit, the index of the hit
+          collider in the group and the id of the hit sub-primitive.
+        """
+        n = O.shape[1]
+        O, D = vec3.from_array(O), vec3.from_array(D)
+
+        distance = np.full(n, FARAWAY)
+        orientation = np.full(n, FARAWAY)
+        index = np.zeros(n, dtype=np.int64)
+        primitive_id = np.zeros(n, dtype=np.int64)
+        for i, c in enumerate(self.colliders):
+            inters = c.intersect(O, D)
+            closer = inters[0] < distance
+            distance = np.where(closer, inters[0], distance)
+            orientation = np.where(closer, inters[1], orientation)
+            index = np.where(closer, i, index)
+            if len(inters) > 2:
+                primitive_id = np.where(
+                    closer, inters[2].astype(np.int64), primitive_id
+                )
+        return distance, orientation, index, primitive_id
+
+
+class SphereGroup(ColliderGroup):
+    def __init__(self, colliders, indices):
+        super().__init__(colliders, indices)
+        self.centers = np.array([c.center.to_array() for c in colliders]).T[:, :, None]
+        self.radii = np.array([c.radius for c in colliders], dtype=np.float64)[:, None]
+
+    def intersect(self, O, D, pool=None):
+        # same formulation as Sphere_Collider.intersect
+        K, R = self.radii.shape[0], O.shape[1]
+        O = O[:, None, :]
+        D = D[:, None, :]
+        a = dot(D, D)
+        O_C = np.subtract(O, self.centers, out=empty(pool, "collider.vec0", (3, K, R)))
+        b = dot(D, O_C, out=empty(pool, "collider.0", (K, R)))
+        b *= 2
+        c = dot(O_C, O_C, out=empty(pool, "collider.1", (K, R)))
+        c -= self.radii**2
+
+        # discriminant = b**2 - 4 * a * c
+        discriminant = np.multiply(b, b, out=empty(pool, "collider.2", (K, R)))
+        c *= 4 * a
+        discriminant -= c
+
+        sqrt_disc = np.abs(discriminant, out=empty(pool, "collider.3", (K, R)))
+        np.sqrt(sqrt_disc, out=sqrt_disc)
+        # r1 = (-b - sqrt_disc) / (2 * a), r2 = (-b + sqrt_disc) / (2 * a)
+        r1 = np.negative(b, out=empty(pool, "collider.4", (K, R)))
+        r1 -= sqrt_disc
+        r1 /= 2 * a
+        r2 = np.subtract(sqrt_disc, b, out=b)
+        r2 /= 2 * a
+        r = r2
+        np.copyto(r, r1, where=(r1 > 0) & (r1 < r2))
+
+        # M = O + D * r
+        M = np.multiply(D, r, out=O_C)
+        M += O
+        M -= self.centers
+        M /= self.radii
+        NdotD = dot(M, D, out=c)
+
+        hit = (discriminant > 0) & (r > 0)
+        distance = r
+        np.copyto(distance, FARAWAY, where=~hit)
+        distance, NdotD, index = nearest(distance, NdotD)
+        orientation = np.where(NdotD < 0, UPWARDS, UPDOWN)
+        return distance, orientation, index, np.zeros(R, np.int64)
+
+
+class PlaneGroup(ColliderGroup):
+    def __init__(self, colliders, indices):
+        super().__init__(colliders, indices)
+
+        def stack(attr):
+            return np.array([getattr(c, attr).to_array() for c in colliders]).T[
+                :, :, None
+            ]
+
+        self.normals = stack("normal")
+        self.centers = stack("center")
+        self.u_axes = stack("u_axis")
+        self.v_axes = stack("v_axis")
+        self.w = np.array([c.w for c in colliders], dtype=np.float64)[:, None]
+        self.h = np.array([c.h for c in colliders], dtype=np.float64)[:, None]
+
+    def intersect(self, O, D, pool=None):
+        # same formulation as Plane_Collider.intersect
+        K, R = self.w.shape[0], O.shape[1]
+        O = O[:, None, :]
+        D = D[:, None, :]
+        N = self.normals
+
+        NdotD = dot(N, D, out=empty(pool, "collider.0", (K, R)))
+        NdotD[NdotD == 0.0] += 0.0001  # avoid zero division
+
+        C_O = np.subtract(self.centers, O, out=empty(pool, "collider.vec0", (3, K, R)))
+        NdotC_O = dot(N, C_O, out=empty(pool, "collider.1", (K, R)))
+
+        # d = D * (NdotC_O / NdotD)
+        t = np.divide(NdotC_O, NdotD, out=empty(pool, "collider.2", (K, R)))
+        d = np.multiply(D, t, out=C_O)
+        M_C = np.add(O, d, out=empty(pool, "collider.vec1", (3, K, R)))
+        M_C -= self.centers
+        dis = dot(d, d, out=empty(pool, "collider.3", (K, R)))
+        np.sqrt(dis, out=dis)
+
+        # |u.M_C| <= w and |v.M_C| <= h and the plane is in front of the ray
+        projection = np.abs(dot(self.u_axes, M_C, out=t), out=t)
+        hit_inside = projection <= self.w
+        projection = np.abs(dot(self.v_axes, M_C, out=t), out=t)
+        hit_inside &= projection <= self.h
+        hit_inside &= np.multiply(NdotC_O, NdotD, out=t) > 0
+
+        distance = dis
+        np.copyto(distance, FARAWAY, where=~hit_inside)
+        distance, NdotD, index = nearest(distance, NdotD)
+        orientation = np.where(NdotD < 0, UPWARDS, UPDOWN)
+        return distance, orientation, index, np.zeros(R, np.int64)
+
+
+class CuboidGroup(ColliderGroup):
+    def __init__(self, colliders, indices):
+        super().__init__(colliders, indices)
+        self.basis_matrices = np.array([c.basis_matrix for c in colliders])
+        self.lb_local = np.array([c.lb_local_basis.to_array() for c in colliders]).T[
+            :, :, None
+        ]
+        self.rt_local = np.array([c.rt_local_basis.to_array() for c in colliders]).T[
+            :, :, None
+        ]
+
+    def intersect(self, O, D, pool=None):
+        # same formulation as Cuboid_Collider.intersect
+        K, R = self.basis_matrices.shape[0], O.shape[1]
+        O_local = np.einsum(
+            "kij,jr->ikr",
+            self.basis_matrices,
+            O,
+            out=empty(pool, "collider.vec0", (3, K, R)),
+        )
+        D_local = np.einsum(
+            "kij,jr->ikr",
+            self.basis_matrices,
+            D,
+            out=empty(pool, "collider.vec1", (3, K, R)),
+        )
+
+        tlow = np.subtract(
+            self.lb_local, O_local, out=empty(pool, "collider.vec2", (3, K, R))
+        )
+        thigh = np.subtract(self.rt_local, O_local, out=O_local)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tlow /= D_local
+            thigh /= D_local
+
+        tmin = np.minimum(tlow, thigh, out=D_local).max(axis=0)
+        tmax = np.maximum(tlow, thigh, out=tlow).min(axis=0)
+
+        miss = (tmin > tmax) | (tmax < 0)
+        distance = np.where(miss, FARAWAY, np.where(tmin < 0, tmax, tmin))
+        distance, tmin, index = nearest(distance, tmin)
+        orientation = np.where(tmin >= 0, UPWARDS, UPDOWN)
+        return distance, orientation, index, np.zeros(R, np.int64)
+
+
+group_types = {
+    Sphere_Collider: SphereGroup,
+    Plane_Collider: PlaneGroup,
+    Cuboid_Collider: CuboidGroup,
+}
+
+
+def pack_colliders(colliders):
+    """
+    Packs a list of colliders in groups of the same type.
+
+    Returns:
+    - A list of ColliderGroup objects. The `indices` of each group are the positions
+      of its colliders in the input list.
+    """
+    by_type = {}
+    for i, c in enumerate(colliders):
+        by_type.setdefault(group_types.get(type(c), ColliderGroup), []).append(i)
+
+    return [
+        group([colliders[i] for i in indices], indices)
+        for group, indices in by_type.items()
+    ]
+
+
+def intersect_groups(groups, O, D, pool=None):
+    """Nearest intersection of the rays with a list of packed groups."""
+    n = O.shape[1]
+    distance = np.full(n, FARAWAY)
+    orientation = np.full(n, FARAWAY)
+    index = np.zeros(n, dtype=np.int64)
+    primitive_id = np.zeros(n, dtype=np.int64)
+    for group in groups:
+        d, o, i, p = group.intersect(O, D, pool)
+        closer = d < distance
+        distance = np.where(closer, d, distance)
+        orientation = np.where(closer, o, orientation)
+        index = np.where(closer, group.indices[i], index)
+        primitive_id = np.where(closer, p, primitive_id)
+    return distance, orientation, index, primitive_id
@@ -170,6 +170,15 @@ class Cuboid_Collider(Collider):
 
         return P.matmul(self.inverse_basis_matrix)
 
+    def get_bounds(self):
+        extent = (
+            np.abs(self.ax_w.to_array()) * self.width / 2
+            + np.abs(self.ax_h.to_array()) * self.height / 2
+            + np.abs(self.ax_l.to_array()) * self.length / 2
+        )
+        c = self.center.to_array()
+        return c - extent, c + extent
+
     def get_uv(self, hit):
         hit.N = self.get_Normal(hit)
         M_C = hit.point - self.center
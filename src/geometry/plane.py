@@ -121,5 +121,12 @@ class Plane_Collider(Collider):
         v = (self.v_axis.dot(M_C) / self.h + 1) / 2 + self.uv_shift[1]
         return u, v
 
+    def get_bounds(self):
+        # the plane spans |u_axis.dot(M_C)| <= w and |v_axis.dot(M_C)| <= h
+        u = self.u_axis.to_array() * self.w / self.u_axis.square_length()
+        v = self.v_axis.to_array() * self.h / self.v_axis.square_length()
+        c = self.center.to_array()
+        return c - np.abs(u) - np.abs(v), c + np.abs(u) + np.abs(v)
+
     def get_Normal(self, hit):
         return self.normal
@@ -71,6 +71,10 @@ class Sphere_Collider(Collider):
             ],
         )
 
+    def get_bounds(self):
+        c = self.center.to_array()
+        return c - self.radius, c + self.radius
+
     def get_Normal(self, hit):
         # M = intersection point
         return (hit.point - self.center) * (1.0 / self.radius)
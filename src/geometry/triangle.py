@@ -12,14 +12,13 @@ class Triangle(Primitive):
             Triangle_Collider(assigned_primitive=self, p1=p1, p2=p2, p3=p3)
         ]
 
-    def get_uv(self, M, collider):
-        return collider.get_uv(M)
+    def get_uv(self, hit):
+        return hit.collider.get_uv(hit)
 
 
 class Triangle_Collider(Collider):
-    def __init__(self, assigned_surface, p1, p2, p3):
-
-        self.assigned_primitive = assigned_surface
+    def __init__(self, assigned_primitive, p1, p2, p3):
+        super().__init__(assigned_primitive, (p1 + p2 + p3) / 3)
         self.p1 = p1
         self.p2 = p2
         self.p3 = p3
@@ -77,10 +76,19 @@ class Triangle_Collider(Collider):
         self.centroid = center + (self.centroid - center).matmul(M)
 
     def get_uv(self, hit):
-        M_C = hit.point - self.center
-        u = (self.pu.dot(M_C) / self.w + 1) / 2 + self.uv_shift[0]
-        v = (self.pv.dot(M_C) / self.h + 1) / 2 + self.uv_shift[1]
+        # barycentric coordinates of the hit point
+        e1 = self.p2 - self.p1
+        e2 = self.p3 - self.p1
+        P = hit.point - self.p1
+        d11, d12, d22 = e1.dot(e1), e1.dot(e2), e2.dot(e2)
+        denom = d11 * d22 - d12 * d12
+        u = (d22 * P.dot(e1) - d12 * P.dot(e2)) / denom
+        v = (d11 * P.dot(e2) - d12 * P.dot(e1)) / denom
         return u, v
 
+    def get_bounds(self):
+        p = np.array([self.p1.to_array(), self.p2.to_array(), self.p3.to_array()])
+        return p.min(axis=0), p.max(axis=0)
+
     def get_Normal(self, hit):
         return self.normal
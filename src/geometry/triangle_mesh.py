@@ -1,43 +1,189 @@
 import numpy as np
 from ..utils.constants import *
 from ..utils.vector3 import vec3
-from ..geometry import Primitive, Triangle_Collider
+from ..geometry import Primitive, Collider
+from .bvh import BVH, to_columns, batch_size
 
 
-# WORK IN PROGRESS.
-# We need to implement a bounding volume hierarchy to make TriangleMesh collision efficient.
-# Without a bounding volume hierarchy a model with 200 triangles takes around 3 minutes to be rendered
+# The mesh is stored as contiguous vertex (float32) and face (int32) arrays.
+# Triangles are kept in a bounding volume hierarchy and each BVH leaf is intersected
+# with a single broadcasted Möller–Trumbore kernel, so no Python object is created per face.
+
+
+def load_obj(file_name):
+    """
+    Reads the vertices and faces of a Wavefront OBJ file.
+    Polygons are triangulated as fans and negative (relative) indices are supported.
+
+    Returns:
+    - A float32 array of shape (num_vertices, 3) and an int32 array of shape (num_faces, 3).
+    """
+    with open(file_name, "r") as f:
+        lines = f.read().split("\n")
+
+    vs = [l.split()[1:4] for l in lines if l.startswith("v ")]
+    vertices = np.array(vs, dtype=np.float32).reshape(-1, 3)
+
+    fs = []
+    for l in lines:
+        if not l.startswith("f "):
+            continue
+        idx = [int(i.split("/")[0]) for i in l.split()[1:]]
+        for k in range(1, len(idx) - 1):
+            fs.append((idx[0], idx[k], idx[k + 1]))
+    faces = np.array(fs, dtype=np.int64).reshape(-1, 3)
+    faces = np.where(faces < 0, faces + len(vertices), faces - 1)
+
+    return vertices, faces.astype(np.int32)
 
 
 class TriangleMesh(Primitive):
-    def __init__(self, file_name, center, material, max_ray_depth, shadow=True):
+    def __init__(
+        self,
+        file_name,
+        center,
+        material,
+        max_ray_depth=5,
+        shadow=True,
+        vertices=None,
+        faces=None,
+    ):
         super().__init__(center, material, max_ray_depth, shadow=shadow)
-        self.collider_list += []
-        vs = []
-        fs = []
-        with open(file_name, "r") as f:
-            r = f.read()
-            r = r.split("\n")
-            for i in r:
-                i = i.split()
-                if not i:
-                    continue
-                elif i[0] == "v":
-                    x = float(i[1])
-                    y = float(i[2])
-                    z = float(i[3])
-                    vs.append(vec3(x, y, z))
-                elif i[0] == "f":
-                    f1 = int(i[1].split("/")[0]) - 1
-                    f2 = int(i[2].split("/")[0]) - 1
-                    f3 = int(i[3].split("/")[0]) - 1
-                    fs.append([f1, f2, f3])
-        for i in fs:
-            p1 = vs[i[0]] + center
-            p2 = vs[i[1]] + center
-            p3 = vs[i[2]] + center
-            self.collider_list += [
-                colliders.Triangle_Collider(
-                    assigned_primitive=self, p1=p1, p2=p2, p3=p3
-                )
-            ]
+
+        if file_name is not None:
+            vertices, faces = load_obj(file_name)
+
+        self.collider_list += [
+            TriangleMesh_Collider(
+                assigned_primitive=self,
+                center=center,
+                vertices=np.asarray(vertices, dtype=np.float32) + center.to_array(),
+                faces=faces,
+            )
+        ]
+        self.bounded_sphere_radius = np.sqrt(
+            ((self.collider_list[0].vertices - center.to_array()) ** 2).sum(1).max()
+        )
+
+    def get_uv(self, hit):
+        return hit.collider.get_uv(hit)
+
+
+class TriangleMesh_Collider(Collider):
+    def __init__(self, vertices, faces, leaf_size=8, **kwargs):
+        super().__init__(**kwargs)
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+        self.faces = np.ascontiguousarray(faces, dtype=np.int32)
+        self.leaf_size = leaf_size
+        self.build()
+
+    def build(self):
+        V, F = self.vertices, self.faces
+        tris = V[F]  # (num_faces, 3 vertices, 3)
+        bvh = BVH(tris.min(axis=1), tris.max(axis=1), leaf_size=self.leaf_size)
+
+        # store the faces in BVH order, so every leaf is a contiguous slice
+        self.faces = np.ascontiguousarray(F[bvh.order])
+        bvh.order = np.arange(bvh.size)
+        self.bvh = bvh
+
+        tris = V[self.faces]
+        # (3, num_faces) layout, one row per coordinate
+        self.p0 = np.ascontiguousarray(tris[:, 0].T)
+        self.e1 = np.ascontiguousarray((tris[:, 1] - tris[:, 0]).T)
+        self.e2 = np.ascontiguousarray((tris[:, 2] - tris[:, 0]).T)
+
+        normal = np.cross(self.e1.T, self.e2.T)
+        length = np.linalg.norm(normal, axis=1, keepdims=True)
+        self.normals = np.ascontiguousarray(
+            (normal / np.where(length == 0, 1, length)).T
+        )
+
+    def intersect_leaf(self, node, prims, O, D):
+        # Möller–Trumbore for every (triangle, ray) pair of the leaf.
+        s = slice(prims[0], prims[-1] + 1)
+        p0 = self.p0[:, s, None]
+        e1 = self.e1[:, s, None]
+        e2 = self.e2[:, s, None]
+        O = O[:, None, :]
+        D = D[:, None, :]
+
+        def cross(a, b):
+            return (
+                a[1] * b[2] - a[2] * b[1],
+                a[2] * b[0] - a[0] * b[2],
+                a[0] * b[1] - a[1] * b[0],
+            )
+
+        def dot(a, b):
+            return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+        pvec = cross(D, e2)
+        det = dot(e1, pvec)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inv_det = 1.0 / det
+            tvec = O - p0
+            u = dot(tvec, pvec) * inv_det
+            qvec = cross(tvec, e1)
+            v = dot(D, qvec) * inv_det
+            t = dot(e2, qvec) * inv_det
+            hit = (
+                (np.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 1e-9)
+            )
+        t = np.where(hit, t, FARAWAY)
+
+        index = np.argmin(t, axis=0)
+        rays = np.arange(t.shape[1])
+        distance = t[index, rays]
+
+        NdotD = dot(self.normals[:, prims[index]], D[:, 0, :])
+        orientation = np.where(NdotD < 0, UPWARDS, UPDOWN)
+        return distance, orientation, index, np.zeros(t.shape[1], dtype=np.int64)
+
+    def intersect(self, O, D):
+        """
+        Computes the intersection of a ray with the triangles of the mesh.
+
+        Args:
+        - O: A vec3 object representing the origins of the rays.
+        - D: A vec3 object representing the directions of the rays.
+
+        Returns:
+        - A NumPy array of shape (3, num_ray) containing
+          the ray distance to the intersection point (row 0),
+          the orientation of the intersection point (row 1)
+          and the index of the hit triangle (row 2).
+        """
+        n = batch_size(O, D)
+        distance, orientation, index, _ = self.bvh.traverse(
+            to_columns(O, n), to_columns(D, n), self.intersect_leaf
+        )
+        return np.array([distance, orientation, index])
+
+    def rotate(self, M, center):
+        c = center.to_array()
+        self.vertices = ((self.vertices - c) @ M.T + c).astype(np.float32)
+        self.build()
+
+    def get_bounds(self):
+        return self.vertices.min(axis=0), self.vertices.max(axis=0)
+
+    def get_Normal(self, hit):
+        N = self.normals[:, hit.primitive_id]
+        return vec3(N[0], N[1], N[2])
+
+    def get_uv(self, hit):
+        # barycentric coordinates of the hit point
+        i = hit.primitive_id
+        P = to_columns(hit.point, np.size(i)) - self.p0[:, i]
+        e1, e2 = self.e1[:, i], self.e2[:, i]
+        d11 = (e1 * e1).sum(0)
+        d12 = (e1 * e2).sum(0)
+        d22 = (e2 * e2).sum(0)
+        dp1 = (P * e1).sum(0)
+        dp2 = (P * e2).sum(0)
+        denom = d11 * d22 - d12 * d12
+        denom = np.where(denom == 0, 1, denom)
+        u = (d22 * dp1 - d12 * dp2) / denom
+        v = (d11 * dp2 - d12 * dp1) / denom
+        return u, v
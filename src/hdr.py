@@ -0,0 +1,86 @@
+import os
+import numpy as np
+from .framebuffer import Framebuffer
+from .checkpoint import load_checkpoint
+from .utils.image_functions import save_pfm, load_pfm
+
+
+# HDR outputs of a render: the average linear color of every pixel as float32, with its number of samples,
+# so the radiance isn't quantized and partial renders can be merged by weighting them with their sample counts:
+# - {path}.npy: an array of shape (height, width, 4) with the linear RGB color and the sample count,
+# - {path}.pfm: a Portable Float Map with the linear RGB color, readable by image tools,
+#   and {path}.samples.pfm, a greyscale one with the sample counts.
+# Checkpoints (checkpoint.py) keep the float64 sums instead, and the variance: merging them is exact.
+
+HDR_FORMATS = (".npy", ".pfm")
+
+
+def save_hdr(path, framebuffer, linear=None):
+    """
+    Writes the average linear color of a framebuffer and its sample counts to path (.npy or .pfm).
+
+    Args:
+    - linear: An optional vec3 object replacing the average linear color (e.g. the denoised color).
+    """
+    root, ext = os.path.splitext(path)
+    if ext not in HDR_FORMATS:
+        raise ValueError("HDR outputs are " + ", ".join(HDR_FORMATS) + " files")
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    H, W = framebuffer.height, framebuffer.width
+    if linear is None:
+        linear = framebuffer.get_linear()
+    color = linear.to_array().reshape(3, H, W).transpose(1, 2, 0).astype(np.float32)
+    samples = framebuffer.samples.reshape(H, W).astype(np.float32)
+
+    if ext == ".npy":
+        np.save(path, np.concatenate([color, samples[:, :, None]], axis=2))
+    else:
+        save_pfm(path, color)
+        save_pfm(root + ".samples.pfm", samples)
+
+
+def load_hdr(path):
+    """
+    Reads an HDR output written by save_hdr as a Framebuffer object (without the variance of the samples,
+    whose squares are taken as the ones of their average).
+    """
+    root, ext = os.path.splitext(path)
+    if ext == ".npy":
+        data = np.load(path)
+        color, samples = data[:, :, :3], data[:, :, 3]
+    elif ext == ".pfm":
+        color = load_pfm(path)
+        samples = load_pfm(root + ".samples.pfm")
+    else:
+        raise ValueError("HDR outputs are " + ", ".join(HDR_FORMATS) + " files")
+
+    H, W = samples.shape
+    framebuffer = Framebuffer(W, H)
+    framebuffer.samples[:] = np.rint(samples).ravel()
+    mean = color.transpose(2, 0, 1).reshape(3, H * W).astype(np.float64)
+    framebuffer.color[:] = mean * framebuffer.samples
+    framebuffer.square[:] = mean**2 * framebuffer.samples
+    return framebuffer
+
+
+def load_render(path):
+    """Reads a partial render: an HDR output (.npy, .pfm) or a checkpoint (.npz, or its path without extension)."""
+    root, ext = os.path.splitext(path)
+    if ext in HDR_FORMATS:
+        return load_hdr(path)
+    return load_checkpoint(root if ext == ".npz" else path)[0]
+
+
+def merge_renders(paths):
+    """
+    Merges partial renders of the same image (rendered with different seeds) into one framebuffer,
+    the weighted average of their colors by their sample counts.
+    """
+    framebuffer = None
+    for path in paths:
+        render = load_render(path)
+        framebuffer = render if framebuffer is None else framebuffer.merge(render)
+    return framebuffer
@@ -1,8 +1,9 @@
 from ..utils.constants import *
 from ..utils.vector3 import vec3, rgb, extract
 from ..utils.random import spherical_caps_pdf, cosine_pdf, mixed_pdf
+from ..utils.sampler import BOUNCE_DIMENSION
 from functools import reduce as reduce
-from ..ray import Ray, get_raycolor
+from ..ray import Ray, Hit, get_raycolor
 from .. import lights
 import numpy as np
 from . import Material
@@ -22,9 +23,74 @@ class Diffuse(Material):
         self.max_diffuse_reflections = 2
         self.ambient_weight = ambient_weight
 
-    def get_color(self, scene, ray, hit) -> vec3:
+    def get_albedo(self, hit):
+        return self.diff_texture.get_color(hit)
+
+    def fan_out(self):
+        return self.diffuse_rays
+
+    def sample_lights(self, scene, origin, N, diff_color, parent, n, depth):
         """
-        Computes the color of diffuse surface intersected by the given ray.
+        Next event estimation: estimates the light reaching the hits directly from the area lights
+        of the scene (importance sampled emissive primitives), with one shadow ray per scattered ray.
+        The directions are sampled in the cones of the lights (spherical_caps_pdf) and weighted
+        against the scattered rays with the power heuristic (see Emissive.scatter).
+
+        Args:
+        - scene: A Scene object with area lights.
+        - origin: A vec3 object with the (nudged) hit point of every shadow ray.
+        - N: A vec3 object with the normal at the hit point of every shadow ray.
+        - diff_color: A vec3 object with the diffuse color of every shadow ray (or a single color).
+        - parent: The index of the hit of every shadow ray.
+        - n: The number of hits.
+        - depth: The depth of the rays hitting the surface.
+
+        Returns:
+        - A vec3 object containing the direct light reflected by each hit.
+        """
+        count = parent.shape[0] // n
+        u = scene.sampler.get_sets(n, count, BOUNCE_DIMENSION + 2 * depth)
+        pdf = spherical_caps_pdf(parent.shape[0], origin, scene.area_light_list)
+        light_dir = pdf.generate(u)
+        light_pdf = pdf.value(light_dir)
+        N_dot_L = np.clip(light_dir.dot(N), 0.0, 1.0)
+        bsdf_pdf = N_dot_L / np.pi
+
+        # the emission of the area lights the shadow rays hit first
+        distance, orientation, collider, primitive_id = scene.intersect(origin, light_dir)
+        light = scene.collider_area_light[collider]
+        m = parent.shape[0]
+        emission = rgb(np.zeros(m), np.zeros(m), np.zeros(m))
+        for k, primitive in enumerate(scene.area_light_list):
+            index = np.nonzero((light == k) & (N_dot_L > 0.0))[0]
+            if index.size == 0:
+                continue
+            colliders = primitive.collider_list
+            light_hit = Hit(
+                distance[index],
+                orientation[index],
+                primitive.material,
+                colliders[0] if len(colliders) == 1 else None,
+                primitive,
+                primitive_id[index],
+                colliders=colliders,
+                collider_index=scene.collider_area_light_position[collider[index]],
+            )
+            light_hit.point = origin.take(index) + light_dir.take(index) * distance[index]
+            emission.put(index, primitive.material.get_emission(light_hit))
+
+        light_pdf2 = light_pdf**2
+        weight = np.where(
+            light_pdf > 0.0,
+            light_pdf / np.maximum(light_pdf2 + bsdf_pdf**2, 1e-300),
+            0.0,
+        )
+        color = emission * diff_color * (N_dot_L * weight / np.pi / count)
+        return color.bincount(parent, n)
+
+    def scatter(self, scene, ray, hit):
+        """
+        Computes the rays scattered by the diffuse surface intersected by the given ray.
 
         Args:
         - scene: A Scene object containing the list of objects in the scene.
@@ -32,7 +98,8 @@ class Diffuse(Material):
         - hit: A Hit object containing the information of the ray-surface intersection.
 
         Returns:
-        - A vec3 object containing the color of the diffuse surface intersected by the given ray.
+        - A vec3 object containing the color emitted by the diffuse surface (black)
+          and the list of continuations (next_ray, weight, parent) of the scattered rays.
         """
 
         hit.point = ray.origin + ray.dir * hit.distance  # intersection point
@@ -53,8 +120,10 @@ class Diffuse(Material):
             N_20 = N.repeat(self.diffuse_rays)
             ray_n_20 = ray.n if ray.n.shape() == 1 else ray.n.repeat(self.diffuse_rays) # if no refraction we're okay but should be handled in case of diffuse
 
+            # the directions scattered by a hit are a set of points of the scene sampler
+            u = scene.sampler.get_sets(N.shape()[0], self.diffuse_rays, BOUNCE_DIMENSION + 2 * ray.depth)
             pdf = cosine_pdf(N_20.shape()[0], N_20)
-            reflected_rays_dir = pdf.generate() # already normalized
+            reflected_rays_dir = pdf.generate(u) # already normalized
             pdf_val = pdf.value(reflected_rays_dir)
             
             reflected_ray = Ray(
@@ -67,8 +136,15 @@ class Diffuse(Material):
                 ray.diffuse_reflections + 1
             )
             N_dot_L_20 = np.clip(reflected_rays_dir.dot(N_20), 0., 1.)
-            every_color = get_raycolor(reflected_ray, scene) * N_dot_L_20 / pdf_val
-            mean_c_sample = every_color.reshape(N.shape()[0], self.diffuse_rays).mean(1)
+            diff_color_20 = diff_color if diff_color.shape() == 1 else diff_color.repeat(self.diffuse_rays)
+
+            # the color is the mean of the samples of each hit
+            weight = diff_color_20 * N_dot_L_20 / pdf_val / np.pi / self.diffuse_rays
+            parent = np.repeat(np.arange(N.shape()[0]), self.diffuse_rays)
+
+            if scene.area_light_list:
+                reflected_ray.bsdf_pdf = pdf_val
+                color = self.sample_lights(scene, nudged_20, N_20, diff_color_20, parent, N.shape()[0], ray.depth)
 
             # color_temp = rgb(0.,0.,0.)
             # for i in range(self.diffuse_rays):
@@ -87,9 +163,8 @@ class Diffuse(Material):
             #     N_dot_L = np.clip(reflected_rays_dir.dot(N), 0., 1.)
             #     color_temp += get_raycolor(reflected_ray, scene) * N_dot_L / pdf_val
             # mean_c_sample = color_temp / self.diffuse_rays / np.pi
-            color += diff_color * mean_c_sample / np.pi
 
-            return color
+            return color, [(reflected_ray, weight, parent)]
             
         # TODO: If the ray intersected with diffuse material more than once,
         # we generate only one secondary ray.
@@ -97,8 +172,9 @@ class Diffuse(Material):
             # raise NotImplementedError("TODO")
             nudged = hit.point + N * 0.000001  # M nudged to avoid itself
             
+            u = scene.sampler.get_sets(nudged.shape()[0], 1, BOUNCE_DIMENSION + 2 * ray.depth)
             pdf = cosine_pdf(nudged.shape()[0], N)
-            reflected_rays_dir = pdf.generate()
+            reflected_rays_dir = pdf.generate(u)
             pdf_val = pdf.value(reflected_rays_dir)
             reflected_ray = Ray(
                 nudged,
@@ -110,10 +186,14 @@ class Diffuse(Material):
                 ray.diffuse_reflections + 1
             )
             N_dot_L = np.clip(reflected_rays_dir.dot(N), 0., 1.)
-            c = get_raycolor(reflected_ray, scene)* N_dot_L/pdf_val / np.pi
-            color += diff_color * c
-            return color
+            weight = diff_color * N_dot_L/pdf_val / np.pi
+            parent = np.arange(N.shape()[0])
+
+            if scene.area_light_list:
+                reflected_ray.bsdf_pdf = pdf_val
+                color = self.sample_lights(scene, nudged, N, diff_color, parent, N.shape()[0], ray.depth)
+            return color, [(reflected_ray, weight, parent)]
             
         # TODO: Stop tracing if the recursion depth exceeds the maximum depth.
         else:
-            return color
\ No newline at end of file
+            return color, []
\ No newline at end of file
@@ -1,5 +1,6 @@
 from ..utils.constants import *
 from ..utils.vector3 import vec3, rgb, extract
+from ..utils.random import spherical_caps_pdf
 from functools import reduce as reduce
 from ..ray import Ray, get_raycolor
 from .. import lights
@@ -9,6 +10,8 @@ from ..textures import *
 
 
 class Emissive(Material):
+    emissive = True
+
     def __init__(self, color, **kwargs):
 
         if isinstance(color, vec3):
@@ -18,6 +21,34 @@ class Emissive(Material):
 
         super().__init__(**kwargs)
 
-    def get_color(self, scene, ray, hit):
-        diff_color = self.texture_color.get_color(hit)
-        return diff_color
+    def get_emission(self, hit):
+        return self.texture_color.get_color(hit)
+
+    def get_albedo(self, hit):
+        # the emission, so the denoiser leaves the lights as they are
+        return self.get_emission(hit)
+
+    def scatter(self, scene, ray, hit):
+        diff_color = self.get_emission(hit)
+
+        if ray.bsdf_pdf is not None and scene.area_light_list:
+            # The rays scattered by a diffuse surface that also sampled the area lights:
+            # the light they hit was estimated by both, so it's weighted by the power heuristic.
+            colliders = np.array(
+                [c.assigned_primitive in scene.area_light_list for c in hit.colliders]
+            )
+            is_light = (
+                colliders[0] if hit.collider_index is None else colliders[hit.collider_index]
+            )
+            light_pdf = spherical_caps_pdf(
+                hit.distance.shape[0], ray.origin, scene.area_light_list
+            ).value(ray.dir)
+            bsdf_pdf2 = ray.bsdf_pdf**2
+            mis_weight = np.where(
+                is_light & (ray.bsdf_pdf > 0),
+                bsdf_pdf2 / np.maximum(bsdf_pdf2 + light_pdf**2, 1e-300),
+                1.0,
+            )
+            diff_color = diff_color * mis_weight
+
+        return diff_color, []
@@ -1,5 +1,7 @@
 from ..utils.constants import *
 from ..utils.vector3 import vec3, rgb, extract
+from ..utils.random import microfacet_pdf
+from ..utils.sampler import BOUNCE_DIMENSION
 from functools import reduce as reduce
 from ..ray import Ray, get_raycolor
 from .. import lights
@@ -9,7 +11,26 @@ from ..textures import *
 
 
 class Glossy(Material):
-    def __init__(self, diff_color, roughness, spec_coeff, diff_coeff, n, **kwargs):
+    """
+    Args:
+    - distribution: The reflection of the rays: "mirror" traces a single perfect mirror reflection,
+      "ggx" or "beckmann" sample the reflected directions from the microfacet normal distribution
+      of the roughness.
+    - specular_rays: The number of reflected directions sampled for the rays hitting the surface
+      from the camera (one for the others), with a microfacet distribution.
+    """
+
+    def __init__(
+        self,
+        diff_color,
+        roughness,
+        spec_coeff,
+        diff_coeff,
+        n,
+        distribution="mirror",
+        specular_rays=1,
+        **kwargs
+    ):
         super().__init__(**kwargs)
 
         if isinstance(diff_color, vec3):
@@ -21,10 +42,60 @@ class Glossy(Material):
         self.diff_coeff = diff_coeff
         self.spec_coeff = spec_coeff
         self.n = n  # index of refraction
+        if distribution not in ("mirror", "ggx", "beckmann"):
+            raise ValueError("unknown distribution " + distribution)
+        self.distribution = distribution
+        self.specular_rays = specular_rays
 
-    def get_color(self, scene, ray, hit):
+    def get_albedo(self, hit):
+        return self.diff_texture.get_color(hit)
+
+    def fan_out(self):
+        return self.specular_rays if self.distribution != "mirror" else 1
+
+    def sample_reflection(self, scene, ray, N, V, nudged, F0):
         """
-        Computes the color of glossy surface intersected by the given ray.
+        Samples the directions reflected by the rough surface from the microfacet distribution.
+
+        Returns:
+        - A continuation (next_ray, weight, parent) with the reflected rays above the surface.
+        """
+        n = N.shape()[0]
+        count = self.specular_rays if ray.depth == 0 else 1
+        if count > 1:
+            N, V, nudged = N.repeat(count), V.repeat(count), nudged.repeat(count)
+        parent = np.repeat(np.arange(n), count)
+
+        u = scene.sampler.get_sets(n, count, BOUNCE_DIMENSION + 2 * ray.depth)
+        pdf = microfacet_pdf(n * count, N, V, self.roughness, self.distribution)
+        out_dir = pdf.generate(u)
+        H = (out_dir + V).normalize()
+        NdotL = out_dir.dot(N)
+        NdotV = np.clip(N.dot(V), 1e-6, 1.0)
+        NdotH = np.clip(N.dot(H), 1e-6, 1.0)
+        VdotH = np.clip(V.dot(H), 0.0, 1.0)
+
+        # f * N.L / pdf, with f = F * G * D / (4 N.V N.L) and pdf = D * N.H / (4 V.H)
+        F = F0 + (1.0 - F0) * (1.0 - VdotH) ** 5
+        G = pdf.G1(NdotV) * pdf.G1(NdotL)
+        weight = F * (G * VdotH / (NdotV * NdotH) / count)
+
+        # directions below the surface are absorbed
+        above = np.nonzero(NdotL > 0.0)[0]
+        reflected_ray = Ray(
+            nudged.take(above),
+            out_dir.take(above),
+            ray.depth + 1,
+            ray.n if ray.n.shape() == 1 else ray.n.repeat(count).take(above),
+            ray.reflections + 1,
+            ray.transmissions,
+            ray.diffuse_reflections,
+        )
+        return reflected_ray, weight.take(above), parent[above]
+
+    def scatter(self, scene, ray, hit):
+        """
+        Computes the direct lighting of the glossy surface intersected by the given ray and its reflected ray.
 
         Args:
         - scene: A Scene object containing the list of objects in the scene.
@@ -32,7 +103,8 @@ class Glossy(Material):
         - hit: A Hit object containing the information of the ray-surface intersection.
 
         Returns:
-        - A vec3 object containing the color of the diffuse surface intersected by the given ray.
+        - A vec3 object containing the color of the glossy surface lit by the scene lights
+          and the list of continuations (next_ray, weight, parent) of the reflected rays.
         """
 
         hit.point = ray.origin + ray.dir * hit.distance  # intersection point
@@ -44,6 +116,7 @@ class Glossy(Material):
         color = scene.ambient_color * diff_color
         V = ray.dir * -1.0
         nudged = hit.point + N * 0.000001  # M nudged to avoid itself
+        continuations = []
 
         for light in scene.Light_list:
 
@@ -60,9 +133,7 @@ class Glossy(Material):
             # This amounts to finding out if M can see the light
             # Shoot a ray from M to L and check what object is the nearest
             if not scene.shadowed_collider_list == []:
-                inters = [s.intersect(nudged, L) for s in scene.shadowed_collider_list]
-                light_distances, light_hit_orientation = zip(*inters)
-                light_nearest = reduce(np.minimum, light_distances)
+                light_nearest, _, _, _ = scene.intersect_shadow(nudged, L)
                 seelight = light_nearest >= dist_light
             else:
                 seelight = 1.0
@@ -109,6 +180,10 @@ class Glossy(Material):
             # theta: angle between the direction from which the incident light is coming & normal of the interface between two media -> NdotV
             # n1, n2 indices of refraction of the two media. (here, air & surface)
             F0 = np.abs((scene.n - self.n)/(scene.n  + self.n))**2
+            if self.distribution != "mirror" and self.roughness != 0.0:
+                continuations += [self.sample_reflection(scene, ray, N, V, nudged, F0)]
+                return color, continuations
+
             NdotV = np.clip(N.dot(V), 0.0, 1.)
             F = F0 + (1. - F0) * (1.- NdotV)**5
             
@@ -124,7 +199,6 @@ class Glossy(Material):
                 ray.transmissions,
                 ray.diffuse_reflections
             )
-            reflected_ray_color = get_raycolor(reflected_ray, scene)
-            color += F*reflected_ray_color
+            continuations += [(reflected_ray, F, np.arange(N.shape()[0]))]
 
-        return color
+        return color, continuations
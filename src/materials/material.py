@@ -1,32 +1,33 @@
 from ..utils.constants import *
 from ..utils.vector3 import vec3, rgb, extract
 from functools import reduce as reduce
-from ..ray import Ray, get_raycolor
+from ..ray import Ray, get_raycolor, propagate_cones
 from .. import lights
-from ..utils.image_functions import load_image, load_image_as_linear_sRGB
+from ..utils.image_functions import get_texels
 import numpy as np
 from abc import abstractmethod
 
 
 class Material:
+    emissive = False  # whether the surface emits light (it can then be sampled as an area light)
+
     def __init__(self, normalmap=None):
 
         if normalmap != None:
-            normalmap = load_image("sightpy/normalmaps/" + normalmap)
+            normalmap = get_texels("sightpy/normalmaps/" + normalmap)
         self.normalmap = normalmap
 
     def get_Normal(self, hit):
+        if hit.collider is None:
+            # hit merges several colliders sharing this material
+            return hit.map(self.get_Normal)
+
         N_coll = hit.collider.get_Normal(hit)
         if self.normalmap is not None:
             u, v = hit.get_uv()
-            im = self.normalmap[
-                -(
-                    (v * self.normalmap.shape[0] * self.repeat).astype(int)
-                    % self.normalmap.shape[0]
-                ),
-                (u * self.normalmap.shape[1] * self.repeat).astype(int)
-                % self.normalmap.shape[1],
-            ].T
+            im = self.normalmap.sample(
+                u, v, self.repeat, hit.get_lod(self.normalmap.shape, self.repeat)
+            )
             N_map = (vec3(im[0] - 0.5, im[1] - 0.5, im[2] - 0.5)) * 2.0
             return (
                 N_map.matmul(hit.collider.inverse_basis_matrix).normalize()
@@ -36,9 +37,51 @@ class Material:
             return N_coll * hit.orientation
 
     def set_normalmap(self, normalmap, repeat=1.0):
-        self.normalmap = load_image("sightpy/normalmaps/" + normalmap)
+        self.normalmap = get_texels("sightpy/normalmaps/" + normalmap)
         self.repeat = repeat
 
-    @abstractmethod
+    def get_albedo(self, hit):
+        # color of the surface under white light, for the albedo AOV (see aov.py)
+        return rgb(1.0, 1.0, 1.0)
+
+    def fan_out(self):
+        # largest number of rays scattered per ray hitting the surface, used to size render tiles
+        return 1
+
     def get_color(self, scene, ray, hit):
+        """
+        Computes the color of the surface intersected by the given rays,
+        recursively tracing the rays scattered by the surface.
+
+        Args:
+        - scene: A Scene object containing the list of objects in the scene.
+        - ray: A Ray object containing the origin, direction, and other information of the rays.
+        - hit: A Hit object containing the information of the ray-surface intersection.
+
+        Returns:
+        - A vec3 object containing the color of the surface intersected by the given rays.
+        """
+        color, continuations = self.scatter(scene, ray, hit)
+
+        n = hit.distance.shape[0]
+        for next_ray, weight, parent in continuations:
+            propagate_cones(next_ray, ray, hit, parent)
+            color += (get_raycolor(next_ray, scene) * weight).bincount(parent, n)
+        return color
+
+    @abstractmethod
+    def scatter(self, scene, ray, hit):
+        """
+        Shades the surface intersected by the given rays without tracing further rays.
+
+        Args:
+        - scene: A Scene object containing the list of objects in the scene.
+        - ray: A Ray object containing the origin, direction, and other information of the rays.
+        - hit: A Hit object containing the information of the ray-surface intersection.
+
+        Returns:
+        - A vec3 object containing the color emitted (or directly lit) at the surface.
+        - A list of continuations (next_ray, weight, parent): the rays scattered by the surface,
+          the weight of their color and the index of the ray each of them comes from.
+        """
         pass
@@ -21,9 +21,13 @@ class Refractive(Material):
         # The imaginary part of n is involved in how much light is reflected and absorbed. For non-transparent materials like metals is usually between (0.1j,3j)
         # and for transparent materials like glass is  usually between (0.j , 1e-7j)
 
-    def get_color(self, scene, ray, hit):
+    def fan_out(self):
+        # a reflected and a refracted ray
+        return 2
+
+    def scatter(self, scene, ray, hit):
         """
-        Computes the color of refractive surface intersected by the given ray.
+        Computes the rays reflected and refracted by the refractive surface intersected by the given ray.
 
         Args:
         - scene: A Scene object containing the list of objects in the scene.
@@ -31,7 +35,8 @@ class Refractive(Material):
         - hit: A Hit object containing the information of the ray-surface intersection.
 
         Returns:
-        - A vec3 object containing the color of the diffuse surface intersected by the given ray.
+        - A vec3 object containing the color emitted by the refractive surface (black)
+          and the list of continuations (next_ray, weight, parent) of the reflected and refracted rays.
         """
 
         hit.point = ray.origin + ray.dir * hit.distance  # intersection point
@@ -41,11 +46,17 @@ class Refractive(Material):
 
         V = ray.dir * -1.0  # direction to ray origin
         nudged = hit.point + N * 0.000001  # M nudged to avoid itself
-        
+        continuations = []
+
         # compute reflection and refraction
         # NOTE: Refer to the following material for the formulation.
         # https://graphics.stanford.edu/courses/cs148-10-summer/docs/2006--degreve--reflection_refraction.pdf
         if ray.depth < hit.surface.max_ray_depth:
+            # # TODO: Compute absorption effect
+            # exp(-absorption_coefficient(= 4 * pi * k / lambda) * concentration * travel distnace)
+            absorption = vec3.exp(-4. * np.pi * vec3.imag(ray.n) * 1e9 * hit.distance / vec3(630,550,475))  # the absorption effect
+            parent = np.arange(N.shape()[0])
+
             n1 = ray.n
             n2 = vec3.where(hit.orientation == UPWARDS, self.n, scene.n)
 
@@ -72,7 +83,7 @@ class Refractive(Material):
                 ray.transmissions,
                 ray.diffuse_reflections
             )
-            color += get_raycolor(reflected_ray, scene) * F
+            continuations += [(reflected_ray, F * absorption, parent)]
 
             # # TODO: Compute refraction
             # # color += ... # the color of the refracted ray
@@ -97,10 +108,6 @@ class Refractive(Material):
                     ray.transmissions + 1,
                     ray.diffuse_reflections
                 )
-                color += get_raycolor(refracted_ray, scene) * (1. - F)
-
-            # # TODO: Compute absorption effect
-            # exp(-absorption_coefficient(= 4 * pi * k / lambda) * concentration * travel distnace)
-            color *= vec3.exp(-4. * np.pi * vec3.imag(ray.n) * 1e9 * hit.distance / vec3(630,550,475))  # the absorption effect
-        return color
+                continuations += [(refracted_ray, (1. - F) * absorption, parent)]
+        return color, continuations
 
@@ -5,7 +5,7 @@ from ..ray import Ray, get_raycolor
 from .. import lights
 import numpy as np
 from . import Material
-from ..utils.image_functions import load_image
+from ..utils.image_functions import get_texels
 
 
 class ThinFilmInterference(Material):
@@ -14,20 +14,24 @@ class ThinFilmInterference(Material):
         self.thickness = thickness
 
         # precomputed reflectance vs cosθI (vertical axis) and thickness (horizontal axis)
-        self.thin_film_interference_reflectance = load_image(
+        self.thin_film_interference_reflectance = get_texels(
             "src/textures/thin_film_interference_n=1.4.png"
         )
-        self.thickness_noise = load_image("src/textures/noise.png")
-        self.thickness_noise = self.thickness_noise[:, :, 0]
+        self.thickness_noise = get_texels("src/textures/noise.png")  # first channel
         self.noise_factor = noise
 
-    def get_color(self, scene, ray, hit):
+    def fan_out(self):
+        # a reflected and a refracted ray
+        return 2
+
+    def scatter(self, scene, ray, hit):
 
         hit.point = ray.origin + ray.dir * hit.distance  # intersection point
         N = hit.material.get_Normal(hit)  # normal
 
         # Ambient
         color = rgb(0.0, 0.0, 0.0)
+        continuations = []
 
         V = ray.dir * -1.0  # direction to ray origin
 
@@ -53,6 +57,7 @@ class ThinFilmInterference(Material):
                         ),
                         (u * self.thickness_noise.shape[1] * 0.5).astype(int)
                         % self.thickness_noise.shape[1],
+                        0,
                     ].T
                     - 0.5
                 )
@@ -75,9 +80,10 @@ class ThinFilmInterference(Material):
             reflected_ray_dir = (ray.dir - N * 2.0 * ray.dir.dot(N)).normalize()
 
             nudged = hit.point + N * 0.000001  # M nudged to avoid itself
-            color += (
-                scene.ambient_color
-                + get_raycolor(
+            color += scene.ambient_color * F
+            parent = np.arange(N.shape()[0])
+            continuations += [
+                (
                     Ray(
                         nudged,
                         reflected_ray_dir,
@@ -87,17 +93,18 @@ class ThinFilmInterference(Material):
                         ray.transmissions,
                         ray.diffuse_reflections,
                     ),
-                    scene,
+                    F,
+                    parent,
                 )
-            ) * F
+            ]
 
             # because the film is very thin (nm) we ignore refraction for transmitted ray.
 
             transmitted_ray_dir = ray.dir
             nudged = hit.point - N * 0.000001  # nudged for transmitted ray
             T = 1.0 - F
-            transmitted_color = (
-                get_raycolor(
+            continuations += [
+                (
                     Ray(
                         nudged,
                         transmitted_ray_dir,
@@ -107,9 +114,8 @@ class ThinFilmInterference(Material):
                         ray.transmissions + 1,
                         ray.diffuse_reflections,
                     ),
-                    scene,
+                    T,
+                    parent,
                 )
-                * T
-            )
-            color += transmitted_color
-        return color
+            ]
+        return color, continuations
@@ -0,0 +1,175 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from multiprocessing.shared_memory import SharedMemory
+import threading
+import time
+import numpy as np
+from .framebuffer import Framebuffer
+from .utils.buffer_pool import BufferPool
+from .utils.random import thread_random_state
+
+
+# Tiles of a render are traced by a pool of processes.
+# The scene is handed to every worker once, when the pool starts (inherited by fork
+# or pickled once by spawn), and the workers write the samples of their tiles directly
+# into a framebuffer in shared memory. Tiles never overlap; the lock only keeps a tile
+# from being written while the framebuffer is copied (see Checkpointer).
+# Tiles are handed out one at a time, so a worker that is done takes the next pending tile.
+#
+# Tiles can also be traced by a pool of threads sharing the scene and the framebuffer.
+# Nothing is copied, and the threads overlap while NumPy kernels release the GIL.
+# Each thread draws the random numbers of its tile from its own random state, seeded like the tiles
+# of the processes. A task can be a slice of the samples of a tile (see Scene.render).
+# Both return the CPU time spent in the tiles, which over the elapsed time gives the utilization
+# of the workers (not the speedup, see Scene.render_stats).
+
+
+# state of the current worker process, set by init_worker
+worker = {}
+
+
+def init_worker(scene, get_color, shared_memory_name, width, height, aovs, lock):
+    shared_memory = SharedMemory(name=shared_memory_name)
+    scene.pool = BufferPool()  # each process has its own scratch buffers
+    worker["scene"] = scene
+    worker["get_color"] = get_color
+    worker["shared_memory"] = shared_memory
+    worker["framebuffer"] = Framebuffer(
+        width, height, buffer=shared_memory.buf, aovs=aovs
+    )
+    worker["lock"] = lock
+
+
+def render_tile_task(task):
+    pixel_index, samples_per_pixel, seed, first_sample = task
+    t0 = time.process_time()
+    worker["scene"].render_tile(
+        worker["framebuffer"],
+        pixel_index,
+        samples_per_pixel,
+        worker["get_color"],
+        seed,
+        worker["lock"],
+        first_sample,
+    )
+    return time.process_time() - t0
+
+
+def tile_seed(seed, tile, samples_done):
+    """
+    Returns an independent seed for the samples of a tile, derived from seed with np.random.SeedSequence.
+    The random numbers of a tile only depend on seed, on the index of the tile and on the number of samples
+    it already has (so a resumed render doesn't repeat them), not on the worker that renders it.
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+    return np.random.SeedSequence(
+        entropy, spawn_key=(tile, samples_done)
+    ).generate_state(4)
+
+
+def render_parallel(
+    scene, get_color, framebuffer, tasks, workers, progress_bar=None, on_tile_done=None
+):
+    """
+    Renders tiles with a pool of worker processes.
+
+    Args:
+    - scene: A finalized Scene object.
+    - get_color: The function computing the color of a batch of rays (get_raycolor or get_raycolor_wavefront).
+    - framebuffer: The Framebuffer object the samples are added to.
+    - tasks: A list of (pixel indices, number of samples, seed, first sample) tuples (see Scene.render_tile).
+    - workers: The number of worker processes.
+    - progress_bar: An optional progressbar.ProgressBar, updated when a tile is done.
+    - on_tile_done: An optional function called with the framebuffer and the lock when a tile is done.
+
+    Returns:
+    - A Framebuffer object with the samples of all the tiles.
+    - The CPU time spent by the workers in the tiles.
+    """
+    width, height = framebuffer.width, framebuffer.height
+    aovs = list(framebuffer.aovs)
+    shared_memory = SharedMemory(
+        create=True, size=Framebuffer.nbytes(width, height, aovs)
+    )
+    shared = Framebuffer(width, height, buffer=shared_memory.buf, aovs=aovs)
+    try:
+        shared.color[:] = framebuffer.color
+        shared.square[:] = framebuffer.square
+        shared.samples[:] = framebuffer.samples
+        for name, data in framebuffer.aovs.items():
+            shared.aovs[name][:] = data
+        lock = multiprocessing.Lock()
+
+        cpu_time = 0.0
+        with multiprocessing.Pool(
+            workers,
+            initializer=init_worker,
+            initargs=(scene, get_color, shared_memory.name, width, height, aovs, lock),
+        ) as pool:
+            done = pool.imap_unordered(render_tile_task, tasks, chunksize=1)
+            if progress_bar is not None:
+                done = progress_bar(done)
+            for tile_time in done:
+                cpu_time += tile_time
+                if on_tile_done is not None:
+                    on_tile_done(shared, lock)
+
+        return shared.copy(), cpu_time
+    finally:
+        del shared  # the views of the shared memory must be released before closing it
+        shared_memory.close()
+        shared_memory.unlink()
+
+
+def render_threaded(
+    scene, get_color, framebuffer, tasks, threads, progress_bar=None, on_tile_done=None
+):
+    """
+    Renders tiles with a pool of threads sharing the scene.
+
+    Args:
+    - scene: A finalized Scene object.
+    - get_color: The function computing the color of a batch of rays (get_raycolor or get_raycolor_wavefront).
+    - framebuffer: The Framebuffer object the samples are added to.
+    - tasks: A list of (pixel indices, number of samples, seed, first sample) tuples (see Scene.render_tile).
+    - threads: The number of threads.
+    - progress_bar: An optional progressbar.ProgressBar, updated when a tile is done.
+    - on_tile_done: An optional function called with the framebuffer and the lock when a tile is done.
+
+    Returns:
+    - The framebuffer.
+    - The CPU time spent by the threads in the tiles.
+    """
+    lock = threading.Lock()
+
+    def render_tile(task):
+        pixel_index, samples_per_pixel, seed, first_sample = task
+        if scene.pool is None:
+            scene.pool = BufferPool()  # scene.pool is per thread
+        t0 = time.thread_time()
+        with thread_random_state():
+            scene.render_tile(
+                framebuffer,
+                pixel_index,
+                samples_per_pixel,
+                get_color,
+                seed,
+                lock,
+                first_sample,
+            )
+        return time.thread_time() - t0
+
+    cpu_time = 0.0
+    try:
+        with ThreadPool(threads) as pool:
+            done = pool.imap_unordered(render_tile, tasks, chunksize=1)
+            if progress_bar is not None:
+                done = progress_bar(done)
+            for tile_time in done:
+                cpu_time += tile_time
+                if on_tile_done is not None:
+                    on_tile_done(framebuffer, lock)
+    finally:
+        scene.pools.clear()
+
+    return framebuffer, cpu_time
@@ -1,5 +1,6 @@
 from .utils.constants import *
-from .utils.vector3 import vec3, extract, rgb
+from .utils.vector3 import vec3, extract, rgb, concatenate
+from .geometry.bvh import batch_size
 import numpy as np
 from functools import reduce as reduce
 
@@ -8,7 +9,17 @@ class Ray:
     """Info of the ray and the media it's travelling"""
 
     def __init__(
-        self, origin, dir, depth, n, reflections, transmissions, diffuse_reflections
+        self,
+        origin,
+        dir,
+        depth,
+        n,
+        reflections,
+        transmissions,
+        diffuse_reflections,
+        bsdf_pdf=None,
+        cone_width=None,
+        cone_spread=None,
     ):
 
         self.origin = origin  # the point where the ray comes from
@@ -28,6 +39,17 @@ class Ray:
         self.transmissions = transmissions  # transmissions is the number of the transmissions/refractions, starting at zero for camera rays
         self.diffuse_reflections = diffuse_reflections  # reflections is the number of the refrections, starting at zero for camera rays
 
+        # For rays scattered by a surface that also sampled the area lights (next event estimation),
+        # the probability density of their direction, so the light they hit is weighted by multiple
+        # importance sampling. None (or 0 for a ray of a concatenated batch) for the other rays.
+        self.bsdf_pdf = bsdf_pdf
+
+        # Ray cones (Akenine-Moller et al. 2019), tracked to pick the mip level of the textures:
+        # the width of the cone of every ray at its origin and its spread angle (radians), or None.
+        # They start at the camera with the angle of a pixel and are carried by the scattered rays.
+        self.cone_width = cone_width
+        self.cone_spread = cone_spread
+
     def extract(self, hit_check):
         return Ray(
             self.origin.extract(hit_check),
@@ -37,41 +59,186 @@ class Ray:
             self.reflections,
             self.transmissions,
             self.diffuse_reflections,
+            None if self.bsdf_pdf is None else np.extract(hit_check, self.bsdf_pdf),
+            None if self.cone_width is None else np.extract(hit_check, self.cone_width),
+            None if self.cone_spread is None else np.extract(hit_check, self.cone_spread),
+        )
+
+    def take(self, index):
+        return Ray(
+            self.origin.take(index),
+            self.dir.take(index),
+            self.depth,
+            self.n.take(index),
+            self.reflections,
+            self.transmissions,
+            self.diffuse_reflections,
+            None if self.bsdf_pdf is None else self.bsdf_pdf[index],
+            None if self.cone_width is None else self.cone_width[index],
+            None if self.cone_spread is None else self.cone_spread[index],
+        )
+
+    def counters(self):
+        return (self.depth, self.reflections, self.transmissions, self.diffuse_reflections)
+
+    def concatenate(rays):
+        # the rays must have the same counters
+        sizes = [batch_size(r.origin, r.dir) for r in rays]
+        bsdf_pdf = None
+        if any(r.bsdf_pdf is not None for r in rays):
+            bsdf_pdf = np.concatenate(
+                [
+                    np.zeros(size) if r.bsdf_pdf is None else r.bsdf_pdf
+                    for r, size in zip(rays, sizes)
+                ]
+            )
+        cone_width, cone_spread = None, None
+        if all(r.cone_width is not None for r in rays):
+            cone_width = np.concatenate([r.cone_width for r in rays])
+            cone_spread = np.concatenate([r.cone_spread for r in rays])
+        return Ray(
+            concatenate([r.origin for r in rays], sizes),
+            concatenate([r.dir for r in rays], sizes),
+            rays[0].depth,
+            concatenate([r.n for r in rays], sizes),
+            rays[0].reflections,
+            rays[0].transmissions,
+            rays[0].diffuse_reflections,
+            bsdf_pdf,
+            cone_width,
+            cone_spread,
         )
 
 
 class Hit:
     """Info of the ray-surface intersection"""
 
-    def __init__(self, distance, orientation, material, collider, surface):
+    def __init__(self, distance, orientation, material, collider, surface, primitive_id=None, colliders=None, collider_index=None):
         self.distance = distance
         self.orientation = orientation
         self.material = material
         self.collider = collider
         self.surface = surface
+        self.primitive_id = primitive_id  # e.g. index of the hit triangle of a mesh
         self.u = None
         self.v = None
         self.N = None
         self.point = None
 
+        # A hit can merge the rays of several colliders sharing the same material.
+        # In that case collider is None, and collider_index tells which of the colliders was hit by each ray.
+        self.colliders = [collider] if colliders is None else colliders
+        self.collider_index = collider_index
+
+        # with ray cones: the width of the cones at the hit point and the direction of the rays (see get_lod)
+        self.cone_width = None
+        self.incident = None
+        self.footprint = None
+
+    def split(self):
+        """Yields the indices of the rays and a single-collider Hit for every collider of a merged hit."""
+        for k, c in enumerate(self.colliders):
+            index = np.nonzero(self.collider_index == k)[0]
+            if index.size == 0:
+                continue
+            hit = Hit(self.distance[index], self.orientation[index], self.material, c, c.assigned_primitive, self.primitive_id[index])
+            if self.point is not None:
+                hit.point = self.point.take(index)
+            if self.cone_width is not None:
+                hit.cone_width, hit.incident = self.cone_width[index], self.incident.take(index)
+            yield index, hit
+
+    def moved(self, point):
+        """Returns a copy of the hit at other points (e.g. to evaluate the texture coordinates around the hit)."""
+        hit = Hit(self.distance, self.orientation, self.material, self.collider, self.surface, self.primitive_id, self.colliders, self.collider_index)
+        hit.point = point
+        return hit
+
+    def map(self, f):
+        """Evaluates f (which returns a vec3 or a tuple of arrays) on every collider of a merged hit and merges the results."""
+        n = self.distance.shape[0]
+        out = None
+        for index, hit in self.split():
+            r = f(hit)
+            if out is None:
+                out = rgb(np.zeros(n), np.zeros(n), np.zeros(n)) if isinstance(r, vec3) else tuple(np.zeros(n) for _ in r)
+            if isinstance(r, vec3):
+                out.put(index, r)
+            else:
+                for o, x in zip(out, r):
+                    o[index] = x
+        return out
+
     def get_uv(self):
         if self.u is None:  # this is for prevent multiple computations of u,v
-            self.u, self.v = self.collider.assigned_primitive.get_uv(self)
+            if self.collider is None:
+                self.u, self.v = self.map(lambda hit: hit.get_uv())
+            else:
+                self.u, self.v = self.collider.assigned_primitive.get_uv(self)
         return self.u, self.v
 
+    def get_footprint(self):
+        """
+        Returns the texture coordinates (du1, dv1, du2, dv2) spanned by the two axes of the ellipse where the ray cones
+        meet the surface: the major axis (the width of the cone over the cosine of the incidence angle)
+        along the projection of the ray on the surface and the minor axis (the width of the cone) across it.
+        They're finite differences of get_uv, so they work for any primitive: each axis is evaluated on both
+        sides of the hit and the smallest change is kept, so the seams of the texture coordinates don't count.
+        """
+        if self.footprint is None:
+            N = self.get_normal()
+            D = self.incident
+            cosine = np.abs(D.dot(N))
+            major = D - N * D.dot(N)
+            length = major.length()
+            # rays along the normal have no major direction: any tangent will do
+            other = vec3.where(np.abs(N.x) < 0.9, vec3(1.0, 0.0, 0.0), vec3(0.0, 1.0, 0.0))
+            major = vec3.where(length > 1e-6, major / np.maximum(length, 1e-6), N.cross(other).normalize())
+            minor = N.cross(major)
+
+            u, v = self.get_uv()
+            footprint = []
+            for axis, width in ((major, self.cone_width / np.maximum(cosine, 1e-3)), (minor, self.cone_width)):
+                du, dv = np.inf, np.inf
+                for side in (1.0, -1.0):
+                    u1, v1 = self.moved(self.point + axis * (width * side)).get_uv()
+                    # texture coordinates wrap around
+                    du = np.fmin(du, np.abs((u1 - u + 0.5) % 1.0 - 0.5))
+                    dv = np.fmin(dv, np.abs((v1 - v + 0.5) % 1.0 - 0.5))
+                footprint += [np.nan_to_num(du), np.nan_to_num(dv)]
+            self.footprint = tuple(footprint)
+        return self.footprint
+
+    def get_lod(self, shape, repeat=1.0):
+        """
+        Returns the mip level of every lookup of a texture of the given shape (height, width, ...) repeated
+        repeat times: the log2 of the size of the footprint of the ray cone in texels (the geometric mean of its axes,
+        so the lookups are isotropic but keep the area of the footprint). None without ray cones.
+        """
+        if self.cone_width is None:
+            return None
+        du1, dv1, du2, dv2 = self.get_footprint()
+        height, width = shape[0] * repeat, shape[1] * repeat
+        texels = np.sqrt(np.hypot(du1 * width, dv1 * height) * np.hypot(du2 * width, dv2 * height))
+        return np.log2(np.maximum(texels, 1e-12))
+
     def get_normal(self):
         if self.N is None:  # this is for prevent multiple computations of normal
-            self.N = self.collider.get_N(self)
+            if self.collider is None:
+                self.N = self.map(lambda hit: hit.get_normal())
+            else:
+                self.N = self.collider.get_Normal(self)
         return self.N
 
 
-def get_raycolor(ray, scene) -> vec3:
+def get_raycolor(ray, scene, aovs=None) -> vec3:
     """
     Computes the color of the ray after it intersects with the scene.
 
     Args:
     - ray: A Ray object containing the origin, direction, and other information of the rays.
     - scene: A Scene object containing the list of objects in the scene.
+    - aovs: An optional AOVSamples object (see aov.py) recording the first hit of the rays.
 
     Returns:
     - A vec3 object containing the color of the ray after it intersects with the scene.
@@ -84,38 +251,91 @@ def get_raycolor(ray, scene) -> vec3:
     # performing a ray-object intersection check 
     # and initiating recursive ray tracing for reflection and refraction, 
     # depending on the material characteristic of the surface.
-    intersections = [c.intersect(ray.origin, ray.dir) for c in scene.collider_list]
-    distances, orientations = list(zip(*intersections))
-    
-    # find first object ray is intersecting
-    first_hit_distance = reduce(np.minimum, distances)
-    
+
     # initiate color to accumulate
-    color = rgb(0., 0., 0.)
-
-    # for all objects collided in scene
-    for (d, o, c) in zip(distances, orientations, scene.collider_list):
-        # mask to select rays that actually collides & which is first collision (non-first will be handeled by recursive hit...)
-        hit_mask = (first_hit_distance!=FARAWAY) & (d==first_hit_distance)
-        if not np.any(hit_mask):
-            pass
-
-        first_hit = Hit(extract(hit_mask,d), extract(hit_mask,o), c.assigned_primitive.material, c, c.assigned_primitive)
-        cumulated_color = c.assigned_primitive.material.get_color(scene, ray.extract(hit_mask), first_hit) #recursively get material & color
-        color += cumulated_color.place(hit_mask)
+    n = batch_size(ray.origin, ray.dir)
+    color = rgb(np.zeros(n), np.zeros(n), np.zeros(n))
+
+    # for all materials collided in scene
+    for index, first_hit in get_hits(ray, scene):
+        hit_ray = ray.take(index)
+        if aovs is not None:
+            aovs.record(index, scene, hit_ray, first_hit)
+        cumulated_color = first_hit.material.get_color(scene, hit_ray, first_hit) #recursively get material & color
+        color.put(index, cumulated_color)
         
     return color
 
-def get_distances(
-    ray, scene
-):  # Used for debugging ray-surface collisions. Return a grey map of objects distances.
+def propagate_cones(next_ray, ray, hit, parent):
+    """
+    Gives the rays scattered by a surface the ray cones of the rays hitting it (see Ray):
+    they start with the width of the cones at the hit, and a diffuse bounce widens their spread
+    by the angle of the share of the hemisphere sampled by each of them.
+
+    Args:
+    - next_ray: The Ray object of the scattered rays.
+    - ray, hit: The rays hitting the surface and their Hit object.
+    - parent: The index of the ray each scattered ray comes from.
+    """
+    if hit.cone_width is None:
+        return
+    next_ray.cone_width = hit.cone_width[parent]
+    next_ray.cone_spread = ray.cone_spread[parent]
+    if next_ray.diffuse_reflections > ray.diffuse_reflections:
+        rays_per_hit = max(parent.shape[0] / max(hit.distance.shape[0], 1), 1.0)
+        next_ray.cone_spread = next_ray.cone_spread + np.sqrt(2 * np.pi / rays_per_hit)
+
 
-    inters = [s.intersect(ray.origin, ray.dir) for s in scene.collider_list]
-    distances, hit_orientation = zip(*inters)
-    # get the shortest distance collision
-    nearest = reduce(np.minimum, distances)
+def get_hits(ray, scene):
+    """
+    Intersects the rays with the scene and groups them by the material they hit.
+
+    Args:
+    - ray: A Ray object containing the origin, direction, and other information of the rays.
+    - scene: A Scene object containing the list of objects in the scene.
 
-    max_r_distance = 10
-    r_distance = np.where(nearest <= max_r_distance, nearest, max_r_distance)
-    norm_r_distance = r_distance / max_r_distance
-    return rgb(norm_r_distance, norm_r_distance, norm_r_distance)
+    Yields:
+    - The indices of the rays of each non-empty shading group and a Hit object with their first intersection.
+      Rays that hit nothing are not yielded.
+    """
+    # the scene BVH returns the first object each ray is intersecting
+    first_hit_distance, first_hit_orientation, first_hit_collider, first_hit_primitive = scene.intersect(ray.origin, ray.dir)
+
+    # partition the rays by the shading group (material) of their first hit collider with a single sort.
+    # Rays that hit nothing are in group -1 and are sorted first.
+    first_hit_group = scene.collider_group[first_hit_collider]
+    order = np.argsort(first_hit_group, kind="stable")
+    ends = np.cumsum(np.bincount(first_hit_group + 1, minlength=len(scene.shading_groups) + 1))
+
+    # only non-empty groups
+    for g in np.nonzero(np.diff(ends))[0]:
+        material, colliders = scene.shading_groups[g]
+        index = order[ends[g] : ends[g + 1]]  # rays whose first collision has this material
+
+        first_hit = Hit(
+            first_hit_distance[index],
+            first_hit_orientation[index],
+            material,
+            colliders[0] if len(colliders) == 1 else None,
+            colliders[0].assigned_primitive,
+            first_hit_primitive[index],
+            colliders=colliders,
+            collider_index=scene.collider_group_position[first_hit_collider[index]],
+        )
+        if ray.cone_width is not None:
+            first_hit.cone_width = ray.cone_width[index] + ray.cone_spread[index] * first_hit.distance
+            first_hit.incident = ray.dir.take(index)
+        yield index, first_hit
+
+def get_aovs(ray, scene, aovs=None):
+    """
+    Only intersects the camera rays, to record their AOVs (see aov.py) without shading them.
+
+    Returns:
+    - A black vec3 object, the rays aren't shaded.
+    """
+    if aovs is not None:
+        for index, hit in get_hits(ray, scene):
+            aovs.record(index, scene, ray.take(index), hit)
+    n = batch_size(ray.origin, ray.dir)
+    return rgb(np.zeros(n), np.zeros(n), np.zeros(n))
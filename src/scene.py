@@ -1,14 +1,31 @@
 from PIL import Image
 import numpy as np
 import time
+import threading
+import contextlib
 from .utils import colour_functions as cf
 from .camera import Camera
 from .utils.constants import *
 from .utils.vector3 import vec3, rgb
-from .ray import Ray, get_raycolor, get_distances
+from .ray import Ray, get_raycolor, get_aovs
+from .wavefront import get_raycolor_wavefront
 from . import lights
 from .backgrounds.skybox import SkyBox
 from .backgrounds.panorama import Panorama
+from .geometry.bvh import ColliderBVH, batch_size
+from .utils.buffer_pool import BufferPool
+from .utils.sampler import RandomSampler, samplers
+from .utils.random import seed_random, thread_random_state
+from .framebuffer import Framebuffer
+from .aov import AOVSamples, aov_image
+from .denoise import FEATURES, denoise_framebuffer
+from .parallel import render_parallel, render_threaded, tile_seed
+from .checkpoint import Checkpointer, has_checkpoint, load_checkpoint
+from .hdr import save_hdr
+
+
+# ray tracing engines, by name
+engines = {"recursive": get_raycolor, "wavefront": get_raycolor_wavefront, "aov": get_aovs}
 
 
 class Scene:
@@ -23,6 +40,29 @@ class Scene:
         self.ambient_color = ambient_color
         self.n = n
         self.importance_sampled_list = []
+        self.bvh = None
+        self.shadow_bvh = None
+        self.area_light_list = []
+        self.pools = {}  # scratch buffers of the current render, one per thread
+        self.render_stats = None
+        self.framebuffer = None  # linear accumulation buffer of the last render
+        self.sampler = RandomSampler()  # random numbers of the paths, set by render
+        self.texture_lod = False  # whether the camera rays carry ray cones, set by render
+        # whether the primitives don't move anymore: finalize then keeps the acceleration structures
+        # it built, which are shared by the copies of the scene (see service.py)
+        self.static = False
+
+    @property
+    def pool(self):
+        # BufferPool of the calling thread (a pool can't be shared between threads)
+        return self.pools.get(threading.get_ident())
+
+    @pool.setter
+    def pool(self, pool):
+        if pool is None:
+            self.pools.pop(threading.get_ident(), None)
+        else:
+            self.pools[threading.get_ident()] = pool
 
     def add_Camera(self, look_from, look_at, **kwargs):
         self.camera = Camera(look_from, look_at, **kwargs)
@@ -43,6 +83,8 @@ class Scene:
         if primitive.shadow == True:
             self.shadowed_collider_list += primitive.collider_list
 
+        self.bvh = None
+
     def add_Background(self, img, light_intensity=0.0, blur=0.0, spherical=False):
 
         primitive = None
@@ -53,14 +95,346 @@ class Scene:
 
         self.scene_primitives += [primitive]
         self.collider_list += primitive.collider_list
+        self.bvh = None
+
+    def finalize(self):
+        # build the acceleration structures once the scene is complete.
+        # It's rebuilt on every render, so primitives can be moved between frames, unless the scene is static.
+        if self.static and self.bvh is not None:
+            return
+        self.bvh = ColliderBVH(self.collider_list)
+        self.shadow_bvh = ColliderBVH(self.shadowed_collider_list)
+
+        # group the colliders by material, so each material is shaded once per bounce.
+        # Materials compare the ray depth against the primitive max_ray_depth,
+        # so primitives with a different max_ray_depth are kept in separate groups.
+        groups = {}
+        self.shading_groups = []
+        self.collider_group = np.full(len(self.collider_list) + 1, -1)  # last entry: rays that hit nothing (-1)
+        self.collider_group_position = np.zeros(len(self.collider_list) + 1, dtype=int)
+        for i, c in enumerate(self.collider_list):
+            key = (id(c.assigned_primitive.material), c.assigned_primitive.max_ray_depth)
+            if key not in groups:
+                groups[key] = len(self.shading_groups)
+                self.shading_groups += [(c.assigned_primitive.material, [])]
+            g = groups[key]
+            self.collider_group[i] = g
+            self.collider_group_position[i] = len(self.shading_groups[g][1])
+            self.shading_groups[g][1].append(c)
+
+        # area lights: the importance sampled emissive primitives, sampled by the diffuse surfaces
+        # (next event estimation). For every collider, the index of its light (-1 if it isn't one)
+        # and its position in the colliders of the light.
+        self.area_light_list = [
+            p for p in self.importance_sampled_list if p.material.emissive
+        ]
+        self.collider_area_light = np.full(len(self.collider_list) + 1, -1)
+        self.collider_area_light_position = np.zeros(
+            len(self.collider_list) + 1, dtype=int
+        )
+        for i, c in enumerate(self.collider_list):
+            for k, light in enumerate(self.area_light_list):
+                if c.assigned_primitive is light:
+                    self.collider_area_light[i] = k
+                    self.collider_area_light_position[i] = light.collider_list.index(c)
+
+        # ids of the AOVs (see aov.py): the index of every collider, and for every collider,
+        # the index of its primitive in scene_primitives and of its material in material_list
+        self.collider_id = {id(c): i for i, c in enumerate(self.collider_list)}
+        primitive_id = {id(p): i for i, p in enumerate(self.scene_primitives)}
+        self.material_list = []
+        material_id = {}
+        for p in self.scene_primitives:
+            if id(p.material) not in material_id:
+                material_id[id(p.material)] = len(self.material_list)
+                self.material_list += [p.material]
+        self.collider_primitive = np.array(
+            [primitive_id[id(c.assigned_primitive)] for c in self.collider_list], dtype=int
+        )
+        self.collider_material = np.array(
+            [material_id[id(c.assigned_primitive.material)] for c in self.collider_list], dtype=int
+        )
+
+    def intersect(self, O, D):
+        """Returns distance, orientation, collider index and primitive id of the nearest hit."""
+        if self.bvh is None:
+            self.finalize()
+        return self.bvh.intersect(O, D, pool=self.pool)
+
+    def intersect_shadow(self, O, D):
+        """Same as intersect, for the colliders that cast shadows."""
+        if self.shadow_bvh is None:
+            self.finalize()
+        return self.shadow_bvh.intersect(O, D, pool=self.pool)
+
+    def get_tiles(self, tile_size=None, memory_budget=None):
+        """
+        Splits the screen in square tiles of pixels that are rendered independently.
+
+        Args:
+        - tile_size: The width and height of the tiles, in pixels.
+        - memory_budget: The approximate peak memory of a tile, in megabytes.
+          It's used to compute the tile size if none is given.
 
-    def render(self, samples_per_pixel, progress_bar=False):
+        Returns:
+        - A list with the pixel indices of each tile, or [None] for a single tile covering the screen.
+        """
+        W, H = self.camera.screen_width, self.camera.screen_height
+        if tile_size is None:
+            if memory_budget is None:
+                return [None]
+            # every camera ray can be multiplied by the materials that scatter several rays
+            fan_out = max([p.material.fan_out() for p in self.scene_primitives] + [1])
+            tile_pixels = memory_budget * 2**20 / (RAY_MEMORY * fan_out)
+            tile_size = max(1, int(np.sqrt(tile_pixels)))
+
+        tiles = []
+        for row in range(0, H, tile_size):
+            for column in range(0, W, tile_size):
+                rows = np.arange(row, min(row + tile_size, H))
+                columns = np.arange(column, min(column + tile_size, W))
+                tiles += [(rows[:, None] * W + columns).ravel()]
+        return tiles
+
+    def render_tile(self, framebuffer, pixel_index, samples_per_pixel, get_color, seed=None, lock=None, first_sample=None):
+        """
+        Adds samples_per_pixel samples of the given pixels to the framebuffer.
+        The samples are summed first and added at once, while holding lock if one is given.
+        first_sample is the index of the first sample for the sampler, by default the number of samples
+        the pixels already have (slices of the samples of a tile rendered at the same time give theirs).
+        """
+        if seed is not None:
+            seed_random(seed)
+
+        # samples already taken by each pixel: the index of its next sample for the sampler
+        if first_sample is not None:
+            samples = first_sample
+        else:
+            samples = framebuffer.samples if pixel_index is None else framebuffer.samples[pixel_index]
+
+        color, square, aovs = None, None, None
+        for i in range(samples_per_pixel):
+            ray = self.camera.get_ray(
+                self.n,
+                pool=self.pool,
+                pixel_index=pixel_index,
+                sampler=self.sampler,
+                sample_index=samples + i,
+                ray_cones=self.texture_lod,
+            )
+            if framebuffer.aovs:
+                # the first hits of the camera rays are recorded by the engine
+                sample_aovs = AOVSamples(framebuffer.aovs, batch_size(ray.origin, ray.dir), first=samples + i == 0)
+                sample = get_color(ray, scene=self, aovs=sample_aovs)
+                if aovs is None:
+                    aovs = sample_aovs.data
+                else:
+                    for name, data in sample_aovs.data.items():
+                        aovs[name] += data
+            else:
+                sample = get_color(ray, scene=self)
+            if color is None:
+                color, square = sample, sample.to_array() ** 2
+            else:
+                color += sample
+                square += sample.to_array() ** 2
+        if color is None:
+            return
+
+        with lock if lock is not None else contextlib.nullcontext():
+            framebuffer.add(color, pixel_index, samples_per_pixel, square, aovs)
+
+    def sample_adaptive(self, framebuffer, samples_per_pixel, get_color, noise_threshold, batch_size, update):
+        """
+        Adds samples to the pixels that haven't converged, one sample per pass, until every pixel's
+        relative error (Framebuffer.get_error) is below noise_threshold or the budget of
+        samples_per_pixel samples per pixel on average is spent. When the budget left is smaller
+        than the number of active pixels, the least sampled ones are sampled.
+        Only the active pixels are traced in each pass. update is called with the framebuffer after each batch.
+        Returns the number of passes.
+        """
+        budget = samples_per_pixel * framebuffer.samples.size
+        passes = 0
+        while True:
+            remaining = budget - int(framebuffer.samples.sum())
+            error = framebuffer.get_error()
+            active = np.nonzero(error > noise_threshold)[0]
+            if active.size == 0 or remaining <= 0:
+                break
+            if active.size > remaining:
+                # the least sampled pixels first (the noisiest of them first), so a few
+                # fireflies can't take the whole budget
+                order = np.lexsort((-error[active], framebuffer.samples[active]))
+                active = np.sort(active[order[:remaining]])
+
+            # the samples of the active pixels at most double in a pass, within the budget
+            samples = max(1, min(remaining // active.size, framebuffer.get_samples(active)))
+            for start in range(0, active.size, batch_size):
+                self.render_tile(framebuffer, active[start : start + batch_size], samples, get_color)
+                update(framebuffer)
+            passes += 1
+        return passes
+
+    def serial_samples_per_second(self, get_color, aovs, tiles, count=4):
+        """
+        Returns the number of samples per second of a serial render of the scene, measured by tracing
+        one sample of a few tiles spread over the screen (count at most) into a scratch framebuffer,
+        on the calling thread and with its own random state (the render itself isn't affected).
+        """
+        W, H = self.camera.screen_width, self.camera.screen_height
+        tiles = tiles[:: -(-len(tiles) // count)]
+        scratch = Framebuffer(W, H, aovs=aovs)
+        self.pool = BufferPool()
+        try:
+            with thread_random_state():
+                t0 = time.time()
+                for pixel_index in tiles:
+                    self.render_tile(scratch, pixel_index, 1, get_color, first_sample=0)
+                return int(scratch.samples.sum()) / max(time.time() - t0, 1e-9)
+        finally:
+            self.pool = None
+
+    def render(
+        self,
+        samples_per_pixel,
+        progress_bar=False,
+        engine="recursive",
+        tile_size=None,
+        memory_budget=None,
+        workers=None,
+        threads=None,
+        seed=None,
+        checkpoint=None,
+        checkpoint_interval=600.0,
+        resume=False,
+        adaptive=False,
+        noise_threshold=0.01,
+        min_samples=4,
+        on_update=None,
+        sampler="random",
+        denoise=False,
+        aovs=(),
+        hdr_output=None,
+        tonemap="clip",
+        exposure=0.0,
+        texture_lod=False,
+    ):
+        # engine: "recursive" traces the scattered rays depth first (get_raycolor),
+        # "wavefront" traces them one generation per bounce (get_raycolor_wavefront), bounding the memory.
+        # "aov" only intersects the camera rays to record the AOVs (get_aovs), the image is black.
+        # tile_size, memory_budget: render the screen in tiles (see get_tiles), so the memory of a render
+        # depends on the tile size instead of the resolution.
+        # workers: render the tiles with this number of processes (see parallel.py).
+        # threads: render the tiles with this number of threads sharing the scene (see parallel.py).
+        # When there are fewer than two tiles per thread, the samples of the tiles are split in slices.
+        # seed: seed of the random numbers. Every tile (or slice) gets its own seed, so a render is
+        # reproducible whatever the number of workers or threads.
+        # checkpoint: path (without extension) where the linear framebuffer is saved every
+        # checkpoint_interval seconds and at the end of the render (see checkpoint.py).
+        # resume: continue from the checkpoint if it exists. samples_per_pixel is the total number
+        # of samples, so only the missing samples are rendered: rerunning a killed render finishes it,
+        # and rerunning with more samples_per_pixel refines it.
+        # adaptive: every pixel gets min_samples samples, then the budget of samples_per_pixel samples
+        # per pixel on average is spent on the pixels whose relative error is above noise_threshold
+        # (see sample_adaptive).
+        # on_update: function called with the framebuffer each time samples are added to it
+        # (after each pass, or each tile with workers or threads), e.g. to show a progressive preview.
+        # With workers or threads, no tile is added to the framebuffer during the call, so it should be short
+        # (e.g. copy the framebuffer only when the preview is due).
+        # sampler: "random", "stratified", "halton", "sobol" or "blue_noise" (see sampler.py), or a Sampler object.
+        # It positions the camera rays and the rays scattered by diffuse surfaces.
+        # denoise: filter the image with the albedo, normal and depth of the first hits, recorded
+        # with the samples (see denoise.py). A few samples per pixel then give a clean image.
+        # aovs: names of AOVs (see aov.py) recorded from the first hits of the camera rays while rendering.
+        # The render then returns the image and a dict of the AOVs, arrays of shape (height, width, channels).
+        # hdr_output: path (.npy or .pfm) where the average linear color and the sample count of every pixel
+        # are saved as float32 (see hdr.py), before denoising, so renders of the same image can be merged.
+        # The framebuffer of the last render is also kept in self.framebuffer.
+        # tonemap, exposure: the tone mapping of the returned 8-bit image (see colour_functions.tonemap).
+        # texture_lod: the rays carry ray cones from the camera through the bounces (see Ray), so the texture,
+        # skybox and normal map lookups blend the mip levels of their footprint instead of aliasing.
 
         print("Rendering...")
 
         t0 = time.time()
-        color_RGBlinear = rgb(0.0, 0.0, 0.0)
+        self.finalize()
+        if isinstance(sampler, str):
+            sampler = samplers[sampler](samples_per_pixel, seed if seed is not None else 0)
+        self.sampler = sampler
+        self.texture_lod = texture_lod
+        get_color = engines[engine]
+        W, H = self.camera.screen_width, self.camera.screen_height
+
+        processes = workers is not None and workers > 1
+        threaded = threads is not None and threads > 1
+        if processes and threaded:
+            raise ValueError("workers and threads can't be used together")
+        if adaptive and (processes or threaded):
+            raise ValueError("adaptive sampling doesn't support workers or threads")
+
+        outputs = tuple(aovs)
+        aovs = outputs + tuple(name for name in FEATURES if denoise and name not in outputs)
+        framebuffer = Framebuffer(W, H, aovs=aovs)
+        if resume and checkpoint is not None and has_checkpoint(checkpoint):
+            framebuffer, metadata = load_checkpoint(checkpoint)
+            if (framebuffer.width, framebuffer.height) != (W, H):
+                raise ValueError(
+                    "the checkpoint is a %dx%d render, the camera is %dx%d" % (framebuffer.width, framebuffer.height, W, H)
+                )
+            if any(name not in framebuffer.aovs for name in aovs):
+                raise ValueError("the checkpoint doesn't have the AOVs " + ", ".join(aovs))
+            if seed is None:
+                seed = metadata["seed"]
+            if progress_bar:
+                print("Resuming from", checkpoint, "with", framebuffer.samples.mean(), "samples per pixel")
 
+        tiles = self.get_tiles(tile_size, memory_budget)
+        if (processes or threaded) and tiles[0] is None:
+            tiles = self.get_tiles(tile_size=64)
+
+        # samples already in each tile (0 unless resumed)
+        samples_done = [framebuffer.get_samples(pixel_index) for pixel_index in tiles]
+
+        if seed is not None or processes or threaded:
+            seed = int(np.random.SeedSequence(seed).entropy)
+
+        checkpointer = Checkpointer(
+            checkpoint,
+            checkpoint_interval,
+            {"samples_per_pixel": samples_per_pixel, "engine": engine, "seed": seed},
+        )
+
+        # samples of every pixel before the adaptive passes
+        target = min(min_samples, samples_per_pixel) if adaptive else samples_per_pixel
+        def update(framebuffer, lock=None):
+            checkpointer.update(framebuffer, lock)
+            if on_update is not None:
+                # the tiles of the other threads or processes aren't added while on_update reads the framebuffer
+                with lock if lock is not None else contextlib.nullcontext():
+                    on_update(framebuffer)
+
+        # slices of the samples of a tile: few tiles are split so all the threads have work.
+        # (The rays scattered by a hit aren't split: they're traced as a single batch, with the tile.)
+        slices = 1
+        if threaded:
+            slices = -(-2 * threads // max(sum(done < target for done in samples_done), 1))
+
+        # (pixel indices, number of samples, seed, index of the first sample or None) of every task
+        tasks = []
+        for tile, (pixel_index, done) in enumerate(zip(tiles, samples_done)):
+            n = min(slices, max(target - done, 0))
+            bounds = [done + (target - done) * k // n for k in range(n + 1)]
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                tasks.append(
+                    (
+                        pixel_index,
+                        end - start,
+                        tile_seed(seed, tile, start) if seed is not None else None,
+                        start if n > 1 else None,
+                    )
+                )
+
+        bar = None
         if progress_bar == True:
 
             try:
@@ -69,61 +443,110 @@ class Scene:
             except ModuleNotFoundError:
                 print("progressbar module is required. \nRun: pip install progressbar")
 
-            bar = progressbar.ProgressBar()
-            for i in bar(range(samples_per_pixel)):
-                color_RGBlinear += get_raycolor(self.camera.get_ray(self.n), scene=self)
-                bar.update(i)
-        else:
+            bar = progressbar.ProgressBar(maxval=len(tasks) if processes or threaded else None)
 
-            for i in range(samples_per_pixel):
-                color_RGBlinear += get_raycolor(self.camera.get_ray(self.n), scene=self)
+        # serial throughput of the scene, the reference of the speedup of the workers or threads
+        serial_rate = None
+        if (processes or threaded) and tasks:
+            serial_rate = self.serial_samples_per_second(get_color, aovs, tiles)
 
-        # average samples per pixel (antialiasing)
-        color_RGBlinear = color_RGBlinear / samples_per_pixel
-        # gamma correction
-        color = cf.sRGB_linear_to_sRGB(color_RGBlinear.to_array())
+        samples_before = framebuffer.samples.sum()
+        adaptive_passes = None
+        t1, cpu_t1 = time.time(), time.process_time()
+        if processes:
+            framebuffer, cpu_time = render_parallel(
+                self, get_color, framebuffer, tasks, workers, bar, update
+            )
+        elif threaded:
+            framebuffer, cpu_time = render_threaded(
+                self, get_color, framebuffer, tasks, threads, bar, update
+            )
+        else:
+            # the camera rays and the intersection temporaries reuse the same buffers for every sample
+            self.pool = BufferPool()
 
-        print("Render Took", time.time() - t0)
+            # every tile is fully sampled before the next one, one sample at a time
+            passes = [
+                (pixel_index, task_seed if i == 0 else None)
+                for pixel_index, samples, task_seed, first_sample in tasks
+                for i in range(samples)
+            ]
+            if bar is not None:
+                passes = bar(passes)
 
-        img_RGB = []
-        for c in color:
-            # average ray colors that fall in the same pixel. (antialiasing)
-            img_RGB += [
-                Image.fromarray(
-                    (
-                        255
-                        * np.clip(c, 0, 1).reshape(
-                            (self.camera.screen_height, self.camera.screen_width)
-                        )
-                    ).astype(np.uint8),
-                    "L",
+            for pixel_index, task_seed in passes:
+                self.render_tile(framebuffer, pixel_index, 1, get_color, task_seed)
+                update(framebuffer)
+
+            if adaptive:
+                if seed is not None:
+                    # seeded by the number of samples already taken, with a key no tile uses
+                    key = (W * H, int(framebuffer.samples.sum()))
+                    np.random.seed(np.random.SeedSequence(seed, spawn_key=key).generate_state(4))
+                # the active pixels are traced in batches of at most a tile
+                batch_size = W * H if tiles[0] is None else max(tile.size for tile in tiles)
+                adaptive_passes = self.sample_adaptive(
+                    framebuffer, samples_per_pixel, get_color, noise_threshold, batch_size, update
                 )
-            ]
 
-        return Image.merge("RGB", img_RGB)
+            self.pool = None
+            cpu_time = time.process_time() - cpu_t1
 
-    def get_distances(
-        self,
-    ):  # Used for debugging ray-primitive collisions. Return a grey map of objects distances.
+        checkpointer.update(framebuffer, force=True)
 
-        print("Rendering...")
-        t0 = time.time()
-        color_RGBlinear = get_distances(self.camera.get_ray(self.n), scene=self)
-        # gamma correction
-        color = color_RGBlinear.to_array()
+        # utilization: CPU time spent tracing the tiles over the elapsed time (about 1 for a serial render,
+        # at most the number of workers or threads). It isn't a speedup: the workers also spend CPU time on
+        # contention (memory bandwidth, GIL hand-offs) that a serial render doesn't.
+        # speedup: samples per second over the ones of a serial pass timed before the render
+        # (see serial_samples_per_second), None for a serial render.
+        trace_time = time.time() - t1
+        traced = framebuffer.samples.sum() - samples_before
+        samples_per_second = traced / max(trace_time, 1e-9)
+        self.render_stats = {
+            "time": trace_time,
+            "cpu_time": cpu_time,
+            "utilization": cpu_time / max(trace_time, 1e-9),
+            "samples_per_second": samples_per_second,
+            "speedup": samples_per_second / serial_rate if serial_rate else None,
+        }
+        if adaptive:
+            # samples per pixel after the adaptive passes
+            self.render_stats.update(
+                adaptive_passes=adaptive_passes,
+                samples_min=int(framebuffer.samples.min()),
+                samples_mean=float(framebuffer.samples.mean()),
+                samples_max=int(framebuffer.samples.max()),
+            )
 
         print("Render Took", time.time() - t0)
-
-        img_RGB = [
-            Image.fromarray(
-                (
-                    255
-                    * np.clip(c, 0, 1).reshape(
-                        (self.camera.screen_height, self.camera.screen_width)
-                    )
-                ).astype(np.uint8),
-                "L",
+        if processes or threaded:
+            print(
+                "Speedup", self.render_stats["speedup"], "with", workers or threads, "processes" if processes else "threads",
+                "(CPU utilization %.2f, %.0f samples per second)"
+                % (self.render_stats["utilization"], self.render_stats["samples_per_second"]),
             )
-            for c in color
-        ]
-        return Image.merge("RGB", img_RGB)
+
+        self.framebuffer = framebuffer
+        if hdr_output is not None:
+            save_hdr(hdr_output, framebuffer)
+
+        # average samples per pixel (antialiasing), tone mapping and gamma correction
+        linear = None
+        if denoise:
+            t2 = time.time()
+            linear = denoise_framebuffer(framebuffer)
+            self.render_stats["denoise_time"] = time.time() - t2
+        image = framebuffer.to_image(linear, tonemap, exposure)
+
+        if outputs:
+            return image, {
+                name: framebuffer.get_aov(name).reshape(-1, H, W).transpose(1, 2, 0) for name in outputs
+            }
+        return image
+
+    def get_distances(self, max_distance=10.0):
+        # Used for debugging ray-primitive collisions. Returns a grey map of the objects distances,
+        # the depth AOV of a render that only intersects the camera rays (white where nothing is hit).
+        _, aovs = self.render(1, engine="aov", aovs=("depth", "hit_count"))
+        depth = np.where(aovs["hit_count"] > 0, aovs["depth"], max_distance)
+        return aov_image("depth", depth, max_distance)
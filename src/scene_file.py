@@ -0,0 +1,267 @@
+import json
+import os
+import numpy as np
+from .utils.vector3 import vec3
+from .scene import Scene
+from .geometry import Sphere, Plane, Cuboid, TriangleMesh, load_obj
+from .materials import Diffuse, Emissive, Glossy, Refractive, ThinFilmInterference
+from .textures import image
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ModuleNotFoundError:
+        tomllib = None
+
+
+# Scene files describe a scene with the arguments of the Python API:
+#
+# {
+#     "scene": {"ambient_color": [0.05, 0.05, 0.05]},                  # Scene(...)
+#     "camera": {"look_from": [0, 0.25, 1], "look_at": [0, 0.25, -3]},  # Scene.add_Camera(...)
+#     "lights": [{"type": "DirectionalLight", "Ldir": [0.5, 0.5, 0.5], "color": [0.5, 0.5, 0.5]}],
+#     "materials": {
+#         "floor": {"type": "Glossy", "diff_color": {"image": "checkered_floor.png", "repeat": 2.0},
+#                   "roughness": 0.2, "spec_coeff": 0.3, "diff_coeff": 0.7, "n": [2.2, 2.2, 2.2]},
+#         "glass": {"type": "Refractive", "n": [[1.5, 4e-8], [1.5, 0.0], [1.5, 4e-8]]},
+#     },
+#     "primitives": [
+#         {"type": "Sphere", "material": "glass", "center": [0, 0, -1.5], "radius": 0.5,
+#          "max_ray_depth": 3, "shadow": false, "importance_sampled": false,
+#          "rotate": [{"angle": 30, "axis": [0, 1, 0]}]},
+#     ],
+#     "background": {"img": "stormydays.png"},                           # Scene.add_Background(...)
+# }
+#
+# Vectors are [x, y, z] lists and complex components (indices of refraction) are [real, imaginary] pairs.
+# Scene files are JSON or TOML (same structure). Meshes (TriangleMesh "file_name") are relative to the scene file.
+#
+# A scene file can be compiled to an .npz file of packed arrays: one parameter matrix per primitive type,
+# the vertices and faces of all the meshes, and the rotations. Loading it only reads the arrays
+# (and a small JSON header with the camera, lights, materials and background), so generated
+# scene variants don't pay for parsing the description or the meshes.
+
+
+MATERIALS = {
+    "Diffuse": Diffuse,
+    "Emissive": Emissive,
+    "Glossy": Glossy,
+    "Refractive": Refractive,
+    "ThinFilmInterference": ThinFilmInterference,
+}
+
+# primitive type: (class, parameters packed in its matrix, with their number of columns)
+PRIMITIVES = {
+    "Sphere": (Sphere, (("center", 3), ("radius", 1))),
+    "Plane": (
+        Plane,
+        (("center", 3), ("width", 1), ("height", 1), ("u_axis", 3), ("v_axis", 3)),
+    ),
+    "Cuboid": (
+        Cuboid,
+        (("center", 3), ("width", 1), ("height", 1), ("length", 1)),
+    ),
+    "TriangleMesh": (TriangleMesh, (("center", 3),)),
+}
+PRIMITIVE_TYPES = list(PRIMITIVES)
+
+# columns of the integer matrix of every primitive type, with their default
+FLAGS = (
+    ("material", None),
+    ("max_ray_depth", 5),
+    ("shadow", True),
+    ("importance_sampled", False),
+)
+
+
+def read_scene_file(path):
+    """Returns the scene description (a dict) of a JSON or TOML scene file."""
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise ModuleNotFoundError(
+                "TOML scene files require Python 3.11 or tomli. \nRun: pip install tomli"
+            )
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def to_vec3(value):
+    # [x, y, z] list, with [real, imaginary] pairs for complex components
+    return vec3(*[complex(*c) if isinstance(c, list) else c for c in value])
+
+
+def to_value(value):
+    if isinstance(value, dict) and "image" in value:
+        return image(value["image"], repeat=value.get("repeat", 1.0))
+    if isinstance(value, list) and len(value) == 3:
+        return to_vec3(value)
+    return value
+
+
+def pack_scene(description, directory="."):
+    """
+    Packs a scene description in arrays (see compile_scene).
+
+    Args:
+    - description: The scene description, a dict.
+    - directory: The directory mesh files are relative to.
+
+    Returns:
+    - A dict of NumPy arrays.
+    """
+    materials = list(description.get("materials", {}))
+    header = {
+        key: description[key]
+        for key in ("scene", "camera", "lights", "materials", "background")
+        if key in description
+    }
+    arrays = {}
+
+    rows = {name: ([], []) for name in PRIMITIVE_TYPES}
+    order, rotations, vertices, faces, mesh_sizes = [], [], [], [], []
+    for i, primitive in enumerate(description.get("primitives", [])):
+        name = primitive["type"]
+        if name not in PRIMITIVES:
+            raise ValueError("unknown primitive type " + name)
+        params, flags = rows[name]
+        order.append((PRIMITIVE_TYPES.index(name), len(params)))
+
+        row = []
+        for key, size in PRIMITIVES[name][1]:
+            row += list(primitive[key]) if size == 3 else [primitive[key]]
+        params.append(row)
+        flag_values = dict(
+            FLAGS, **{k: primitive[k] for k, _ in FLAGS if k in primitive}
+        )
+        flag_values["material"] = materials.index(primitive["material"])
+        flags.append([int(flag_values[k]) for k, _ in FLAGS])
+
+        if name == "TriangleMesh":
+            if "file_name" in primitive:
+                v, f = load_obj(os.path.join(directory, primitive["file_name"]))
+            else:
+                v, f = primitive["vertices"], primitive["faces"]
+            vertices.append(np.asarray(v, dtype=np.float32).reshape(-1, 3))
+            faces.append(np.asarray(f, dtype=np.int32).reshape(-1, 3))
+            mesh_sizes.append((len(vertices[-1]), len(faces[-1])))
+
+        for rotation in primitive.get("rotate", []):
+            rotations.append([i, rotation["angle"]] + list(rotation["axis"]))
+
+    for name, (params, flags) in rows.items():
+        columns = sum(size for _, size in PRIMITIVES[name][1])
+        arrays[name + ".params"] = np.array(params, dtype=np.float64).reshape(
+            -1, columns
+        )
+        arrays[name + ".flags"] = np.array(flags, dtype=np.int64).reshape(
+            -1, len(FLAGS)
+        )
+    arrays["order"] = np.array(order, dtype=np.int64).reshape(-1, 2)
+    arrays["rotations"] = np.array(rotations, dtype=np.float64).reshape(-1, 5)
+    arrays["mesh_sizes"] = np.array(mesh_sizes, dtype=np.int64).reshape(-1, 2)
+    arrays["vertices"] = (
+        np.concatenate(vertices) if vertices else np.zeros((0, 3), dtype=np.float32)
+    )
+    arrays["faces"] = (
+        np.concatenate(faces) if faces else np.zeros((0, 3), dtype=np.int32)
+    )
+    arrays["header"] = np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)
+    return arrays
+
+
+def build_packed_scene(arrays):
+    """Builds the Scene object of a packed scene (see pack_scene)."""
+    header = json.loads(arrays["header"].tobytes())
+
+    scene = Scene(**{k: to_value(v) for k, v in header.get("scene", {}).items()})
+    if "camera" in header:
+        scene.add_Camera(**{k: to_value(v) for k, v in header["camera"].items()})
+    for light in header.get("lights", []):
+        kwargs = {k: to_value(v) for k, v in light.items() if k != "type"}
+        if light["type"] == "DirectionalLight":
+            scene.add_DirectionalLight(**kwargs)
+        elif light["type"] == "PointLight":
+            scene.add_PointLight(**kwargs)
+        else:
+            raise ValueError("unknown light type " + light["type"])
+
+    materials = []
+    for material in header.get("materials", {}).values():
+        if material["type"] not in MATERIALS:
+            raise ValueError("unknown material type " + material["type"])
+        kwargs = {k: to_value(v) for k, v in material.items() if k != "type"}
+        materials.append(MATERIALS[material["type"]](**kwargs))
+
+    # offsets of the meshes in the vertex and face arrays
+    mesh_offsets = np.zeros((len(arrays["mesh_sizes"]) + 1, 2), dtype=np.int64)
+    np.cumsum(arrays["mesh_sizes"], axis=0, out=mesh_offsets[1:])
+
+    params = {name: arrays[name + ".params"] for name in PRIMITIVE_TYPES}
+    flags = {name: arrays[name + ".flags"] for name in PRIMITIVE_TYPES}
+    rotations = arrays["rotations"]
+    rotation = 0
+    for i, (type_index, j) in enumerate(arrays["order"]):
+        name = PRIMITIVE_TYPES[type_index]
+        cls, columns = PRIMITIVES[name]
+
+        kwargs, c = {}, 0
+        for key, size in columns:
+            row = params[name][j]
+            kwargs[key] = vec3(*row[c : c + 3]) if size == 3 else row[c]
+            c += size
+        material, max_ray_depth, shadow, importance_sampled = flags[name][j]
+        if name == "TriangleMesh":
+            (v0, f0), (v1, f1) = mesh_offsets[j], mesh_offsets[j + 1]
+            kwargs.update(
+                file_name=None,
+                vertices=arrays["vertices"][v0:v1],
+                faces=arrays["faces"][f0:f1],
+            )
+
+        primitive = cls(
+            material=materials[material],
+            max_ray_depth=int(max_ray_depth),
+            shadow=bool(shadow),
+            **kwargs,
+        )
+        while rotation < len(rotations) and rotations[rotation, 0] == i:
+            _, angle, x, y, z = rotations[rotation]
+            primitive.rotate(θ=angle, u=vec3(x, y, z))
+            rotation += 1
+        scene.add(primitive, importance_sampled=bool(importance_sampled))
+
+    if "background" in header:
+        scene.add_Background(**header["background"])
+    return scene
+
+
+def compile_scene(path, output_path):
+    """Compiles a JSON or TOML scene file to an .npz file of packed arrays, loaded by load_scene."""
+    arrays = pack_scene(read_scene_file(path), os.path.dirname(path))
+    with open(output_path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def load_scene(path):
+    """
+    Builds the Scene object of a scene file.
+
+    Args:
+    - path: A JSON (.json) or TOML (.toml) scene file, or a compiled scene (.npz, see compile_scene).
+
+    Returns:
+    - A Scene object.
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return build_packed_scene(dict(data))
+    return build_packed_scene(pack_scene(read_scene_file(path), os.path.dirname(path)))
+
+
+def build_scene_from_description(description, directory="."):
+    """Builds the Scene object of a scene description (a dict with the structure of a scene file)."""
+    return build_packed_scene(pack_scene(description, directory))
@@ -0,0 +1,426 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import io
+import itertools
+import json
+import socket
+import threading
+import time
+import traceback
+import numpy as np
+from .utils.vector3 import vec3
+from .framebuffer import Framebuffer
+from .farm import parse_address
+
+
+# Render service: a long-running asyncio HTTP server accepting render jobs.
+# Scenes are built once per scene spec and kept in a cache (with their meshes, decoded textures
+# and acceleration structures: the cached scenes are static, see Scene.finalize), so a re-render of a
+# cached scene with a different camera, resolution or number of samples only pays for the tracing.
+# Jobs are rendered by a pool of threads, each on a shallow copy of the cached scene with its own camera,
+# and publish a preview of their framebuffer as it refines. Finished jobs are kept for a while
+# (job_ttl, at most max_finished_jobs of them) so their results can be fetched.
+# The renders draw from the global NumPy random state, which seeded renders reseed: a seeded job
+# runs alone, so its image doesn't depend on the other jobs.
+#
+# Endpoints:
+# - POST /render with a JSON job (see RenderService.submit): returns {"job": id}.
+# - GET /jobs/<id>: the state of the job.
+# - GET /jobs/<id>/image: the latest preview (the final image once done) as a PNG.
+# - GET /jobs/<id>/stream: the previews as a multipart/x-mixed-replace stream of PNGs, until the job is done.
+
+
+# options of a job passed to Scene.render
+RENDER_OPTIONS = (
+    "engine",
+    "tile_size",
+    "memory_budget",
+    "threads",
+    "seed",
+    "adaptive",
+    "noise_threshold",
+    "sampler",
+    "denoise",
+    "tonemap",
+    "exposure",
+    "texture_lod",
+)
+# options of a job overriding the camera of the scene
+CAMERA_OPTIONS = ("look_from", "look_at", "field_of_view", "aperture", "focal_distance")
+
+
+def camera_args(camera):
+    """Returns the arguments of Scene.add_Camera that rebuild the given camera."""
+    return {
+        "look_from": camera.look_from,
+        "look_at": camera.look_at,
+        "screen_width": camera.screen_width,
+        "screen_height": camera.screen_height,
+        "field_of_view": float(np.degrees(2.0 * np.arctan(camera.camera_width / 2.0))),
+        "aperture": camera.lens_radius * 2.0,
+        "focal_distance": camera.focal_distance,
+    }
+
+
+def encode_png(image):
+    f = io.BytesIO()
+    image.save(f, "PNG")
+    return f.getvalue()
+
+
+class Job:
+    def __init__(self, job_id, options, loop):
+        self.id = job_id
+        self.options = options
+        self.loop = loop
+        self.state = "queued"  # queued, running, done or failed
+        self.error = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.samples = 0.0
+        self.preview = None  # copy of the framebuffer, or the final image once done
+        self.version = 0
+        self.png = (None, None)  # (version, PNG data) of the latest encoded preview
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        # called in the event loop: wakes up the streams waiting for this version
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def publish(self, preview, samples, state=None):
+        # called by the render thread
+        self.preview = preview
+        self.samples = samples
+        self.version += 1
+        if state is not None:
+            self.state = state
+        self.loop.call_soon_threadsafe(self.notify)
+
+    def status(self):
+        return {
+            "job": self.id,
+            "state": self.state,
+            "error": self.error,
+            "samples_per_pixel": self.samples,
+            "queue_time": (self.start_time or time.time()) - self.submit_time,
+            "render_time": (
+                (self.end_time or time.time()) - self.start_time
+                if self.start_time is not None
+                else None
+            ),
+        }
+
+    def get_png(self):
+        version, data = self.png
+        if version != self.version and self.preview is not None:
+            version, preview = self.version, self.preview
+            if isinstance(preview, Framebuffer):
+                preview = preview.to_image(
+                    tonemap=self.options.get("tonemap", "clip"),
+                    exposure=self.options.get("exposure", 0.0),
+                )
+            data = encode_png(preview)
+            self.png = (version, data)
+        return data
+
+
+class SharedLock:
+    """A lock held either by any number of shared holders or by a single exclusive one."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared_count = 0
+        self.exclusive_held = False
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.exclusive_held)
+            self.shared_count += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.shared_count -= 1
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: not self.exclusive_held and self.shared_count == 0
+            )
+            self.exclusive_held = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.exclusive_held = False
+                self.condition.notify_all()
+
+
+class RenderService:
+    """
+    Renders the jobs submitted to an HTTP server, keeping the scenes built by the previous jobs.
+
+    Args:
+    - build_scene: A function returning the Scene object described by a scene spec (a JSON dict).
+    - workers: The number of jobs rendered at the same time (by threads sharing the cached scenes).
+    - cache_size: The number of built scenes kept.
+    - preview_interval: The minimum time between two previews of a job, in seconds.
+    - job_ttl: How long a finished job is kept, in seconds.
+    - max_finished_jobs: The number of finished jobs kept, the oldest are forgotten first.
+    """
+
+    def __init__(
+        self,
+        build_scene,
+        workers=1,
+        cache_size=4,
+        preview_interval=0.5,
+        job_ttl=3600.0,
+        max_finished_jobs=64,
+    ):
+        self.build_scene = build_scene
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.cache_size = cache_size
+        self.preview_interval = preview_interval
+        self.job_ttl = job_ttl
+        self.max_finished_jobs = max_finished_jobs
+        # scene spec (JSON): Scene, least recently used first
+        self.scenes = collections.OrderedDict()
+        self.scenes_lock = threading.Lock()
+        # scene spec (JSON): Event set once the scene being built by another job is cached
+        self.building = {}
+        self.jobs = {}
+        self.job_ids = itertools.count()
+        self.random_lock = SharedLock()  # exclusive for the seeded jobs
+
+    def get_scene(self, spec):
+        """Returns the cached Scene object of a scene spec, building it on a miss."""
+        key = json.dumps(spec, sort_keys=True)
+        while True:
+            with self.scenes_lock:
+                if key in self.scenes:
+                    self.scenes.move_to_end(key)
+                    return self.scenes[key]
+                built = self.building.get(key)
+                if built is None:
+                    # this job builds it, the others wait for it
+                    built = self.building[key] = threading.Event()
+                    break
+            built.wait()  # built by another job (or failed: then built again)
+
+        # built out of the lock, so the other requests aren't blocked by a slow load
+        try:
+            scene = self.build_scene(spec)
+            # the acceleration structures are built once, and shared by the copies of the jobs
+            scene.finalize()
+            scene.static = True
+            with self.scenes_lock:
+                self.scenes[key] = scene
+                while len(self.scenes) > self.cache_size:
+                    self.scenes.popitem(last=False)
+            return scene
+        finally:
+            with self.scenes_lock:
+                del self.building[key]
+            built.set()
+
+    def evict_jobs(self):
+        """Forgets the finished jobs older than job_ttl, and the oldest ones beyond max_finished_jobs."""
+        now = time.time()
+        finished = sorted(
+            (job for job in list(self.jobs.values()) if job.end_time is not None),
+            key=lambda job: job.end_time,
+        )
+        excess = len(finished) - self.max_finished_jobs
+        for i, job in enumerate(finished):
+            if i < excess or now - job.end_time > self.job_ttl:
+                self.jobs.pop(job.id, None)
+
+    def submit(self, options):
+        """
+        Queues a render job. options is a JSON dict with:
+        - scene: The scene spec passed to build_scene (main.py takes {"scene_type": ...} or {"scene_file": ...}).
+        - spp: The number of samples per pixel.
+        - width, height: The resolution, by default the one of the scene camera.
+        - camera: Camera overrides (look_from, look_at as [x, y, z] lists, field_of_view, aperture, focal_distance).
+        - engine, tile_size, memory_budget, threads, seed, adaptive, noise_threshold, sampler, denoise,
+          tonemap, exposure, texture_lod: Options of Scene.render.
+
+        Returns:
+        - The Job object.
+        """
+        if not isinstance(options, dict) or "scene" not in options:
+            raise ValueError("a job needs a scene spec")
+        if not isinstance(options.get("spp", 1), int) or options.get("spp", 1) < 1:
+            raise ValueError("spp must be a positive integer")
+        unknown = set(options.get("camera", {})) - set(CAMERA_OPTIONS)
+        unknown |= (
+            set(options)
+            - {"scene", "spp", "width", "height", "camera"}
+            - set(RENDER_OPTIONS)
+        )
+        if unknown:
+            raise ValueError("unknown options: " + ", ".join(sorted(unknown)))
+
+        self.evict_jobs()
+        loop = asyncio.get_running_loop()
+        job = Job(str(next(self.job_ids)), options, loop)
+        self.jobs[job.id] = job
+        loop.run_in_executor(self.executor, self.run_job, job)
+        return job
+
+    def run_job(self, job):
+        job.state = "running"
+        job.start_time = time.time()
+        try:
+            options = job.options
+            scene = copy.copy(self.get_scene(options["scene"]))
+            scene.pools = {}
+
+            camera = dict(options.get("camera", {}))
+            if "width" in options:
+                camera["screen_width"] = options["width"]
+            if "height" in options:
+                camera["screen_height"] = options["height"]
+            if camera:
+                for key in ("look_from", "look_at"):
+                    if key in camera:
+                        camera[key] = vec3(*camera[key])
+                scene.add_Camera(**dict(camera_args(scene.camera), **camera))
+
+            last_preview = [0.0]
+
+            def on_update(framebuffer):
+                if time.time() - last_preview[0] > self.preview_interval:
+                    job.publish(framebuffer.copy(), float(framebuffer.samples.mean()))
+                    last_preview[0] = time.time()
+
+            seeded = options.get("seed") is not None
+            with self.random_lock.exclusive() if seeded else self.random_lock.shared():
+                image = scene.render(
+                    options.get("spp", 1),
+                    on_update=on_update,
+                    **{k: options[k] for k in RENDER_OPTIONS if k in options},
+                )
+            job.end_time = time.time()
+            job.publish(image, float(options.get("spp", 1)), "done")
+        except Exception as e:
+            traceback.print_exc()
+            job.error = "%s: %s" % (type(e).__name__, e)
+            job.end_time = time.time()
+            job.state = "failed"
+            job.loop.call_soon_threadsafe(job.notify)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            method, path, _ = request.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            parts = path.split("?")[0].strip("/").split("/")
+            if method == "POST" and parts == ["render"]:
+                try:
+                    job = self.submit(json.loads(body or b"null"))
+                except ValueError as e:
+                    await self.respond(writer, 400, {"error": str(e)})
+                else:
+                    await self.respond(writer, 202, {"job": job.id})
+            elif method == "GET" and len(parts) >= 2 and parts[0] == "jobs":
+                self.evict_jobs()
+                job = self.jobs.get(parts[1])
+                if job is None:
+                    await self.respond(writer, 404, {"error": "unknown job"})
+                elif parts[2:] == []:
+                    await self.respond(writer, 200, job.status())
+                elif parts[2:] == ["image"]:
+                    await self.send_image(writer, job)
+                elif parts[2:] == ["stream"]:
+                    await self.stream(writer, job)
+                else:
+                    await self.respond(writer, 404, {"error": "not found"})
+            else:
+                await self.respond(writer, 404, {"error": "not found"})
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, code, content, content_type="application/json"):
+        if content_type == "application/json":
+            content = json.dumps(content).encode()
+        reason = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found"}
+        writer.write(
+            (
+                "HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                % (code, reason.get(code, ""), content_type, len(content))
+            ).encode()
+        )
+        writer.write(content)
+        await writer.drain()
+
+    async def send_image(self, writer, job):
+        if job.preview is None:
+            await self.respond(
+                writer, 404, {"error": "no preview yet", "state": job.state}
+            )
+            return
+        png = await asyncio.get_running_loop().run_in_executor(None, job.get_png)
+        await self.respond(writer, 200, png, "image/png")
+
+    async def stream(self, writer, job):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=frame\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        version = 0
+        while True:
+            changed = job.changed
+            finished = job.state in (
+                "done",
+                "failed",
+            )  # before the version: the last preview is then sent
+            if job.version != version and job.preview is not None:
+                version = job.version
+                png = await asyncio.get_running_loop().run_in_executor(
+                    None, job.get_png
+                )
+                writer.write(
+                    b"--frame\r\nContent-Type: image/png\r\nContent-Length: %d\r\n\r\n"
+                    % len(png)
+                )
+                writer.write(png + b"\r\n")
+                await writer.drain()
+            if finished:
+                break
+            await changed.wait()
+        writer.write(b"--frame--\r\n")
+        await writer.drain()
+
+    async def serve(self, address):
+        """Serves the jobs on address ('host:port' or the path of a Unix socket) until cancelled."""
+        family, addr = parse_address(address)
+        if family == socket.AF_INET:
+            server = await asyncio.start_server(self.handle, *addr)
+        else:
+            server = await asyncio.start_unix_server(self.handle, addr)
+        print("Render service listening on", address)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
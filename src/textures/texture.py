@@ -1,7 +1,7 @@
 from ..utils.constants import *
 from ..utils.vector3 import vec3, rgb
 from ..ray import Ray, get_raycolor
-from ..utils.image_functions import load_image, load_image_as_linear_sRGB
+from ..utils.image_functions import get_texels
 import numpy as np
 from abc import abstractmethod
 
@@ -29,14 +29,11 @@ class solid_color(texture):
 class image(texture):
 
     def __init__(self, img, repeat=1.0):
-        self.img = load_image_as_linear_sRGB("src/textures/" + img)
+        self.img = get_texels("src/textures/" + img, linear=True)
         self.repeat = repeat
 
     def get_color(self, hit):
         u, v = hit.get_uv()
-        im = self.img[
-            -((v * self.img.shape[0] * self.repeat).astype(int) % self.img.shape[0]),
-            (u * self.img.shape[1] * self.repeat).astype(int) % self.img.shape[1],
-        ].T
+        im = self.img.sample(u, v, self.repeat, hit.get_lod(self.img.shape, self.repeat))
         color = vec3(im[0], im[1], im[2])
         return color
@@ -0,0 +1,37 @@
+import math
+import numpy as np
+from .vector3 import vec3
+
+
+class BufferPool:
+    """
+    Scratch arrays reused across the iterations of a render.
+
+    Every array is requested by name. The pool keeps one flat buffer per name and only
+    grows it, so arrays for a varying number of rays are views of the same memory and
+    no allocation happens once the largest batch has been seen.
+    An array is only valid until its name is requested again, so names must not be shared
+    by arrays that are alive at the same time. A pool must not be shared between threads.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.float64):
+        size = math.prod(shape)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.size < size or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(size, dtype=dtype)
+        return buffer[:size].reshape(shape)
+
+
+def empty(pool, name, shape, dtype=np.float64):
+    """Returns np.empty(shape), taken from the pool if one is given."""
+    if pool is None:
+        return np.empty(shape, dtype=dtype)
+    return pool.get(name, shape, dtype)
+
+
+def empty_vec3(pool, name, n):
+    """Returns a vec3 of n uninitialized vectors, taken from the pool if one is given."""
+    return vec3.from_array(empty(pool, name, (3, n)))
@@ -24,3 +24,33 @@ def sRGB_to_sRGB_linear(rgb):
     )
 
     return rgb_linear
+
+
+def luminance(rgb_linear):
+    """Rec. 709 luminance of linear RGB colors (arrays of shape (3, ...))."""
+    return 0.2126 * rgb_linear[0] + 0.7152 * rgb_linear[1] + 0.0722 * rgb_linear[2]
+
+
+def tonemap(rgb_linear, operator="clip", exposure=0.0):
+    """
+    Maps linear RGB radiance (an array of shape (3, ...)) to display sRGB in [0, 1].
+
+    Args:
+    - operator: "clip" only scales down the colors brighter than white (sRGB_linear_to_sRGB),
+      "reinhard" compresses the luminance with L / (1 + L), "aces" applies the ACES filmic curve
+      fitted by Narkowicz.
+    - exposure: The radiance is scaled by 2^exposure first.
+    """
+    if exposure != 0.0:
+        rgb_linear = rgb_linear * 2.0**exposure
+
+    if operator == "reinhard":
+        L = luminance(rgb_linear)
+        rgb_linear = rgb_linear / (1.0 + np.maximum(L, 0.0))
+    elif operator == "aces":
+        x = np.maximum(rgb_linear, 0.0)
+        rgb_linear = x * (2.51 * x + 0.03) / (x * (2.43 * x + 0.59) + 0.14)
+    elif operator != "clip":
+        raise ValueError("unknown tone mapping operator " + operator)
+
+    return sRGB_linear_to_sRGB(rgb_linear)
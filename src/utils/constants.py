@@ -2,3 +2,4 @@ UPWARDS = 1
 UPDOWN = -1
 FARAWAY = 1.0e39
 SKYBOX_DISTANCE = 1.0e6
+RAY_MEMORY = 1024  # estimated peak bytes per traced ray, used to size render tiles
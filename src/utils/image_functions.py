@@ -1,3 +1,4 @@
+import threading
 from PIL import Image, ImageFilter
 import numpy as np
 from pathlib import Path
@@ -31,3 +32,214 @@ def load_image_as_linear_sRGB(path, blur=0.0):
     img_array = np.asarray(img) / 256.0
     img_sRGB_linear_array = sRGB_to_sRGB_linear(img_array)
     return img_sRGB_linear_array
+
+
+
+# Process-wide texture registry: the images of the textures, skyboxes, normal maps and thin film tables
+# are loaded once per path and preprocessing options, and shared by every material and scene using them.
+# 8-bit images are kept as their uint8 pixels and converted to float64 on lookup through a 256 entry table
+# (the same values load_image and load_image_as_linear_sRGB compute), other images are kept as float16.
+# A float64 copy is 8 times larger than the source pixels (e.g. 300 MB for a 4096x3072 skybox).
+
+# value of the 256 uint8 levels: as loaded (load_image) and linearized (load_image_as_linear_sRGB)
+LUTS = {
+    False: np.arange(256) / 256.0,
+    True: sRGB_to_sRGB_linear(np.arange(256) / 256.0),
+}
+
+
+def cube_cross_mask(height, width):
+    """Returns the texels of the faces of a cube map laid out as a horizontal cross (4x3 faces)."""
+    N = height // 3
+    mask = np.zeros((height, width), dtype=bool)
+    mask[N : 2 * N, :] = True
+    mask[:, N : 2 * N] = True
+    return mask
+
+
+class Texels:
+    """
+    The texels of an image in compact storage. Indexing it like a NumPy array returns float64 texels.
+    The mip levels of the image (each the previous one averaged over 2x2 texels, down to a single texel)
+    are built, as float16, the first time a lookup needs them.
+
+    Args:
+    - data: A uint8 or float16 NumPy array of shape (height, width, channels).
+    - lut: The float value of each uint8 level, or None if data is float.
+    - layout: None, or "cross" for a cube map laid out as a horizontal cross:
+      the texels out of its faces are left out of the mip levels.
+    """
+
+    def __init__(self, data, lut=None, layout=None):
+        self.data = data
+        self.lut = lut
+        self.layout = layout
+        self.mip_levels = None
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        levels = self.mip_levels[1:] if self.mip_levels is not None else []
+        return self.data.nbytes + sum(level.nbytes for level in levels)
+
+    def __getitem__(self, index):
+        texels = self.data[index]
+        if self.lut is not None:
+            return self.lut[texels]
+        return texels.astype(np.float64)
+
+    def __array__(self, dtype=None, copy=None):
+        return self[...] if dtype is None else self[...].astype(dtype)
+
+    def get_mip_levels(self):
+        if self.mip_levels is None:
+            with texture_registry_lock:  # shared texels are built once
+                if self.mip_levels is None:
+                    self.mip_levels = self.build_mip_levels()
+        return self.mip_levels
+
+    def build_mip_levels(self):
+        level = self[...]
+        if level.ndim == 2:
+            level = level[:, :, None]
+        H, W = level.shape[:2]
+        weight = np.ones((H, W, 1))
+        if self.layout == "cross":
+            weight = cube_cross_mask(H, W)[:, :, None].astype(np.float64)
+
+        levels = [self]
+        while max(level.shape[:2]) > 1:
+            # odd sizes wrap around, like the texture coordinates
+            H, W = level.shape[:2]
+            pad = [(0, H % 2), (0, W % 2), (0, 0)]
+            level, weight = np.pad(level * weight, pad, mode="wrap"), np.pad(weight, pad, mode="wrap")
+            level = level[0::2, 0::2] + level[1::2, 0::2] + level[0::2, 1::2] + level[1::2, 1::2]
+            weight = weight[0::2, 0::2] + weight[1::2, 0::2] + weight[0::2, 1::2] + weight[1::2, 1::2]
+            level = level / np.maximum(weight, 1e-12)
+            weight = (weight > 0).astype(np.float64)
+            levels += [level.reshape(level.shape[:2] + self.shape[2:]).astype(np.float16)]
+        return levels
+
+    def sample(self, u, v, repeat=1.0, lod=None):
+        """
+        Looks up the nearest texels of the texture coordinates u, v (arrays) of the texture repeated repeat times.
+        With a level of detail lod (an array, see Hit.get_lod), the texels of the two nearest mip levels are blended.
+
+        Returns:
+        - A float64 NumPy array of shape (channels, n).
+        """
+        if lod is None:
+            H, W = self.shape[:2]
+            return self[-((v * H * repeat).astype(int) % H), (u * W * repeat).astype(int) % W].T
+
+        levels = self.get_mip_levels()
+        lod = np.clip(lod, 0.0, len(levels) - 1)
+        lower = np.minimum(lod.astype(int), len(levels) - 2) if len(levels) > 1 else np.zeros(lod.shape, int)
+        t = lod - lower
+
+        # the texels of a level cover 2^k x 2^k texels of the image
+        H, W = self.shape[:2]
+        row, column = -((v * H * repeat).astype(int) % H) % H, (u * W * repeat).astype(int) % W
+
+        out = np.zeros(self.shape[2:] + u.shape)
+        for k in np.unique(np.concatenate([lower, lower + 1])):
+            if k >= len(levels):
+                continue
+            weight = np.where(lower == k, 1.0 - t, 0.0) + np.where(lower + 1 == k, t, 0.0)
+            index = np.nonzero(weight > 0.0)[0]
+            if index.size == 0:
+                continue
+            texels = levels[k][row[index] >> k, column[index] >> k]
+            out[..., index] += np.asarray(texels, dtype=np.float64).T * weight[index]
+        return out
+
+
+texture_registry = {}  # key: Texels
+texture_registry_lock = threading.RLock()  # loads can use other textures
+
+
+def texture_key(path):
+    """Returns the registry key of an image file: its resolved path, so every path of a file shares its Texels."""
+    return str(Path(path).resolve())
+
+
+def cached_texels(key, load):
+    """
+    Returns the Texels registered for key, calling load() to create them the first time.
+    Keys naming image files use texture_key.
+    """
+    with texture_registry_lock:
+        if key not in texture_registry:
+            texture_registry[key] = load()
+        return texture_registry[key]
+
+
+def get_texels(path, linear=False, blur=0.0, layout=None):
+    """
+    Returns the shared Texels of an image: its values as loaded by load_image,
+    or by load_image_as_linear_sRGB if linear is True (with a Gaussian blur of the given radius).
+    layout: The layout of the image for its mip levels (see Texels).
+    """
+    path = Path(path)
+
+    def load():
+        if linear:
+            print("proccesing " + path.name)
+        img = Image.open(path)
+        if blur != 0.0:
+            img = img.filter(ImageFilter.GaussianBlur(radius=blur))
+        data = np.asarray(img)
+        if data.dtype == np.uint8:
+            return Texels(data, LUTS[linear], layout)
+        data = data / 256.0
+        if linear:
+            data = sRGB_to_sRGB_linear(data)
+        return Texels(data.astype(np.float16), layout=layout)
+
+    return cached_texels((texture_key(path), linear, blur, layout), load)
+
+
+def texture_memory():
+    """Returns the number of bytes of the texels in the registry."""
+    with texture_registry_lock:
+        return sum(texels.nbytes for texels in texture_registry.values())
+
+
+def clear_textures():
+    """Empties the texture registry (the texels stay alive while materials use them)."""
+    with texture_registry_lock:
+        texture_registry.clear()
+
+
+def to_8bit_image(rgb, width, height):
+    """Returns a PIL RGB image of display RGB values in [0, 1] (an array of shape (3, width * height), row-major pixels)."""
+    data = (255 * np.clip(rgb, 0, 1)).astype(np.uint8)
+    return Image.fromarray(data.reshape(3, height, width).transpose(1, 2, 0), "RGB")
+
+
+def save_pfm(path, data):
+    """
+    Writes a float32 Portable Float Map: an array of shape (height, width, 3) (PF, color)
+    or (height, width) (Pf, greyscale). Rows are stored bottom to top, little endian.
+    """
+    data = np.asarray(data, dtype="<f4")
+    header = "PF" if data.ndim == 3 else "Pf"
+    with open(path, "wb") as f:
+        f.write(b"%s\n%d %d\n-1.0\n" % (header.encode(), data.shape[1], data.shape[0]))
+        f.write(np.ascontiguousarray(data[::-1]).tobytes())
+
+
+def load_pfm(path):
+    """Reads a Portable Float Map written by save_pfm (or any other), returns a float32 array (top row first)."""
+    with open(path, "rb") as f:
+        header = f.readline().strip()
+        width, height = map(int, f.readline().split())
+        scale = float(f.readline())
+        channels = 3 if header == b"PF" else 1
+        data = np.frombuffer(f.read(), dtype="<f4" if scale < 0 else ">f4")
+
+    shape = (height, width, 3) if channels == 3 else (height, width)
+    return data.reshape(shape)[::-1].astype(np.float32)
@@ -1,19 +1,51 @@
+import contextlib
+import threading
 import numpy as np
 from ..utils.vector3 import vec3
 from abc import abstractmethod
 
 
-def random_in_unit_disk(shape):
-    r = np.sqrt(np.random.rand(shape))
-    phi = np.random.rand(shape) * 2 * np.pi
+# The random numbers of the paths are drawn from the global NumPy random state, unless the calling
+# thread has its own (see thread_random_state): the threads of a threaded render seed the state of
+# their tile, so the numbers of a tile don't depend on the other threads.
+thread_state = threading.local()
+
+
+def rng():
+    """Returns the random state of the calling thread: its own one, or the global one of np.random."""
+    state = getattr(thread_state, "random_state", None)
+    return np.random if state is None else state
+
+
+def seed_random(seed):
+    """Seeds the random state of the calling thread (see rng)."""
+    rng().seed(seed)
+
+
+@contextlib.contextmanager
+def thread_random_state():
+    """Gives the calling thread its own random state (see rng) until the end of the block."""
+    thread_state.random_state = np.random.RandomState()
+    try:
+        yield
+    finally:
+        thread_state.random_state = None
+
+
+def random_in_unit_disk(shape, u=None):
+    # u: optional (2, shape) array of sample points in [0, 1)^2 (see sampler.py), random if None
+    if u is None:
+        u = rng().rand(2, shape)
+    r = np.sqrt(u[0])
+    phi = u[1] * 2 * np.pi
     return r * np.cos(phi), r * np.sin(phi)
 
 
 def random_in_unit_sphere(shape):
 
     # https://mathworld.wolfram.com/SpherePointPicking.html
-    phi = np.random.rand(shape) * 2 * np.pi
-    u = 2.0 * np.random.rand(shape) - 1.0
+    phi = rng().rand(shape) * 2 * np.pi
+    u = 2.0 * rng().rand(shape) - 1.0
     r = np.sqrt(1 - u**2)
     return vec3(r * np.cos(phi), r * np.sin(phi), u)
 
@@ -57,14 +89,17 @@ class cosine_pdf(PDF):
     def value(self, ray_dir):
         return np.clip(ray_dir.dot(self.normal), 0.0, 1.0) / np.pi
 
-    def generate(self):
+    def generate(self, u=None):
+        # u: optional (2, shape) array of sample points in [0, 1)^2 (see sampler.py), random if None
         ax_w = self.normal
         a = vec3.where(np.abs(ax_w.x) > 0.9, vec3(0, 1, 0), vec3(1, 0, 0))
         ax_v = ax_w.cross(a).normalize()
         ax_u = ax_w.cross(ax_v)
 
-        phi = np.random.rand(self.shape) * 2 * np.pi
-        r2 = np.random.rand(self.shape)
+        if u is None:
+            u = rng().rand(2, self.shape)
+        phi = u[0] * 2 * np.pi
+        r2 = u[1]
 
         z = np.sqrt(1 - r2)
         x = np.cos(phi) * np.sqrt(r2)
@@ -73,6 +108,69 @@ class cosine_pdf(PDF):
         return ax_u * x + ax_v * y + ax_w * z
 
 
+class microfacet_pdf(PDF):
+    """
+    Probability density Function of the directions reflected by a rough surface
+    whose microfacet normals are sampled from the GGX or Beckmann distribution.
+    """
+
+    def __init__(self, shape, normal, view, roughness, distribution="ggx"):
+        self.shape = shape
+        self.normal = normal
+        self.view = view  # direction to the viewer
+        self.alpha = max(roughness, 1e-4)
+        self.distribution = distribution
+
+    def D(self, NdotH):
+        # normal distribution function
+        alpha2 = self.alpha**2
+        cos2 = NdotH**2
+        if self.distribution == "ggx":
+            return alpha2 / (np.pi * (cos2 * (alpha2 - 1.0) + 1.0) ** 2)
+        tan2 = (1.0 - cos2) / np.maximum(cos2, 1e-12)
+        return np.exp(-tan2 / alpha2) / (np.pi * alpha2 * np.maximum(cos2, 1e-12) ** 2)
+
+    def G1(self, NdotX):
+        # Smith masking of the microfacets seen from direction X
+        NdotX = np.clip(NdotX, 1e-6, 1.0)
+        if self.distribution == "ggx":
+            alpha2 = self.alpha**2
+            return 2.0 * NdotX / (NdotX + np.sqrt(alpha2 + (1.0 - alpha2) * NdotX**2))
+        # rational approximation of Walter et al. 2007
+        a = NdotX / (self.alpha * np.sqrt(1.0 - NdotX**2) + 1e-12)
+        return np.where(
+            a < 1.6, (3.535 * a + 2.181 * a**2) / (1.0 + 2.276 * a + 2.577 * a**2), 1.0
+        )
+
+    def value(self, ray_dir):
+        H = (ray_dir + self.view).normalize()
+        NdotH = np.clip(H.dot(self.normal), 0.0, 1.0)
+        VdotH = np.clip(H.dot(self.view), 1e-6, 1.0)
+        return self.D(NdotH) * NdotH / (4.0 * VdotH)
+
+    def generate(self, u=None):
+        # u: optional (2, shape) array of sample points in [0, 1)^2 (see sampler.py), random if None
+        ax_w = self.normal
+        a = vec3.where(np.abs(ax_w.x) > 0.9, vec3(0, 1, 0), vec3(1, 0, 0))
+        ax_v = ax_w.cross(a).normalize()
+        ax_u = ax_w.cross(ax_v)
+
+        if u is None:
+            u = rng().rand(2, self.shape)
+        phi = u[0] * 2 * np.pi
+        if self.distribution == "ggx":
+            tan2 = self.alpha**2 * u[1] / (1.0 - u[1])
+        else:
+            tan2 = -self.alpha**2 * np.log(1.0 - u[1])
+
+        z = 1.0 / np.sqrt(1.0 + tan2)
+        r = np.sqrt(1.0 - z**2)
+        H = ax_u * (np.cos(phi) * r) + ax_v * (np.sin(phi) * r) + ax_w * z
+
+        # the view direction reflected by the microfacet normal
+        return H * (2.0 * self.view.dot(H)) - self.view
+
+
 class spherical_caps_pdf(PDF):
     """Probability density Function"""
 
@@ -81,27 +179,14 @@ class spherical_caps_pdf(PDF):
         self.origin = origin
         self.importance_sampled_list = importance_sampled_list
         self.l = len(importance_sampled_list)
+        self.cosθmax_list = None
 
-    def value(self, ray_dir):
-        PDF_value = 0.0
-        for i in range(self.l):
-            PDF_value += np.where(
-                ray_dir.dot(self.ax_w_list[i]) > self.cosθmax_list[i],
-                1 / ((1 - self.cosθmax_list[i]) * 2 * np.pi),
-                0.0,
-            )
-        PDF_value = PDF_value / self.l
-        return PDF_value
-
-    def generate(self):
-        shape = self.shape
+    def set_cones(self):
+        # cone of directions from the origin to the bounding sphere of every primitive
         origin = self.origin
         importance_sampled_list = self.importance_sampled_list
         l = self.l
 
-        mask = (np.random.rand(shape) * l).astype(int)
-        mask_list = [None] * l
-
         cosθmax_list = [None] * l
         ax_u_list = [None] * l
         ax_v_list = [None] * l
@@ -113,7 +198,6 @@ class spherical_caps_pdf(PDF):
             a = vec3.where(np.abs(ax_w_list[i].x) > 0.9, vec3(0, 1, 0), vec3(1, 0, 0))
             ax_v_list[i] = ax_w_list[i].cross(a).normalize()
             ax_u_list[i] = ax_w_list[i].cross(ax_v_list[i])
-            mask_list[i] = mask == i
 
             target_distance = np.sqrt(
                 (importance_sampled_list[i].center - origin).dot(
@@ -132,15 +216,49 @@ class spherical_caps_pdf(PDF):
             )
 
         self.cosθmax_list = cosθmax_list
+        self.ax_u_list = ax_u_list
+        self.ax_v_list = ax_v_list
         self.ax_w_list = ax_w_list
 
-        phi = np.random.rand(shape) * 2 * np.pi
-        r2 = np.random.rand(shape)
+    def value(self, ray_dir):
+        if self.cosθmax_list is None:
+            self.set_cones()
+        PDF_value = 0.0
+        for i in range(self.l):
+            PDF_value += np.where(
+                ray_dir.dot(self.ax_w_list[i]) > self.cosθmax_list[i],
+                1 / ((1 - self.cosθmax_list[i]) * 2 * np.pi),
+                0.0,
+            )
+        PDF_value = PDF_value / self.l
+        return PDF_value
+
+    def generate(self, u=None):
+        # u: optional (2, shape) array of sample points in [0, 1)^2 (see sampler.py), random if None.
+        # The first coordinate picks the primitive and is rescaled to pick the direction in its cone.
+        shape = self.shape
+        l = self.l
+
+        if u is None:
+            mask = (rng().rand(shape) * l).astype(int)
+        else:
+            mask = np.minimum((u[0] * l).astype(int), l - 1)
+        mask_list = [mask == i for i in range(l)]
+
+        if self.cosθmax_list is None:
+            self.set_cones()
+
+        if u is None:
+            phi = rng().rand(shape) * 2 * np.pi
+            r2 = rng().rand(shape)
+        else:
+            phi = (u[0] * l - mask) * 2 * np.pi
+            r2 = u[1]
 
-        cosθmax = np.select(mask_list, cosθmax_list)
-        ax_w = vec3.select(mask_list, ax_w_list)
-        ax_v = vec3.select(mask_list, ax_v_list)
-        ax_u = vec3.select(mask_list, ax_u_list)
+        cosθmax = np.select(mask_list, self.cosθmax_list)
+        ax_w = vec3.select(mask_list, self.ax_w_list)
+        ax_v = vec3.select(mask_list, self.ax_v_list)
+        ax_u = vec3.select(mask_list, self.ax_u_list)
 
         z = 1.0 + r2 * (cosθmax - 1.0)
         x = np.cos(phi) * np.sqrt(1.0 - z**2)
@@ -168,7 +286,7 @@ class mixed_pdf(PDF):
         )
 
     def generate(self):
-        mask = np.random.rand(self.shape)
+        mask = rng().rand(self.shape)
         return vec3.where(
             mask < self.pdf1_weight, self.pdf1.generate(), self.pdf2.generate()
         )
@@ -178,7 +296,7 @@ def random_in_unit_spherical_caps(shape, origin, importance_sampled_list):
 
     l = len(importance_sampled_list)
 
-    mask = (np.random.rand(shape) * l).astype(int)
+    mask = (rng().rand(shape) * l).astype(int)
     mask_list = [None] * l
 
     cosθmax_list = [None] * l
@@ -210,8 +328,8 @@ def random_in_unit_spherical_caps(shape, origin, importance_sampled_list):
             ** 2
         )
 
-    phi = np.random.rand(shape) * 2 * np.pi
-    r2 = np.random.rand(shape)
+    phi = rng().rand(shape) * 2 * np.pi
+    r2 = rng().rand(shape)
 
     cosθmax = np.select(mask_list, cosθmax_list)
     ax_w = vec3.select(mask_list, ax_w_list)
@@ -243,8 +361,8 @@ def random_in_unit_spherical_cap(shape, cosθmax, normal):
     ax_v = ax_w.cross(a).normalize()
     ax_u = ax_w.cross(ax_v)
 
-    phi = np.random.rand(shape) * 2 * np.pi
-    r2 = np.random.rand(shape)
+    phi = rng().rand(shape) * 2 * np.pi
+    r2 = rng().rand(shape)
 
     z = 1.0 + r2 * (cosθmax - 1.0)
     x = np.cos(phi) * np.sqrt(1.0 - z**2)
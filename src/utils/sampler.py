@@ -0,0 +1,309 @@
+import functools
+import numpy as np
+from abc import abstractmethod
+from .random import rng
+
+
+# Samplers hand out the random numbers of the paths, two dimensions at a time.
+# Dimensions are numbered along a path, so a sampler can correlate them across the samples
+# of a pixel (camera rays) or across the rays scattered by a hit (diffuse fan-out):
+# - PIXEL_DIMENSION: the position of the camera ray in the pixel,
+# - LENS_DIMENSION: the position of the camera ray on the lens,
+# - BOUNCE_DIMENSION + 2 * depth: the directions scattered at the given depth.
+# The camera rays of a pixel are the successive points of a sequence keyed by the pixel (the sample
+# index is the number of samples the pixel already has, so tiles, resumed and adaptive renders
+# continue the sequence). The rays scattered by a hit are a set of points keyed by a random number.
+#
+# The random sampler draws independent uniform numbers (random.rng, the default, same numbers as before
+# there were samplers). The others are randomized low discrepancy points, so the estimates
+# converge faster than white noise: jittered stratification, Halton with Cranley-Patterson rotations,
+# Owen-scrambled and shuffled Sobol (Burley 2020), and Sobol with pixels shifted by a blue noise mask
+# (Georgiev and Fajardo 2016), so the remaining error of neighbouring pixels is uncorrelated.
+
+PIXEL_DIMENSION = 0
+LENS_DIMENSION = 2
+BOUNCE_DIMENSION = 4
+
+PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71)
+
+
+def hash_uint32(x):
+    """Hashes an array of integers to well mixed uint32 values."""
+    x = np.asarray(x).astype(np.uint32)
+    x ^= x >> np.uint32(16)
+    x *= np.uint32(0x7FEB352D)
+    x ^= x >> np.uint32(15)
+    x *= np.uint32(0x846CA68B)
+    x ^= x >> np.uint32(16)
+    return x
+
+
+def hash_combine(key, *values):
+    h = hash_uint32(key)
+    for value in values:
+        h = hash_uint32(h ^ hash_uint32(np.uint32(value & 0xFFFFFFFF)))
+    return h
+
+
+def to_unit(x):
+    # uint32 to a float in [0, 1)
+    return x.astype(np.float64) * 2.0**-32
+
+
+def reverse_bits(x):
+    x = x.astype(np.uint32)
+    x = ((x >> np.uint32(1)) & np.uint32(0x55555555)) | (
+        (x & np.uint32(0x55555555)) << np.uint32(1)
+    )
+    x = ((x >> np.uint32(2)) & np.uint32(0x33333333)) | (
+        (x & np.uint32(0x33333333)) << np.uint32(2)
+    )
+    x = ((x >> np.uint32(4)) & np.uint32(0x0F0F0F0F)) | (
+        (x & np.uint32(0x0F0F0F0F)) << np.uint32(4)
+    )
+    x = ((x >> np.uint32(8)) & np.uint32(0x00FF00FF)) | (
+        (x & np.uint32(0x00FF00FF)) << np.uint32(8)
+    )
+    return (x >> np.uint32(16)) | (x << np.uint32(16))
+
+
+def nested_uniform_scramble(x, seed):
+    """Owen scrambling of 32 bit integers in base 2 (Laine-Karras permutation of the reversed bits)."""
+    x = reverse_bits(x)
+    x += seed
+    x ^= x * np.uint32(0x6C50B47C)
+    x ^= x * np.uint32(0xB82F1E52)
+    x ^= x * np.uint32(0xC7AFE638)
+    x ^= x * np.uint32(0x8D22F6E6)
+    return reverse_bits(x)
+
+
+# generator matrix (direction numbers) of the second Sobol dimension; the first one is the bit reversal
+SOBOL_DIRECTIONS = [1 << 31]
+for _ in range(31):
+    SOBOL_DIRECTIONS.append(SOBOL_DIRECTIONS[-1] ^ (SOBOL_DIRECTIONS[-1] >> 1))
+
+
+def sobol_2d(index):
+    """Returns the first two dimensions of the Sobol sequence (as uint32) for an array of indices."""
+    index = index.astype(np.uint32)
+    y = np.zeros_like(index)
+    for bit, direction in enumerate(SOBOL_DIRECTIONS):
+        y ^= np.where(
+            (index >> np.uint32(bit)) & np.uint32(1), np.uint32(direction), np.uint32(0)
+        )
+    return reverse_bits(index), y
+
+
+def radical_inverse(index, base):
+    index = index.astype(np.int64)
+    result = np.zeros(index.shape)
+    scale = 1.0 / base
+    while np.any(index > 0):
+        result += (index % base) * scale
+        index //= base
+        scale /= base
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def blue_noise_mask(size=64, sigma=1.5):
+    """
+    Returns a size x size blue noise dither mask (values in (0, 1), each rank once),
+    built with the void and cluster method of Ulichney with a toroidal Gaussian filter.
+    """
+    n = size * size
+    d = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(d[:, None] ** 2 + d[None, :] ** 2) / (2 * sigma**2)).ravel()
+    rows, columns = np.divmod(np.arange(n), size)
+
+    def splat(i):
+        # filter response of a single point at i
+        return kernel.reshape(size, size)[
+            (rows - rows[i]) % size, (columns - columns[i]) % size
+        ]
+
+    def energy(pattern):
+        return sum(splat(i) for i in np.nonzero(pattern)[0])
+
+    # initial pattern: random points whose tightest cluster is moved to the largest void until stable
+    state = np.random.RandomState(0)
+    pattern = np.zeros(n, dtype=bool)
+    pattern[state.choice(n, n // 10, replace=False)] = True
+    e = energy(pattern)
+    while True:
+        cluster = np.argmax(np.where(pattern, e, -np.inf))
+        pattern[cluster] = False
+        e -= splat(cluster)
+        void = np.argmin(np.where(pattern, np.inf, e))
+        pattern[void] = True
+        e += splat(void)
+        if void == cluster:
+            break
+
+    rank = np.zeros(n, dtype=np.int64)
+    ones = int(pattern.sum())
+
+    # points of the initial pattern are ranked by removing the tightest clusters
+    p, e1 = pattern.copy(), e.copy()
+    for r in range(ones - 1, -1, -1):
+        cluster = np.argmax(np.where(p, e1, -np.inf))
+        p[cluster] = False
+        e1 -= splat(cluster)
+        rank[cluster] = r
+
+    # the others by filling the largest voids
+    p, e2 = pattern.copy(), e.copy()
+    for r in range(ones, n):
+        void = np.argmin(np.where(p, np.inf, e2))
+        p[void] = True
+        e2 += splat(void)
+        rank[void] = r
+
+    return ((rank + 0.5) / n).reshape(size, size)
+
+
+class Sampler:
+    """
+    Base class of the samplers.
+
+    Args:
+    - samples_per_pixel: The number of samples per pixel of the render (used by the stratified sampler).
+    - seed: Seed of the randomization of the points.
+    """
+
+    def __init__(self, samples_per_pixel=1, seed=0):
+        self.samples_per_pixel = samples_per_pixel
+        self.seed = seed
+
+    @abstractmethod
+    def get_2d(self, index, count, dimension, key):
+        """
+        Returns a NumPy array of shape (2, n) with points in [0, 1)^2.
+
+        Args:
+        - index: An integer array of shape (n,): the index of every point in its set.
+        - count: The number of points of a set.
+        - dimension: The first of the two dimensions.
+        - key: An integer array of shape (n,) identifying the set of every point.
+          Points with the same key are well distributed together.
+        """
+        pass
+
+    def get_pixel_2d(self, pixel_index, sample_index, dimension, width):
+        """Returns the points (shape (2, n)) of the given samples of the given pixels, for a screen of the given width."""
+        return self.get_2d(sample_index, self.samples_per_pixel, dimension, pixel_index)
+
+    def get_sets(self, num_sets, count, dimension):
+        """Returns num_sets sets of count points (shape (2, num_sets * count), the points of a set are contiguous)."""
+        index = np.tile(np.arange(count), num_sets)
+        key = np.repeat(rng().randint(0, 2**32, num_sets, dtype=np.uint64), count)
+        return self.get_2d(index, count, dimension, key)
+
+    def get_shift(self, key, dimension):
+        # Cranley-Patterson rotation of the points of a key
+        return np.stack(
+            [
+                to_unit(hash_combine(key, dimension, self.seed)),
+                to_unit(hash_combine(key, dimension + 1, self.seed)),
+            ]
+        )
+
+
+class RandomSampler(Sampler):
+    """Independent uniform random numbers."""
+
+    def get_2d(self, index, count, dimension, key):
+        return rng().rand(2, np.shape(index)[0])
+
+    def get_sets(self, num_sets, count, dimension):
+        return rng().rand(2, num_sets * count)
+
+
+class StratifiedSampler(Sampler):
+    """
+    Multi-jittered points (Chiu et al. 1994), shifted per key: a set of count points
+    has one point per cell of a grid and one point per stratum of each dimension.
+    """
+
+    def get_2d(self, index, count, dimension, key):
+        count = max(count, 1)
+        nx = int(np.sqrt(count))
+        ny = -(-count // nx)
+        i = np.asarray(index) % count
+        column, row = i % nx, i // nx
+        jitter = rng().rand(2, i.shape[0])
+        points = np.stack(
+            [
+                (column + (row + jitter[0]) / ny) / nx,
+                (row + (column + jitter[1]) / nx) / ny,
+            ]
+        )
+        points += self.get_shift(key, dimension)
+        return points % 1.0
+
+
+class HaltonSampler(Sampler):
+    """Halton sequence (one prime base per dimension), shifted per key."""
+
+    def get_2d(self, index, count, dimension, key):
+        # The points of a set scattered by a hit are only used by one pair of dimensions,
+        # so they all take the best distributed bases.
+        if dimension >= BOUNCE_DIMENSION:
+            dimension = 0
+        base_x, base_y = PRIMES[dimension], PRIMES[dimension + 1]
+        index = np.asarray(index)
+        points = np.stack(
+            [radical_inverse(index, base_x), radical_inverse(index, base_y)]
+        )
+        points += self.get_shift(key, dimension)
+        return points % 1.0
+
+
+class SobolSampler(Sampler):
+    """
+    Sobol (0, 2)-sequence, Owen-scrambled per key and dimension. The order of the points
+    is also shuffled per dimension, so the dimensions of a sample aren't correlated.
+    """
+
+    def get_2d(self, index, count, dimension, key):
+        seed = hash_combine(key, dimension, self.seed)
+        index = nested_uniform_scramble(np.asarray(index), seed)
+        x, y = sobol_2d(index)
+        x = nested_uniform_scramble(x, hash_uint32(seed ^ np.uint32(1)))
+        y = nested_uniform_scramble(y, hash_uint32(seed ^ np.uint32(2)))
+        return np.stack([to_unit(x), to_unit(y)])
+
+
+class BlueNoiseSampler(SobolSampler):
+    """
+    Sobol points of the pixel dimensions are the same for every pixel, shifted by a
+    tiled blue noise mask, so the error is distributed as blue noise on the screen.
+    """
+
+    def get_pixel_2d(self, pixel_index, sample_index, dimension, width):
+        points = self.get_2d(
+            sample_index, self.samples_per_pixel, dimension, np.zeros_like(pixel_index)
+        )
+        mask = blue_noise_mask()
+        size = mask.shape[0]
+        rows, columns = np.divmod(pixel_index, width)
+        # a different toroidal offset of the mask for every dimension
+        offset = hash_combine(dimension, self.seed) % np.uint32(size * size)
+        row_offset, column_offset = int(offset) // size, int(offset) % size
+        points[0] += mask[(rows + row_offset) % size, (columns + column_offset) % size]
+        points[1] += mask[
+            (rows + column_offset + size // 2) % size,
+            (columns + row_offset + size // 3) % size,
+        ]
+        return points % 1.0
+
+
+# samplers, by name
+samplers = {
+    "random": RandomSampler,
+    "stratified": StratifiedSampler,
+    "halton": HaltonSampler,
+    "sobol": SobolSampler,
+    "blue_noise": BlueNoiseSampler,
+}
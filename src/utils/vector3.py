@@ -9,94 +9,200 @@ def extract(cond, x):
         return np.extract(cond, x)
 
 
+def take(index, x):
+    if isinstance(x, numbers.Number):
+        return x
+    else:
+        return x[index]
+
+
+def column(data, ndim=1):
+    # a single vector of shape (3,) is broadcasted as (3, 1, ...) against arrays of vectors
+    if data.ndim == 1 and ndim > 0:
+        return data.reshape((3,) + (1,) * ndim)
+    return data
+
+
 class vec3:
+    # The components are stored in a single (3, ...) array: data[0] is x, data[1] is y and data[2] is z.
+    # A single vector has shape (3,) and a batch of N vectors has shape (3, N),
+    # so every operation is a single NumPy call on the whole block.
+
+    __slots__ = ("data",)
 
     def __init__(self, x, y, z):
-        self.x = x
-        self.y = y
-        self.z = z
+        if (
+            isinstance(x, numbers.Number)
+            and isinstance(y, numbers.Number)
+            and isinstance(z, numbers.Number)
+        ):
+            self.data = np.array([x, y, z])
+        else:
+            self.data = np.stack(np.broadcast_arrays(x, y, z))
+
+    def from_array(data):
+        # wraps a (3, ...) array without copying it
+        v = vec3.__new__(vec3)
+        v.data = data
+        return v
+
+    @property
+    def x(self):
+        return self.data[0]
+
+    @x.setter
+    def x(self, value):
+        self.data = vec3(value, self.data[1], self.data[2]).data
+
+    @property
+    def y(self):
+        return self.data[1]
+
+    @y.setter
+    def y(self, value):
+        self.data = vec3(self.data[0], value, self.data[2]).data
+
+    @property
+    def z(self):
+        return self.data[2]
+
+    @z.setter
+    def z(self, value):
+        self.data = vec3(self.data[0], self.data[1], value).data
 
     def __str__(self):
         # Used for debugging. This method is called when you print an instance
         return "(" + str(self.x) + ", " + str(self.y) + ", " + str(self.z) + ")"
 
-    def __add__(self, v):
+    def operands(self, v):
+        # returns the arrays of self and v, aligned for broadcasting
         if isinstance(v, vec3):
-            return vec3(self.x + v.x, self.y + v.y, self.z + v.z)
-        elif isinstance(v, numbers.Number) or isinstance(v, np.ndarray):
-            return vec3(self.x + v, self.y + v, self.z + v)
+            return column(self.data, v.data.ndim - 1), column(
+                v.data, self.data.ndim - 1
+            )
+        elif isinstance(v, numbers.Number):
+            return self.data, v
+        elif isinstance(v, np.ndarray):
+            return column(self.data, v.ndim), v
+        return None, None
+
+    def __add__(self, v):
+        a, b = self.operands(v)
+        if a is None:
+            return NotImplemented
+        return vec3.from_array(a + b)
 
     def __radd__(self, v):
-        if isinstance(v, vec3):
-            return vec3(self.x + v.x, self.y + v.y, self.z + v.z)
-        elif isinstance(v, numbers.Number) or isinstance(v, np.ndarray):
-            return vec3(self.x + v, self.y + v, self.z + v)
+        a, b = self.operands(v)
+        if a is None:
+            return NotImplemented
+        return vec3.from_array(b + a)
 
     def __sub__(self, v):
-        if isinstance(v, vec3):
-            return vec3(self.x - v.x, self.y - v.y, self.z - v.z)
-        elif isinstance(v, numbers.Number) or isinstance(v, np.ndarray):
-            return vec3(self.x - v, self.y - v, self.z - v)
+        a, b = self.operands(v)
+        if a is None:
+            return NotImplemented
+        return vec3.from_array(a - b)
 
     def __rsub__(self, v):
-        if isinstance(v, vec3):
-            return vec3(v.x - self.x, v.y - self.y, v.z - self.z)
-        elif isinstance(v, numbers.Number) or isinstance(v, np.ndarray):
-            return vec3(v - self.x, v - self.y, v - self.z)
+        a, b = self.operands(v)
+        if a is None:
+            return NotImplemented
+        return vec3.from_array(b - a)
 
     def __mul__(self, v):
-        if isinstance(v, vec3):
-            return vec3(self.x * v.x, self.y * v.y, self.z * v.z)
-        elif isinstance(v, numbers.Number) or isinstance(v, np.ndarray):
-            return vec3(self.x * v, self.y * v, self.z * v)
+        a, b = self.operands(v)
+        if a is None:
+            return NotImplemented
+        return vec3.from_array(a * b)
 
     def __rmul__(self, v):
-        if isinstance(v, vec3):
-            return vec3(v.x * self.x, v.y * self.y, v.z * self.z)
-        elif isinstance(v, numbers.Number) or isinstance(v, np.ndarray):
-            return vec3(v * self.x, v * self.y, v * self.z)
+        a, b = self.operands(v)
+        if a is None:
+            return NotImplemented
+        return vec3.from_array(b * a)
 
     def __truediv__(self, v):
-        if isinstance(v, vec3):
-            return vec3(self.x / v.x, self.y / v.y, self.z / v.z)
-        elif isinstance(v, numbers.Number) or isinstance(v, np.ndarray):
-            return vec3(self.x / v, self.y / v, self.z / v)
+        a, b = self.operands(v)
+        if a is None:
+            return NotImplemented
+        return vec3.from_array(a / b)
 
     def __rtruediv__(self, v):
-        if isinstance(v, vec3):
-            return vec3(v.x / self.x, v.y / self.y, v.z / self.z)
-        elif isinstance(v, numbers.Number) or isinstance(v, np.ndarray):
-            return vec3(v / self.x, v / self.y, v / self.z)
+        a, b = self.operands(v)
+        if a is None:
+            return NotImplemented
+        return vec3.from_array(b / a)
+
+    def inplace(self, ufunc, v):
+        # writes the result in self if it has the same shape and type, otherwise returns a new vec3
+        a, b = self.operands(v)
+        if a is None:
+            return NotImplemented
+        if (
+            a.shape == self.data.shape
+            and np.broadcast_shapes(a.shape, np.shape(b)) == a.shape
+            and np.can_cast(np.result_type(a, b), a.dtype, "same_kind")
+        ):
+            ufunc(a, b, out=a)
+            return self
+        return vec3.from_array(ufunc(a, b))
+
+    def __iadd__(self, v):
+        return self.inplace(np.add, v)
+
+    def __isub__(self, v):
+        return self.inplace(np.subtract, v)
+
+    def __imul__(self, v):
+        return self.inplace(np.multiply, v)
+
+    def __itruediv__(self, v):
+        return self.inplace(np.true_divide, v)
+
+    def apply(self, ufunc, v, out=None):
+        # self (ufunc) v, written in the vec3 out if it is given
+        a, b = self.operands(v)
+        if out is None:
+            return vec3.from_array(ufunc(a, b))
+        ufunc(a, b, out=out.data)
+        return out
+
+    def add(self, v, out=None):
+        return self.apply(np.add, v, out)
+
+    def sub(self, v, out=None):
+        return self.apply(np.subtract, v, out)
+
+    def mul(self, v, out=None):
+        return self.apply(np.multiply, v, out)
+
+    def div(self, v, out=None):
+        return self.apply(np.true_divide, v, out)
 
     def __abs__(self):
-        return vec3(np.abs(self.x), np.abs(self.y), np.abs(self.z))
+        return vec3.from_array(np.abs(self.data))
 
     def real(v):
-        return vec3(np.real(v.x), np.real(v.y), np.real(v.z))
+        return vec3.from_array(np.real(v.data))
 
     def imag(v):
-        return vec3(np.imag(v.x), np.imag(v.y), np.imag(v.z))
+        return vec3.from_array(np.imag(v.data))
 
     def yzx(self):
-        return vec3(self.y, self.z, self.x)
+        return vec3.from_array(self.data[[1, 2, 0]])
 
     def xyz(self):
-        return vec3(self.x, self.y, self.z)
+        return vec3.from_array(self.data.copy())
 
     def zxy(self):
-        return vec3(self.z, self.x, self.y)
-
-    def xyz(self):
-        return vec3(self.x, self.y, self.z)
+        return vec3.from_array(self.data[[2, 0, 1]])
 
     def average(self):
-        return (self.x + self.y + self.z) / 3
+        return self.data.sum(axis=0) / 3
 
     def matmul(self, matrix):
-        if isinstance(self.x, numbers.Number):
-            return array_to_vec3(np.dot(matrix, self.to_array()))
-        elif isinstance(self.x, np.ndarray):
-            return array_to_vec3(np.tensordot(matrix, self.to_array(), axes=([1, 0])))
+        return vec3.from_array(np.tensordot(matrix, self.data, axes=([1, 0])))
 
     def change_basis(self, new_basis):
         return vec3(
@@ -104,26 +210,24 @@ class vec3:
         )
 
     def __pow__(self, a):
-        return vec3(self.x**a, self.y**a, self.z**a)
+        return vec3.from_array(self.data**a)
 
     def dot(self, v):
-        return self.x * v.x + self.y * v.y + self.z * v.z
+        a, b = self.operands(v)
+        return np.einsum("i...,i...->...", a, b)
 
     def exp(v):
-        return vec3(np.exp(v.x), np.exp(v.y), np.exp(v.z))
+        return vec3.from_array(np.exp(v.data))
 
     def sqrt(v):
-        return vec3(np.sqrt(v.x), np.sqrt(v.y), np.sqrt(v.z))
+        return vec3.from_array(np.sqrt(v.data))
 
     def to_array(self):
-        return np.array([self.x, self.y, self.z])
+        return self.data
 
     def cross(self, v):
-        return vec3(
-            self.y * v.z - self.z * v.y,
-            -self.x * v.z + self.z * v.x,
-            self.x * v.y - self.y * v.x,
-        )
+        a, b = self.operands(v)
+        return vec3.from_array(np.cross(a, b, axis=0))
 
     def length(self):
         return np.sqrt(self.dot(self))
@@ -131,77 +235,89 @@ class vec3:
     def square_length(self):
         return self.dot(self)
 
-    def normalize(self):
+    def normalize(self, out=None):
         mag = self.length()
-        return self * (1.0 / np.where(mag == 0, 1, mag))
+        return self.mul(1.0 / np.where(mag == 0, 1, mag), out)
 
     def components(self):
         return (self.x, self.y, self.z)
 
     def extract(self, cond):
-        return vec3(extract(cond, self.x), extract(cond, self.y), extract(cond, self.z))
+        if self.data.ndim == 1:
+            return vec3.from_array(self.data.copy())
+        return vec3.from_array(self.data[:, np.asarray(cond) != 0])
 
-    def where(cond, out_true, out_false):
+    def take(self, index):
+        if self.data.ndim == 1:
+            return vec3.from_array(self.data.copy())
+        return vec3.from_array(self.data[:, index])
+
+    def put(self, index, v):
+        # in-place scatter of v into the entries given by index
+        self.data[:, index] = column(v.data)
+
+    def bincount(self, index, n):
+        # sums the vectors sharing the same index into n entries
         return vec3(
-            np.where(cond, out_true.x, out_false.x),
-            np.where(cond, out_true.y, out_false.y),
-            np.where(cond, out_true.z, out_false.z),
+            np.bincount(index, self.x, n),
+            np.bincount(index, self.y, n),
+            np.bincount(index, self.z, n),
         )
 
-    def select(mask_list, out_list):
-        out_list_x = [i.x for i in out_list]
-        out_list_y = [i.y for i in out_list]
-        out_list_z = [i.z for i in out_list]
+    def where(cond, out_true, out_false):
+        ndim = np.ndim(cond)
+        return vec3.from_array(
+            np.where(cond, column(out_true.data, ndim), column(out_false.data, ndim))
+        )
 
-        return vec3(
-            np.select(mask_list, out_list_x),
-            np.select(mask_list, out_list_y),
-            np.select(mask_list, out_list_z),
+    def select(mask_list, out_list):
+        ndim = max(np.ndim(mask) for mask in mask_list)
+        return vec3.from_array(
+            np.select(mask_list, [column(v.data, ndim) for v in out_list])
         )
 
     def clip(self, min, max):
-        return vec3(
-            np.clip(self.x, min, max),
-            np.clip(self.y, min, max),
-            np.clip(self.z, min, max),
-        )
+        return vec3.from_array(np.clip(self.data, min, max))
 
     def place(self, cond):
-        r = vec3(np.zeros(cond.shape), np.zeros(cond.shape), np.zeros(cond.shape))
-        np.place(r.x, cond, self.x)
-        np.place(r.y, cond, self.y)
-        np.place(r.z, cond, self.z)
-        return r
+        r = np.zeros((3,) + cond.shape)
+        r[:, cond] = column(self.data)
+        return vec3.from_array(r)
 
     def repeat(self, n):
-        return vec3(np.repeat(self.x, n), np.repeat(self.y, n), np.repeat(self.z, n))
+        return vec3.from_array(np.repeat(self.data.reshape(3, -1), n, axis=1))
 
     def reshape(self, *newshape):
-        return vec3(
-            self.x.reshape(*newshape),
-            self.y.reshape(*newshape),
-            self.z.reshape(*newshape),
-        )
+        if len(newshape) == 1 and isinstance(newshape[0], tuple):
+            newshape = newshape[0]
+        return vec3.from_array(self.data.reshape(3, *newshape))
 
     def shape(self, *newshape):
-        if isinstance(self.x, numbers.Number):
+        if self.data.ndim == 1:
             return 1
-        elif isinstance(self.x, np.ndarray):
-            return self.x.shape
+        else:
+            return self.data.shape[1:]
 
     def mean(self, axis):
-        return vec3(
-            np.mean(self.x, axis=axis),
-            np.mean(self.y, axis=axis),
-            np.mean(self.z, axis=axis),
-        )
+        return vec3.from_array(np.mean(self.data, axis=axis + 1 if axis >= 0 else axis))
 
     def __eq__(self, other):
-        return (self.x == other.x) & (self.y == other.y) & (self.z == other.z)
+        a, b = self.operands(other)
+        return np.logical_and.reduce(a == b, axis=0)
+
+
+def concatenate(vs, sizes):
+    # single vectors are broadcasted to their size
+    return vec3.from_array(
+        np.concatenate(
+            [np.broadcast_to(column(v.data), (3, size)) for v, size in zip(vs, sizes)],
+            axis=1,
+        )
+    )
 
 
 def array_to_vec3(array):
-    return vec3(array[0], array[1], array[2])
+    return vec3.from_array(np.asarray(array))
 
 
 global rgb
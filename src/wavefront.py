@@ -0,0 +1,107 @@
+from .utils.constants import *
+from .utils.vector3 import vec3, rgb, concatenate
+from .ray import Ray, get_hits, propagate_cones
+from .geometry.bvh import batch_size
+import numpy as np
+
+
+# Iterative (wavefront) alternative to the recursive get_raycolor.
+# Instead of tracing the rays scattered by a surface as soon as they are generated,
+# every bounce is processed as a whole generation: intersect, sort by material,
+# shade (Material.scatter) and push the continuation rays with their throughput to
+# the queue of the next generation. Only the rays of the current and the next
+# generation are alive at any time, and the batches of a generation are independent.
+
+
+def get_raycolor_wavefront(ray, scene, max_batch=2**16, aovs=None) -> vec3:
+    """
+    Computes the color of the rays iteratively, one generation of rays per bounce.
+
+    Args:
+    - ray: A Ray object containing the origin, direction, and other information of the rays.
+    - scene: A Scene object containing the list of objects in the scene.
+    - max_batch: The maximum number of rays intersected and shaded at once.
+      It bounds the memory of the intersection kernels, which grows with the size of the batch.
+    - aovs: An optional AOVSamples object (see aov.py) recording the first hit of the rays.
+
+    Returns:
+    - A vec3 object containing the color of the rays. It's the same estimate computed by get_raycolor.
+    """
+    n = batch_size(ray.origin, ray.dir)
+    color = np.zeros((3, n))
+
+    # Rays waiting to be traced, keyed by their counters (depth, reflections, transmissions, diffuse reflections),
+    # because materials branch on them for whole batches. Each entry is a list of
+    # (rays, throughput, index of the camera ray they contribute to).
+    queue = {ray.counters(): [(ray, rgb.from_array(np.ones((3, n))), np.arange(n))]}
+
+    while queue:
+        # all the continuations of a generation have the next depth
+        depth = min(key[0] for key in queue)
+        generation = [key for key in queue if key[0] == depth]
+
+        for key in generation:
+            for ray, throughput, pixel in split(merge(queue.pop(key)), max_batch):
+                trace(scene, ray, throughput, pixel, color, queue, aovs if depth == 0 else None)
+
+    return rgb.from_array(color)
+
+
+def trace(scene, ray, throughput, pixel, color, queue, aovs=None):
+    """Shades a batch of rays, accumulating their color and queuing their continuations."""
+    for index, hit in get_hits(ray, scene):
+        hit_throughput = throughput.take(index)
+        hit_pixel = pixel[index]
+        hit_ray = ray.take(index)
+        if aovs is not None:
+            aovs.record(hit_pixel, scene, hit_ray, hit)
+
+        local_color, continuations = hit.material.scatter(scene, hit_ray, hit)
+        local_color = local_color * hit_throughput
+        np.add.at(color, (slice(None), hit_pixel), local_color.data)
+
+        for next_ray, weight, parent in continuations:
+            propagate_cones(next_ray, hit_ray, hit, parent)
+            next_throughput = hit_throughput.take(parent) * weight
+
+            # compaction: rays that can't contribute any color are not traced
+            alive = np.nonzero(np.any(next_throughput.data != 0, axis=0))[0]
+            if alive.size == 0:
+                continue
+            if alive.size < parent.shape[0]:
+                next_ray, next_throughput, parent = (
+                    next_ray.take(alive),
+                    next_throughput.take(alive),
+                    parent[alive],
+                )
+
+            queue.setdefault(next_ray.counters(), []).append(
+                (next_ray, next_throughput, hit_pixel[parent])
+            )
+
+
+def merge(batches):
+    """Concatenates the queued (rays, throughput, pixel) batches that share the same counters."""
+    if len(batches) == 1:
+        return batches[0]
+
+    rays, throughputs, pixels = zip(*batches)
+    sizes = [pixel.shape[0] for pixel in pixels]
+    return (
+        Ray.concatenate(rays),
+        concatenate(throughputs, sizes),
+        np.concatenate(pixels),
+    )
+
+
+def split(batch, max_batch):
+    """Splits a (rays, throughput, pixel) batch in chunks of at most max_batch rays."""
+    ray, throughput, pixel = batch
+    n = pixel.shape[0]
+    if n <= max_batch:
+        yield batch
+        return
+
+    for start in range(0, n, max_batch):
+        chunk = slice(start, start + max_batch)
+        yield ray.take(chunk), throughput.take(chunk), pixel[chunk]